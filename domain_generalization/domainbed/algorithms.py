@@ -7,7 +7,7 @@ import torch.autograd as autograd
 
 import copy
 import numpy as np
-from collections import defaultdict, OrderedDict
+from collections import defaultdict, OrderedDict, Counter
 try:
     from backpack import backpack, extend
     from backpack.extensions import BatchGrad
@@ -16,6 +16,7 @@ except:
 
 from domainbed import networks
 from domainbed import hsic as HSIC
+from domainbed.lib import soft_labels
 from domainbed.lib.misc import (
     random_pairs_of_minibatches, ParamDict, MovingAverage, l2_between_dicts
 )
@@ -69,6 +70,7 @@ class Algorithm(torch.nn.Module):
     def __init__(self, input_shape, num_classes, num_domains, hparams):
         super(Algorithm, self).__init__()
         self.hparams = hparams
+        self.counters = Counter()
 
     def update(self, minibatches, unlabeled=None):
         """
@@ -82,6 +84,40 @@ class Algorithm(torch.nn.Module):
 
     def predict(self, x):
         raise NotImplementedError
+
+    def count(self, name, n=1):
+        """Count n units of an algorithm-specific extra cost (network clones,
+        per-sample gradients...), reported per step by lib/profiler.py."""
+        self.counters[name] += n
+
+    def training_state_dict(self):
+        """
+        Everything needed to resume training: the parameters and buffers of
+        the algorithm and the state of every optimizer among its attributes
+        (also in lists).
+        """
+        optimizers = {}
+        for name, value in vars(self).items():
+            if isinstance(value, torch.optim.Optimizer):
+                optimizers[name] = value.state_dict()
+            elif isinstance(value, (list, tuple)):
+                for i, item in enumerate(value):
+                    if isinstance(item, torch.optim.Optimizer):
+                        optimizers['{}.{}'.format(name, i)] = item.state_dict()
+        return {
+            'model': torch.nn.Module.state_dict(self),
+            'optimizers': optimizers
+        }
+
+    def load_training_state_dict(self, state_dict):
+        torch.nn.Module.load_state_dict(self, state_dict['model'])
+        for key, optimizer_state in state_dict['optimizers'].items():
+            name, _, i = key.partition('.')
+            optimizer = getattr(self, name)
+            if i:
+                optimizer = optimizer[int(i)]
+            optimizer.load_state_dict(optimizer_state)
+
 class ERM(Algorithm):
     """
     Empirical Risk Minimization (ERM)
@@ -132,9 +168,17 @@ class LFME(Algorithm):
         self.classifier = [None] * self.expert_number
         self.network = [None] * self.expert_number
         self.optimizer = [None] * self.expert_number
+        # Two-phase mode: the experts' soft labels are read from a store
+        # written by scripts/soft_labels.py, and only the target is trained.
+        self.soft_label_store = None
+        if self.hparams.get('lfme_soft_labels'):
+            self.soft_label_store = soft_labels.SoftLabelStore(
+                self.hparams['lfme_soft_labels'])
         #device = 'cuda'  # or 'cpu'
-        device = torch.device("gpu"if torch.cuda.is_available() else "cpu")
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         for i in range(self.expert_number):
+            if self.soft_label_store is not None and i < self.expert_number - 1:
+                continue
             self.featurizer[i] = networks.Featurizer(input_shape, self.hparams).to(device)
             self.classifier[i] = networks.Classifier(self.featurizer[i].n_outputs,
                                                      num_classes, self.hparams['nonlinear_classifier']).to(device)
@@ -144,11 +188,83 @@ class LFME(Algorithm):
                 lr=self.hparams["lr"],
                 weight_decay=self.hparams['weight_decay']
             )
+        if self.hparams.get('lfme_fused', False) and self.soft_label_store is None:
+            self._init_fused_experts()
 
-    def update(self, minibatches, unlabeled=None):
+    def _init_fused_experts(self):
+        """
+        Stack the parameters of the experts so that they all run in a single
+        vmapped functional call, and train them together with the target
+        network with one multi-tensor Adam step. Adam is elementwise, so this
+        is equivalent to stepping the per-expert optimizers separately.
+        """
+        experts = self.network[:-1]
+        self.expert_params, self.expert_buffers = \
+            torch.func.stack_module_state(experts)
+        # Make the expert modules views of the stacked storage so that they
+        # keep reflecting the fused parameters.
+        for i, expert in enumerate(experts):
+            for name, p in expert.named_parameters():
+                p.data = self.expert_params[name].data[i]
+            for name, b in expert.named_buffers():
+                b.data = self.expert_buffers[name].data[i]
+        # Kept in a list, like the experts, so that algorithm.to() does not
+        # try to move the meta tensors.
+        self.expert_skeleton = [copy.deepcopy(experts[0]).to('meta')]
+        self.fused_optimizer = torch.optim.Adam(
+            [{'params': list(self.expert_params.values())},
+             {'params': self.network[-1].parameters()}],
+            lr=self.hparams["lr"],
+            weight_decay=self.hparams['weight_decay'],
+            foreach=True
+        )
+
+    def fused_expert_forward(self, xs):
+        """Logits of expert i on xs[i], for all experts at once."""
+        def expert_forward(params, buffers, x):
+            return torch.func.functional_call(self.expert_skeleton[0],
+                                              (params, buffers), (x,))
+        return torch.func.vmap(expert_forward, randomness='different')(
+            self.expert_params, self.expert_buffers, xs)
+
+    def update_fused(self, minibatches):
         all_x = torch.cat([x for x, y in minibatches])
         all_y = torch.cat([y for x, y in minibatches])
-        expert = torch.zeros(all_y.shape[0], self.num_classes).to('cuda')
+        xs = torch.stack([x for x, y in minibatches])
+        ys = torch.stack([y for x, y in minibatches])
+        result_expert = self.fused_expert_forward(xs)
+        loss_expert = F.cross_entropy(result_expert.flatten(0, 1), ys.flatten(),
+                                      reduction='none').view(ys.shape).mean(1).sum()
+        expert = F.softmax(result_expert, dim=2).flatten(0, 1)
+
+        result_target = self.network[-1](all_x)
+        loss_cla = F.cross_entropy(result_target, all_y)
+        loss_guid = self.MSEloss(result_target, expert.detach())
+        loss = loss_cla + loss_guid * self.hparams['lfe_reg']
+        self.fused_optimizer.zero_grad()
+        (loss + loss_expert).backward()
+        self.fused_optimizer.step()
+        return {'loss': loss.item()}
+
+    def update_experts(self, minibatches):
+        """
+        Train each expert for one step on the minibatch of its own domain, and
+        return the experts' softmax outputs for the concatenated minibatches.
+        """
+        if self.hparams.get('lfme_fused', False):
+            xs = torch.stack([x for x, y in minibatches])
+            ys = torch.stack([y for x, y in minibatches])
+            result_expert = self.fused_expert_forward(xs)
+            loss = F.cross_entropy(result_expert.flatten(0, 1), ys.flatten(),
+                                   reduction='none').view(ys.shape).mean(1).sum()
+            self.fused_optimizer.zero_grad()
+            loss.backward()
+            self.fused_optimizer.step()
+            return F.softmax(result_expert, dim=2).flatten(0, 1).detach()
+
+        all_y = torch.cat([y for x, y in minibatches])
+        expert = torch.zeros(all_y.shape[0], self.num_classes,
+                             device=all_y.device)
         for i in range(self.expert_number - 1):
             mmbatch = minibatches[i]
             part_x, part_y = mmbatch[0], mmbatch[1]
@@ -159,7 +275,11 @@ class LFME(Algorithm):
             self.optimizer[i].step()
             index, end = (i) * part_y.shape[0], (i + 1) * part_y.shape[0]
             expert[index:end, :] = F.softmax(result_expert, dim=1)
+        return expert
 
+    def update_target(self, minibatches, expert):
+        all_x = torch.cat([mb[0] for mb in minibatches])
+        all_y = torch.cat([mb[1] for mb in minibatches])
         result_target = self.network[-1](all_x)
         loss_cla = F.cross_entropy(result_target, all_y)
         loss_guid = self.MSEloss(result_target, expert.detach())
@@ -169,15 +289,50 @@ class LFME(Algorithm):
         self.optimizer[-1].step()
         return {'loss': loss.item()}
 
+    def update(self, minibatches, unlabeled=None):
+        if self.soft_label_store is not None:
+            # minibatches are (x, y, index) from soft_labels.IndexedSplit
+            expert = torch.cat([self.soft_label_store.lookup(i, index)
+                                for i, (x, y, index) in enumerate(minibatches)])
+            return self.update_target(minibatches,
+                                      expert.to(minibatches[0][1].device))
+        if self.hparams.get('lfme_fused', False):
+            return self.update_fused(minibatches)
+        return self.update_target(minibatches, self.update_experts(minibatches))
+
     def predict(self, x):
         return self.network[-1](x)
 
+    def expert_state_dicts(self):
+        return [network.state_dict() for network in self.network[:-1]
+                if network is not None]
+
+    def load_expert_state_dicts(self, state_dicts):
+        for network, state_dict in zip(self.network[:-1], state_dicts):
+            network.load_state_dict(state_dict)
+
     def state_dict(self):
         return self.network[-1].state_dict()
 
     def load_state_dict(self, state_dict):
         self.network[-1].load_state_dict(state_dict)
 
+    def training_state_dict(self):
+        # The networks are kept in a list, out of the module's state_dict. In
+        # fused mode, the experts' parameters are views of the stacked ones.
+        state_dict = super(LFME, self).training_state_dict()
+        state_dict['networks'] = [network.state_dict()
+                                  if network is not None else None
+                                  for network in self.network]
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(LFME, self).load_training_state_dict(state_dict)
+        for network, network_state in zip(self.network,
+                                          state_dict['networks']):
+            if network is not None:
+                network.load_state_dict(network_state)
+
 
 class ERMPlus(ERM):
     " A Free Lunch for DG, introduced in LFME "
@@ -496,6 +651,7 @@ class Fish(Algorithm):
         self.optimizer_inner_state = None
 
     def create_clone(self, device):
+        self.count('inner_clones')
         self.network_inner = networks.WholeFish(self.input_shape, self.num_classes, self.hparams,
                                             weights=self.network.state_dict()).to(device)
         self.optimizer_inner = torch.optim.Adam(
@@ -534,6 +690,21 @@ class Fish(Algorithm):
     def predict(self, x):
         return self.network(x)
 
+    def training_state_dict(self):
+        # network_inner and optimizer_inner are rebuilt by create_clone() at
+        # every step; only the inner optimizer's state carries over
+        state_dict = super(Fish, self).training_state_dict()
+        state_dict['model'] = OrderedDict(
+            (k, v) for k, v in state_dict['model'].items()
+            if not k.startswith('network_inner.'))
+        state_dict['optimizers'].pop('optimizer_inner', None)
+        state_dict['optimizer_inner_state'] = self.optimizer_inner_state
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(Fish, self).load_training_state_dict(state_dict)
+        self.optimizer_inner_state = state_dict['optimizer_inner_state']
+
 
 class ARM(ERM):
     """ Adaptive Risk Minimization (ARM) """
@@ -831,6 +1002,11 @@ class GroupDRO(ERM):
 
         return {'loss': loss.item()}
 
+    def load_training_state_dict(self, state_dict):
+        # q is allocated lazily by the first update(), resize it to match
+        self.q = torch.empty_like(state_dict['model']['q'], device=self.q.device)
+        super(GroupDRO, self).load_training_state_dict(state_dict)
+
 
 class MLDG(ERM):
     """
@@ -870,6 +1046,7 @@ class MLDG(ERM):
         for (xi, yi), (xj, yj) in random_pairs_of_minibatches(minibatches):
             # fine tune clone-network on task "i"
             inner_net = copy.deepcopy(self.network)
+            self.count('inner_clones')
 
             inner_opt = torch.optim.Adam(
                 inner_net.parameters(),
@@ -1325,6 +1502,7 @@ class ANDMask(ERM):
             mean_loss += env_loss.item() / len(minibatches)
 
             env_grads = autograd.grad(env_loss, self.network.parameters())
+            self.count('env_grads')
             for grads, env_grad in zip(param_gradients, env_grads):
                 grads.append(env_grad)
 
@@ -1369,6 +1547,7 @@ class IGA(ERM):
 
             env_grad = autograd.grad(env_loss, self.network.parameters(),
                                         create_graph=True)
+            self.count('env_grads')
 
             grads.append(env_grad)
 
@@ -1512,6 +1691,7 @@ class SANDMask(ERM):
             env_loss = F.cross_entropy(logits, y)
             mean_loss += env_loss.item() / len(minibatches)
             env_grads = autograd.grad(env_loss, self.network.parameters(), retain_graph=True)
+            self.count('env_grads')
             for grads, env_grad in zip(param_gradients, env_grads):
                 grads.append(env_grad)
 
@@ -1617,6 +1797,7 @@ class Fishr(Algorithm):
             loss.backward(
                 inputs=list(self.classifier.parameters()), retain_graph=True, create_graph=True
             )
+        self.count('per_sample_grads', len(y))
 
         # compute individual grads for all samples across all domains simultaneously
         dict_grads = OrderedDict(
@@ -1674,6 +1855,19 @@ class Fishr(Algorithm):
     def predict(self, x):
         return self.network(x)
 
+    def training_state_dict(self):
+        state_dict = super(Fishr, self).training_state_dict()
+        state_dict['ema_per_domain'] = [
+            ema.state_dict() for ema in self.ema_per_domain]
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(Fishr, self).load_training_state_dict(state_dict)
+        device = self.update_count.device
+        for ema, ema_state in zip(self.ema_per_domain,
+                                  state_dict['ema_per_domain']):
+            ema.load_state_dict(ema_state, device)
+
 class TRM(Algorithm):
     """
     Learning Representations that Support Robust Transfer of Predictors
@@ -1774,6 +1968,7 @@ class TRM(Algorithm):
                 loss_erm.backward()
                 for opt in self.olist:
                     opt.step()
+                self.count('inner_steps')
 
             # collect (feature, y)
             feature_split = list()
@@ -1842,6 +2037,21 @@ class TRM(Algorithm):
     def eval(self):
         self.featurizer.eval()
 
+    def training_state_dict(self):
+        # the per-domain classifiers and alpha are not registered submodules
+        # or buffers
+        state_dict = super(TRM, self).training_state_dict()
+        state_dict['clist'] = [c.state_dict() for c in self.clist]
+        state_dict['alpha'] = self.alpha
+        return state_dict
+
+    def load_training_state_dict(self, state_dict):
+        super(TRM, self).load_training_state_dict(state_dict)
+        for classifier, classifier_state in zip(self.clist,
+                                                state_dict['clist']):
+            classifier.load_state_dict(classifier_state)
+        self.alpha.copy_(state_dict['alpha'])
+
 class IB_ERM(ERM):
     """Information Bottleneck based ERM on feature with conditionning"""
 
@@ -6,8 +6,17 @@ launcher to add support for your cluster. We've provided an example launcher
 which runs all commands serially on the local machine.
 """
 
+import gc
+import json
+import multiprocessing
+import os
+import queue
+import shlex
 import subprocess
+import sys
+import threading
 import time
+import traceback
 import torch
 
 def local_launcher(commands):
@@ -48,10 +57,243 @@ def multi_gpu_launcher(commands):
         if p is not None:
             p.wait()
 
+# Approximate number of images, used to start the largest datasets first
+DATASET_SIZES = {
+    'DomainNet': 586575,
+    'WILDSFMoW': 523846,
+    'WILDSCamelyon': 455954,
+    'ColoredMNIST': 70000,
+    'RotatedMNIST': 70000,
+    'SVIRO': 56000,
+    'TerraIncognita': 24788,
+    'OfficeHome': 15588,
+    'VLCS': 10729,
+    'PACS': 9991,
+}
+
+SMALL_IMAGE_DATASETS = ['ColoredMNIST', 'RotatedMNIST', 'Debug28']
+
+def _command_arg(cmd, name):
+    """Value of --name in a train.py command, or None."""
+    tokens = shlex.split(cmd)
+    for i, token in enumerate(tokens[:-1]):
+        if token == '--' + name:
+            return tokens[i + 1]
+    return None
+
+def _command_args(cmd, name):
+    """Values of --name in a train.py command (all the tokens up to the next
+    flag, e.g. ('0', '1') for --test_envs 0 1), or () if it has none."""
+    tokens = shlex.split(cmd)
+    if '--' + name not in tokens:
+        return ()
+    values = []
+    for token in tokens[tokens.index('--' + name) + 1:]:
+        if token.startswith('--'):
+            break
+        values.append(token)
+    return tuple(values)
+
+def _available_memory_gb():
+    try:
+        with open('/proc/meminfo') as f:
+            for line in f:
+                if line.startswith('MemAvailable:'):
+                    return int(line.split()[1]) / (1024. * 1024.)
+    except OSError:
+        pass
+    return float('inf')
+
+def _write_status(path, status):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f, indent=2)
+    os.replace(tmp_path, path)
+
+def cpu_pool_launcher(commands):
+    """
+    Launch commands on the local machine as a pool of concurrent CPU jobs.
+
+    Each job gets DOMAINBED_THREADS_PER_JOB intra-op threads (OMP/MKL, and
+    so torch), and as many jobs run at once as fit in the available cores
+    and memory (DOMAINBED_JOB_MEM_GB per job, by default 2 for small-image
+    datasets and 6 otherwise). DOMAINBED_MAX_JOBS caps the pool size. Jobs on
+    the largest datasets start first. Failed jobs are retried up to
+    DOMAINBED_RETRIES times, and the state of the pool is kept up to date in
+    DOMAINBED_LAUNCHER_STATUS (default: launcher_status.json).
+    """
+    n_cores = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') \
+        else os.cpu_count()
+    threads = int(os.environ.get('DOMAINBED_THREADS_PER_JOB',
+        max(1, min(4, n_cores // 4))))
+    retries = int(os.environ.get('DOMAINBED_RETRIES', 1))
+    status_path = os.environ.get('DOMAINBED_LAUNCHER_STATUS',
+        'launcher_status.json')
+    memory_gb = _available_memory_gb()
+    max_jobs = max(1, n_cores // threads)
+    if 'DOMAINBED_MAX_JOBS' in os.environ:
+        max_jobs = min(max_jobs, int(os.environ['DOMAINBED_MAX_JOBS']))
+
+    def job_memory_gb(cmd):
+        if 'DOMAINBED_JOB_MEM_GB' in os.environ:
+            return float(os.environ['DOMAINBED_JOB_MEM_GB'])
+        return 2. if _command_arg(cmd, 'dataset') in SMALL_IMAGE_DATASETS \
+            else 6.
+
+    pending = sorted(commands, key=lambda cmd: -DATASET_SIZES.get(
+        _command_arg(cmd, 'dataset'), 0))
+    attempts = {}
+    running = {}
+    finished = queue.Queue()
+    n_done = 0
+    failed = []
+    env = dict(os.environ, OMP_NUM_THREADS=str(threads),
+        MKL_NUM_THREADS=str(threads))
+    print(f'cpu_pool_launcher: {len(pending)} jobs, up to {max_jobs} at a '
+        f'time with {threads} threads each')
+
+    def update_status():
+        _write_status(status_path, {
+            'updated': time.strftime('%Y-%m-%d %H:%M:%S'),
+            'max_jobs': max_jobs,
+            'threads_per_job': threads,
+            'pending': len(pending),
+            'running': [{'command': cmd, 'pid': proc.pid,
+                'attempt': attempts[cmd], 'started': started}
+                for proc, (cmd, started) in running.items()],
+            'done': n_done,
+            'failed': failed,
+        })
+
+    def wait_for(proc):
+        proc.wait()
+        finished.put(proc)
+
+    while pending or running:
+        used_memory = sum(job_memory_gb(cmd) for cmd, _ in running.values())
+        while pending and len(running) < max_jobs and (not running or
+                used_memory + job_memory_gb(pending[0]) <= memory_gb):
+            cmd = pending.pop(0)
+            attempts[cmd] = attempts.get(cmd, 0) + 1
+            proc = subprocess.Popen(cmd, shell=True, env=env)
+            running[proc] = (cmd, time.strftime('%Y-%m-%d %H:%M:%S'))
+            threading.Thread(target=wait_for, args=(proc,), daemon=True).start()
+            used_memory += job_memory_gb(cmd)
+        update_status()
+
+        proc = finished.get()
+        cmd, _ = running.pop(proc)
+        if proc.returncode == 0:
+            n_done += 1
+        elif attempts[cmd] <= retries:
+            print(f'cpu_pool_launcher: retrying (exit code {proc.returncode}):'
+                f' {cmd}')
+            pending.insert(0, cmd)
+        else:
+            failed.append({'command': cmd, 'returncode': proc.returncode,
+                'attempts': attempts[cmd]})
+    update_status()
+    print(f'cpu_pool_launcher: {n_done} jobs done, {len(failed)} failed')
+
+def _in_process_worker(worker_i, n_gpus, threads, tasks, results):
+    """Runs train.py commands from `tasks` until it gets None, keeping the
+    most recently used dataset in memory between commands."""
+    if n_gpus > 0:
+        os.environ['CUDA_VISIBLE_DEVICES'] = str(worker_i % n_gpus)
+    if threads is not None:
+        torch.set_num_threads(threads)
+    from domainbed.scripts import train
+    parser = train.get_parser()
+    dataset_cache = {}
+    while True:
+        cmd = tasks.get()
+        if cmd is None:
+            break
+        tokens = shlex.split(cmd)
+        argv = tokens[tokens.index('domainbed.scripts.train') + 1:]
+        stdout, stderr = sys.stdout, sys.stderr
+        try:
+            train.main(parser.parse_args(argv), dataset_cache)
+            ok = True
+        except BaseException:
+            # train.main's Tee is still in place, so this also goes to the
+            # job's err.txt
+            traceback.print_exc()
+            ok = False
+        finally:
+            for stream in (sys.stdout, sys.stderr):
+                if stream not in (stdout, stderr) and hasattr(stream, 'file'):
+                    stream.file.close()
+            sys.stdout, sys.stderr = stdout, stderr
+        while len(dataset_cache) > 1:
+            dataset_cache.pop(next(iter(dataset_cache)))
+        # Shut down the DataLoader workers of the finished job
+        gc.collect()
+        results.put((cmd, ok))
+
+def in_process_launcher(commands):
+    """
+    Run train.py commands in DOMAINBED_MAX_JOBS (default: one per GPU, or 1)
+    long-lived worker processes instead of a new interpreter per command.
+    Each worker imports torch once and runs its commands back to back through
+    train.main, reusing the loaded dataset while consecutive commands share it
+    and the pretrained ResNet weights (networks.pretrained_resnet18) for all
+    of them. Commands are sorted by dataset and test environments so that
+    they do. Outputs (results.jsonl, done, ...) are the same as with the other
+    launchers. DOMAINBED_THREADS_PER_JOB sets torch's threads per worker.
+    """
+    n_gpus = torch.cuda.device_count()
+    n_workers = int(os.environ.get('DOMAINBED_MAX_JOBS', max(1, n_gpus)))
+    threads = os.environ.get('DOMAINBED_THREADS_PER_JOB')
+    threads = int(threads) if threads is not None else None
+
+    def sort_key(cmd):
+        dataset = _command_arg(cmd, 'dataset') or ''
+        return (-DATASET_SIZES.get(dataset, 0), dataset,
+            _command_args(cmd, 'test_envs'))
+
+    # fork, so that the DataLoader workers of the jobs are forked as well.
+    # torch.cuda.device_count() does not initialize CUDA in this process.
+    context = multiprocessing.get_context('fork')
+    tasks = context.Queue()
+    results = context.Queue()
+    for cmd in sorted(commands, key=sort_key):
+        tasks.put(cmd)
+    workers = []
+    for worker_i in range(n_workers):
+        tasks.put(None)
+        worker = context.Process(target=_in_process_worker,
+            args=(worker_i, n_gpus, threads, tasks, results))
+        worker.start()
+        workers.append(worker)
+    print(f'in_process_launcher: {len(commands)} jobs in {n_workers} '
+        'worker processes')
+
+    failed = []
+    for _ in range(len(commands)):
+        while True:
+            try:
+                cmd, ok = results.get(timeout=10)
+                break
+            except queue.Empty:
+                if not any(worker.is_alive() for worker in workers):
+                    raise RuntimeError('in_process_launcher: all workers '
+                        'exited before finishing the jobs')
+        if not ok:
+            failed.append(cmd)
+    for worker in workers:
+        worker.join()
+    print(f'in_process_launcher: {len(commands) - len(failed)} jobs done, '
+        f'{len(failed)} failed')
+    for cmd in failed:
+        print(f'\tfailed: {cmd}')
+
 REGISTRY = {
     'local': local_launcher,
     'dummy': dummy_launcher,
-    'multi_gpu': multi_gpu_launcher
+    'multi_gpu': multi_gpu_launcher,
+    'cpu_pool': cpu_pool_launcher,
+    'in_process': in_process_launcher
 }
 
 try:
@@ -1,13 +1,21 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
 import os
+import fcntl
+import hashlib
+import math
+import shutil
+import uuid
+import numpy as np
 import torch
 from PIL import Image, ImageFile
 from torchvision import transforms
 import torchvision.datasets.folder
 from torch.utils.data import TensorDataset, Subset
 from torchvision.datasets import MNIST, ImageFolder
-from torchvision.transforms.functional import rotate
+
+from domainbed.lib import shards
+from domainbed.lib.batch_augment import BatchAugment
 
 from wilds.datasets.camelyon17_dataset import Camelyon17Dataset
 from wilds.datasets.fmow_dataset import FMoWDataset
@@ -49,6 +57,8 @@ class MultipleDomainDataset:
     N_WORKERS = 8            # Default, subclasses may override
     ENVIRONMENTS = None      # Subclasses should override
     INPUT_SHAPE = None       # Subclasses should override
+    augmented_envs = ()      # Envs whose transform is random; set by subclasses
+    batch_augment = None     # BatchAugment to apply to the augmented envs
 
     def __getitem__(self, index):
         return self.datasets[index]
@@ -81,12 +91,33 @@ class Debug224(Debug):
 
 
 class MultipleEnvironmentMNIST(MultipleDomainDataset):
+    STORE_VERSION = 2        # Bump when the generated environments change
+    STORE_SEED = 0           # Seed the stored environments are generated from
+
     def __init__(self, root, environments, dataset_transform, input_shape,
-                 num_classes):
+                 num_classes, image_transform=None, store=False):
         super().__init__()
         if root is None:
             raise ValueError('Data directory not specified!')
 
+        if store:
+            self.datasets = self.load_store(root, environments,
+                image_transform)
+        else:
+            original_images, original_labels = self.shuffled_mnist(root)
+
+            self.datasets = []
+
+            for i in range(len(environments)):
+                images = original_images[i::len(environments)]
+                labels = original_labels[i::len(environments)]
+                self.datasets.append(dataset_transform(images, labels, environments[i]))
+
+        self.input_shape = input_shape
+        self.num_classes = num_classes
+
+    @staticmethod
+    def shuffled_mnist(root):
         original_dataset_tr = MNIST(root, train=True, download=True)
         original_dataset_te = MNIST(root, train=False, download=True)
 
@@ -98,18 +129,146 @@ class MultipleEnvironmentMNIST(MultipleDomainDataset):
 
         shuffle = torch.randperm(len(original_images))
 
-        original_images = original_images[shuffle]
-        original_labels = original_labels[shuffle]
-
-        self.datasets = []
+        return original_images[shuffle], original_labels[shuffle]
+
+    @staticmethod
+    def store_dir(root):
+        """Directory holding the generated environments of every
+        MultipleEnvironmentMNIST dataset."""
+        cache_root = os.environ.get('DOMAINBED_CACHE_DIR')
+        if cache_root is None:
+            return os.path.join(root, "MNIST_store")
+        return os.path.join(cache_root, "MNIST_store")
+
+    def store_key(self, root, environments):
+        """Hash of everything the generated environments depend on: the MNIST
+        files, the environments and STORE_SEED. None if MNIST is not
+        downloaded."""
+        raw_folder = os.path.join(root, "MNIST", "raw")
+        h = hashlib.md5("{}\0{}\0{}\0{}\n".format(type(self).__name__,
+            self.STORE_VERSION, self.STORE_SEED,
+            environments).encode("utf-8"))
+        for filename, _ in MNIST.resources:
+            path = os.path.join(raw_folder, os.path.splitext(filename)[0])
+            if not os.path.exists(path):
+                return None
+            st = os.stat(path)
+            h.update("{}\0{}\0{}\n".format(
+                path, st.st_size, st.st_mtime_ns).encode("utf-8"))
+        return h.hexdigest()
+
+    def load_store(self, root, environments, image_transform):
+        """
+        The environments as StoredTensorDatasets, generated once by
+        image_transform(images, labels, environment), which returns uint8
+        images and labels. Unlike the environments generated at every start,
+        which depend on the seed of the run, they are generated from
+        STORE_SEED, so that every job (e.g. of a sweep) shares one store; the
+        torch RNG is left untouched. Building a store removes the stores of
+        this dataset and root with an older STORE_VERSION.
+        """
+        key = self.store_key(root, environments)
+        if key is None:
+            # Download MNIST first, the key depends on its files
+            MNIST(root, train=True, download=True)
+            MNIST(root, train=False, download=True)
+            key = self.store_key(root, environments)
+        store_dir = self.store_dir(root)
+        # Stores of different roots may share store_dir ($DOMAINBED_CACHE_DIR)
+        prefix = "{}_{}_v".format(type(self).__name__, hashlib.md5(
+            os.path.abspath(root).encode("utf-8")).hexdigest()[:12])
+        name = "{}{}_{}".format(prefix, self.STORE_VERSION, key)
+        path = os.path.join(store_dir, name)
+        if not os.path.exists(path):
+            os.makedirs(store_dir, exist_ok=True)
+            with open(path + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not os.path.exists(path):
+                    with torch.random.fork_rng(devices=[]):
+                        torch.manual_seed(self.STORE_SEED)
+                        build_mnist_store(path, self.shuffled_mnist(root),
+                            environments, image_transform)
+            remove_old_stores(store_dir, prefix, self.STORE_VERSION)
+        return [StoredTensorDataset(
+                os.path.join(path, "env{}_images.npy".format(i)),
+                os.path.join(path, "env{}_labels.npy".format(i)))
+            for i in range(len(environments))]
+
+
+def build_mnist_store(path, shuffled_mnist, environments, image_transform):
+    """Generate the environments into the directory `path`, which is written
+    under a temporary name and renamed into place, so that concurrent jobs
+    never see a partially written store."""
+    original_images, original_labels = shuffled_mnist
+    tmp_path = "{}.tmp{}".format(path, uuid.uuid4().hex)
+    os.makedirs(tmp_path)
+    for i in range(len(environments)):
+        images, labels = image_transform(
+            original_images[i::len(environments)],
+            original_labels[i::len(environments)], environments[i])
+        np.save(os.path.join(tmp_path, "env{}_images.npy".format(i)),
+            images.numpy())
+        np.save(os.path.join(tmp_path, "env{}_labels.npy".format(i)),
+            labels.numpy().astype(np.uint8))
+    try:
+        os.rename(tmp_path, path)
+    except OSError:
+        # Another job stored the same environments first
+        shutil.rmtree(tmp_path)
+
+
+def remove_old_stores(store_dir, prefix, version):
+    """Remove the stores (and their lock files) in store_dir named
+    `prefix`<v>_<key> with a version v older than `version`. A store is only
+    removed once the code that reads it has changed."""
+    for entry in os.listdir(store_dir):
+        if not entry.startswith(prefix) or ".tmp" in entry:
+            continue
+        entry_version = entry[len(prefix):].split("_", 1)[0]
+        if not entry_version.isdigit() or int(entry_version) >= version:
+            continue
+        entry_path = os.path.join(store_dir, entry)
+        if os.path.isdir(entry_path):
+            shutil.rmtree(entry_path, ignore_errors=True)
+        else:
+            try:
+                os.remove(entry_path)
+            except OSError:
+                pass
+
+
+class StoredTensorDataset(torch.utils.data.Dataset):
+    """
+    TensorDataset of (float image in [0, 1], label) read from a uint8
+    memory-mapped .npy array of images and a .npy array of labels. The
+    pages of the images are shared by the DataLoader workers and by every
+    job reading the same file.
+    """
+    def __init__(self, images_path, labels_path):
+        super().__init__()
+        self.images_path = images_path
+        self.targets = torch.from_numpy(np.load(labels_path).astype(np.int64))
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so that each DataLoader worker maps the file itself
+        # instead of receiving a pickled copy of the array.
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
 
-        for i in range(len(environments)):
-            images = original_images[i::len(environments)]
-            labels = original_labels[i::len(environments)]
-            self.datasets.append(dataset_transform(images, labels, environments[i]))
+    def __getitem__(self, index):
+        x = torch.from_numpy(np.array(self.images[index]))
+        return x.float().div_(255.0), self.targets[index]
 
-        self.input_shape = input_shape
-        self.num_classes = num_classes
+    def __len__(self):
+        return len(self.targets)
 
 
 class ColoredMNIST(MultipleEnvironmentMNIST):
@@ -117,12 +276,19 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
 
     def __init__(self, root, test_envs, hparams):
         super(ColoredMNIST, self).__init__(root, [0.1, 0.2, 0.9],
-                                         self.color_dataset, (2, 28, 28,), 2)
+                                         self.color_dataset, (2, 28, 28,), 2,
+                                         self.color_images,
+                                         hparams.get('mnist_store', False))
 
         self.input_shape = (2, 28, 28,)
         self.num_classes = 2
 
     def color_dataset(self, images, labels, environment):
+        images, labels = self.color_images(images, labels, environment)
+        x = images.float().div_(255.0)
+        return TensorDataset(x, labels)
+
+    def color_images(self, images, labels, environment):
         # # Subsample 2x for computational convenience
         # images = images.reshape((-1, 28, 28))[:, ::2, ::2]
         # Assign a binary label based on the digit
@@ -140,10 +306,7 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
         images[torch.tensor(range(len(images))), (
             1 - colors).long(), :, :] *= 0
 
-        x = images.float().div_(255.0)
-        y = labels.view(-1).long()
-
-        return TensorDataset(x, y)
+        return images, labels.view(-1).long()
 
     def torch_bernoulli_(self, p, size):
         return (torch.rand(size) < p).float()
@@ -152,30 +315,199 @@ class ColoredMNIST(MultipleEnvironmentMNIST):
         return (a - b).abs()
 
 
+def rotate_images(images, angle):
+    """
+    Rotate the uint8 (N, H, W) images by angle degrees around their center,
+    with bilinear interpolation and zero fill. The sampling grid is computed
+    once from the affine matrix of PIL's Image.rotate and applied to all the
+    images, reproducing PIL's output exactly (including its truncation to
+    uint8); F.affine_grid / F.grid_sample differ from it by one gray level
+    on some pixels.
+    """
+    n, h, w = images.shape
+    radians = -math.radians(angle)
+    cos, sin = round(math.cos(radians), 15), round(math.sin(radians), 15)
+    cx, cy = w / 2., h / 2.
+    # Input coordinates of the output pixel centers, in PIL's order of
+    # operations
+    y, x = torch.meshgrid(torch.arange(h, dtype=torch.float64) + 0.5,
+        torch.arange(w, dtype=torch.float64) + 0.5, indexing='ij')
+    x_in = cos * x + sin * y + (cos * -cx + sin * -cy + cx)
+    y_in = -sin * x + cos * y + (-sin * -cx + cos * -cy + cy)
+    inside = (x_in >= 0) & (x_in < w) & (y_in >= 0) & (y_in < h)
+
+    x_in, y_in = x_in - 0.5, y_in - 0.5
+    x0, y0 = x_in.floor(), y_in.floor()
+    dx, dy = x_in - x0, y_in - y0
+    x0, y0 = x0.long(), y0.long()
+    # Neighbors outside the image are replaced by the nearest edge pixel
+    x_a, x_b = x0.clamp(0, w - 1), (x0 + 1).clamp(0, w - 1)
+    y_a, y_b = y0.clamp(0, h - 1), (y0 + 1).clamp(0, h - 1)
+
+    images = images.reshape(n, h * w)
+    def interpolate_row(rows):
+        left = images.index_select(1, (rows * w + x_a).view(-1)).double()
+        right = images.index_select(1, (rows * w + x_b).view(-1)).double()
+        return left + (right - left) * dx.view(-1)
+    top, bottom = interpolate_row(y_a), interpolate_row(y_b)
+    rotated = (top + (bottom - top) * dy.view(-1)) * inside.view(-1)
+    return rotated.floor_().to(torch.uint8).view(n, h, w)
+
+
 class RotatedMNIST(MultipleEnvironmentMNIST):
     ENVIRONMENTS = ['0', '15', '30', '45', '60', '75']
 
     def __init__(self, root, test_envs, hparams):
         super(RotatedMNIST, self).__init__(root, [0, 15, 30, 45, 60, 75],
-                                           self.rotate_dataset, (1, 28, 28,), 10)
+                                           self.rotate_dataset, (1, 28, 28,), 10,
+                                           self.rotate_images,
+                                           hparams.get('mnist_store', False))
 
     def rotate_dataset(self, images, labels, angle):
-        rotation = transforms.Compose([
-            transforms.ToPILImage(),
-            transforms.Lambda(lambda x: rotate(x, angle, fill=(0,),
-                interpolation=torchvision.transforms.InterpolationMode.BILINEAR)),
-            transforms.ToTensor()])
+        images, labels = self.rotate_images(images, labels, angle)
+        x = images.float().div_(255.0)
+        return TensorDataset(x, labels)
 
-        x = torch.zeros(len(images), 1, 28, 28)
-        for i in range(len(images)):
-            x[i] = rotation(images[i])
+    def rotate_images(self, images, labels, angle):
+        return rotate_images(images, angle)[:, None], labels.view(-1)
 
-        y = labels.view(-1)
 
-        return TensorDataset(x, y)
+class _ResizedImages(torch.utils.data.Dataset):
+    """Decodes image files and resizes them to a square uint8 HxWx3 tensor.
+    Used to fill a CachedImageFolder."""
+    def __init__(self, samples, resolution):
+        self.samples = samples
+        self.resize = transforms.Resize((resolution, resolution))
+
+    def __getitem__(self, index):
+        img = torchvision.datasets.folder.default_loader(self.samples[index][0])
+        return torch.from_numpy(np.array(self.resize(img), dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.samples)
+
+
+def image_folder_hash(samples, resolution):
+    """Hash of an ImageFolder's file list (path, size, mtime) and the cache
+    resolution; any added, removed or modified image changes it."""
+    h = hashlib.md5(str(resolution).encode("utf-8"))
+    for path, target in samples:
+        st = os.stat(path)
+        h.update("{}\0{}\0{}\0{}\n".format(
+            path, target, st.st_size, st.st_mtime_ns).encode("utf-8"))
+    return h.hexdigest()
+
+
+def remove_superseded_caches(cache_dir, stem, key):
+    """Remove the cache files (and lock files) in cache_dir of the folder
+    named by `stem` whose hash is not `key`, i.e. left by earlier contents of
+    the folder."""
+    for entry in os.listdir(cache_dir):
+        if (entry.startswith(stem) and not entry.startswith(stem + key) and
+                ".tmp" not in entry):
+            try:
+                os.remove(os.path.join(cache_dir, entry))
+            except OSError:
+                pass
+
+
+class CachedImageFolder(torch.utils.data.Dataset):
+    """
+    Drop-in replacement for ImageFolder that reads images from an on-disk
+    cache: every image of the folder is decoded once, resized to
+    resolution x resolution and stored in a uint8 memory-mapped .npy array
+    next to a label index. The cache is rebuilt whenever the hash of the
+    source folder changes, under a lock so that concurrent jobs build it once,
+    and the cache of the previous contents is removed. `transform` (including
+    random augmentations) is applied on top of the cached image, as for
+    ImageFolder.
+    """
+    def __init__(self, root, cache_dir, resolution=224, transform=None,
+                 num_workers=8):
+        super().__init__()
+        folder = ImageFolder(root)
+        self.root = root
+        self.transform = transform
+        self.classes = folder.classes
+        self.class_to_idx = folder.class_to_idx
+
+        key = image_folder_hash(folder.samples, resolution)
+        # Folders of different roots may share cache_dir ($DOMAINBED_CACHE_DIR)
+        stem = "{}_{}_".format(os.path.basename(os.path.normpath(root)),
+            hashlib.md5(os.path.abspath(root).encode("utf-8")).hexdigest()[:12])
+        prefix = os.path.join(cache_dir, stem + key)
+        self.images_path = prefix + ".images.npy"
+        labels_path = prefix + ".labels.npy"
+        if not (os.path.exists(self.images_path) and
+                os.path.exists(labels_path)):
+            os.makedirs(cache_dir, exist_ok=True)
+            # Of concurrent jobs, only the first builds the cache
+            with open(prefix + ".lock", "w") as lock:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+                if not (os.path.exists(self.images_path) and
+                        os.path.exists(labels_path)):
+                    build_image_cache(folder.samples, resolution,
+                        self.images_path, labels_path, num_workers)
+            remove_superseded_caches(cache_dir, stem, key)
+
+        self.targets = np.load(labels_path)
+        self._images = None
+
+    @property
+    def images(self):
+        # Opened lazily so that each DataLoader worker maps the file itself
+        # instead of receiving a pickled copy of the array.
+        if self._images is None:
+            self._images = np.load(self.images_path, mmap_mode="r")
+        return self._images
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_images"] = None
+        return state
+
+    def __getitem__(self, index):
+        x = Image.fromarray(np.array(self.images[index]))
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, int(self.targets[index])
+
+    def __len__(self):
+        return len(self.targets)
+
+
+def build_image_cache(samples, resolution, images_path, labels_path,
+                      num_workers=8):
+    """Decode and resize `samples` (ImageFolder (path, target) pairs) into the
+    memory-mapped array at images_path and their labels into labels_path.
+    Files are written under temporary names and renamed into place, so that
+    concurrent jobs never see a partially written cache. The global RNGs are
+    left untouched."""
+    os.makedirs(os.path.dirname(images_path), exist_ok=True)
+    tmp_suffix = ".tmp{}".format(uuid.uuid4().hex)
+    images = np.lib.format.open_memmap(images_path + tmp_suffix, mode="w+",
+        dtype=np.uint8, shape=(len(samples), resolution, resolution, 3))
+    # The DataLoader draws its base seed from this generator rather than the
+    # global torch RNG, so that the run that builds the cache trains like the
+    # runs that find it built
+    loader = torch.utils.data.DataLoader(_ResizedImages(samples, resolution),
+        batch_size=64, num_workers=num_workers, generator=torch.Generator())
+    offset = 0
+    for batch in loader:
+        images[offset:offset + len(batch)] = batch.numpy()
+        offset += len(batch)
+    images.flush()
+    del images
+
+    with open(labels_path + tmp_suffix, "wb") as f:
+        np.save(f, np.array([target for _, target in samples], dtype=np.int64))
+    os.replace(labels_path + tmp_suffix, labels_path)
+    os.replace(images_path + tmp_suffix, images_path)
 
 
 class MultipleEnvironmentImageFolder(MultipleDomainDataset):
+    CACHE_RESOLUTION = 224   # Side of the cached images, if image_cache is set
+
     def __init__(self, root, test_envs, augment, hparams):
         super().__init__()
         environments = [f.name for f in os.scandir(root) if f.is_dir()]
@@ -199,23 +531,50 @@ class MultipleEnvironmentImageFolder(MultipleDomainDataset):
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
+        if augment and hparams.get('batch_augment', False):
+            # Workers only decode; the minibatches of the augmented envs go
+            # through self.batch_augment on the training device.
+            augment_transform = transforms.Compose([
+                transforms.Resize((224, 224)),
+                transforms.PILToTensor(),
+            ])
+            self.batch_augment = BatchAugment()
+
         self.datasets = []
+        self.augmented_envs = []
         for i, environment in enumerate(environments):
 
             if augment and (i not in test_envs):
+                self.augmented_envs.append(i)
                 env_transform = augment_transform
             else:
                 env_transform = transform
 
             path = os.path.join(root, environment)
-            env_dataset = ImageFolder(path,
-                transform=env_transform)
+            if hparams.get('image_cache', False):
+                env_dataset = CachedImageFolder(path,
+                    cache_dir=self.cache_dir(root),
+                    resolution=self.CACHE_RESOLUTION,
+                    transform=env_transform,
+                    num_workers=self.N_WORKERS)
+            else:
+                env_dataset = ImageFolder(path,
+                    transform=env_transform)
 
             self.datasets.append(env_dataset)
 
         self.input_shape = (3, 224, 224,)
         self.num_classes = len(self.datasets[-1].classes)
 
+    @staticmethod
+    def cache_dir(root):
+        """Directory holding the CachedImageFolder files of a dataset. Kept
+        outside root, whose subdirectories are the environments."""
+        cache_root = os.environ.get('DOMAINBED_CACHE_DIR')
+        if cache_root is None:
+            return os.path.normpath(root) + "_cache"
+        return os.path.join(cache_root, os.path.basename(os.path.normpath(root)))
+
 class VLCS(MultipleEnvironmentImageFolder):
     CHECKPOINT_FREQ = 300
     ENVIRONMENTS = ["C", "L", "S", "V"]
@@ -290,9 +649,15 @@ class WILDSEnvironment:
     def __len__(self):
         return len(self.indices)
 
+    @property
+    def targets(self):
+        """Labels of the examples, read from y_array without the images."""
+        return self.dataset.y_array[self.indices]
+
 
 class WILDSDataset(MultipleDomainDataset):
     INPUT_SHAPE = (3, 224, 224)
+    SHARDS_VERSION = 1       # Bump when the format of the shards changes
     def __init__(self, dataset, metadata_name, test_envs, augment, hparams):
         super().__init__()
 
@@ -314,23 +679,71 @@ class WILDSDataset(MultipleDomainDataset):
                 mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
         ])
 
+        if augment and hparams.get('batch_augment', False):
+            # Workers only decode; the minibatches of the augmented envs go
+            # through self.batch_augment on the training device.
+            augment_transform = transforms.Compose([
+                transforms.Resize((224, 224)),
+                transforms.PILToTensor(),
+            ])
+            self.batch_augment = BatchAugment()
+
         self.datasets = []
+        self.augmented_envs = []
+
+        metadata_values = self.metadata_values(dataset, metadata_name)
+        if hparams.get('wilds_shards', False):
+            shards_path = self.pack_shards(dataset, metadata_name,
+                metadata_values)
 
-        for i, metadata_value in enumerate(
-                self.metadata_values(dataset, metadata_name)):
+        for i, metadata_value in enumerate(metadata_values):
             if augment and (i not in test_envs):
+                self.augmented_envs.append(i)
                 env_transform = augment_transform
             else:
                 env_transform = transform
 
-            env_dataset = WILDSEnvironment(
-                dataset, metadata_name, metadata_value, env_transform)
+            if hparams.get('wilds_shards', False):
+                env_dataset = shards.ShardedEnvironment(shards_path, i,
+                    env_transform)
+            else:
+                env_dataset = WILDSEnvironment(
+                    dataset, metadata_name, metadata_value, env_transform)
 
             self.datasets.append(env_dataset)
 
         self.input_shape = (3, 224, 224,)
         self.num_classes = dataset.n_classes
 
+    def pack_shards(self, wilds_dataset, metadata_name, metadata_values):
+        """Directory of the shards of the environments (lib/shards.py),
+        packed on first use. Its name holds a hash of the examples of every
+        environment, so that a change of the dataset packs new shards."""
+        environments = [WILDSEnvironment(wilds_dataset, metadata_name, value)
+            for value in metadata_values]
+        h = hashlib.md5("{}\0{}\0{}\n".format(self.SHARDS_VERSION,
+            wilds_dataset.version, metadata_name).encode("utf-8"))
+        for environment in environments:
+            h.update(environment.indices.numpy().tobytes() + b"\n")
+        path = os.path.join(self.shards_dir(wilds_dataset.data_dir),
+            "{}_{}".format(metadata_name, h.hexdigest()))
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shards.pack_environments(environments, path,
+                num_workers=self.N_WORKERS)
+        return path
+
+    @staticmethod
+    def shards_dir(data_dir):
+        """Directory holding the shards of a WILDS dataset, outside its
+        data_dir."""
+        cache_root = os.environ.get('DOMAINBED_CACHE_DIR')
+        name = os.path.basename(os.path.normpath(data_dir)) + "_shards"
+        if cache_root is None:
+            return os.path.join(os.path.dirname(os.path.normpath(data_dir)),
+                name)
+        return os.path.join(cache_root, name)
+
     def metadata_values(self, wilds_dataset, metadata_name):
         metadata_index = wilds_dataset.metadata_fields.index(metadata_name)
         metadata_vals = wilds_dataset.metadata_array[:, metadata_index]
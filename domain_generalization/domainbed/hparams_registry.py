@@ -31,6 +31,14 @@ def _hparams(algorithm, dataset, random_seed):
     _hparam('resnet18', True, lambda r: True)
     _hparam('resnet_dropout', 0., lambda r: r.choice([0., 0.1, 0.5]))
     _hparam('class_balanced', False, lambda r: False)
+    # Read image datasets from a pre-resized memory-mapped cache (datasets.py)
+    _hparam('image_cache', False, lambda r: False)
+    # Read ColoredMNIST / RotatedMNIST from a generated memory-mapped store
+    _hparam('mnist_store', False, lambda r: False)
+    # Read the WILDS datasets from packed tar shards (lib/shards.py)
+    _hparam('wilds_shards', False, lambda r: False)
+    # Augment whole minibatches on the training device (lib/batch_augment.py)
+    _hparam('batch_augment', False, lambda r: False)
     # TODO: nonlinear classifiers disabled
     _hparam('nonlinear_classifier', False,
             lambda r: bool(r.choice([False, False])))
@@ -61,6 +69,11 @@ def _hparams(algorithm, dataset, random_seed):
 
     elif algorithm == 'LFME':
         _hparam('lfe_reg', 1.0, lambda r: 10**r.uniform(-2, 1))
+        # Train the experts as one vmapped model (see LFME.update_fused)
+        _hparam('lfme_fused', False, lambda r: False)
+        # Directory written by scripts/soft_labels.py; if set, only the target
+        # network is trained, against the stored expert soft labels
+        _hparam('lfme_soft_labels', None, lambda r: None)
 
     elif algorithm == 'ITTA':
         if dataset == 'DomainNet':
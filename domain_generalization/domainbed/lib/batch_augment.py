@@ -0,0 +1,189 @@
+"""
+Batched tensor version of the image augmentation of datasets.py.
+
+With the `batch_augment` hparam, the DataLoader workers only decode and resize
+the images of augmented environments to uint8 tensors, and BatchAugment
+applies RandomResizedCrop, RandomHorizontalFlip, ColorJitter, RandomGrayscale
+and Normalize to whole minibatches, on the device the model trains on.
+"""
+
+import math
+
+import torch
+import torch.nn.functional as F
+
+from domainbed.lib import misc
+
+
+def _grayscale(x):
+    r, g, b = x.unbind(1)
+    return (0.299 * r + 0.587 * g + 0.114 * b).unsqueeze(1)
+
+
+def _rgb_to_hsv(x):
+    r, g, b = x.unbind(1)
+    maxc = x.max(1).values
+    minc = x.min(1).values
+    eqc = maxc == minc
+    cr = maxc - minc
+    ones = torch.ones_like(maxc)
+    s = cr / torch.where(eqc, ones, maxc)
+    cr_divisor = torch.where(eqc, ones, cr)
+    rc = (maxc - r) / cr_divisor
+    gc = (maxc - g) / cr_divisor
+    bc = (maxc - b) / cr_divisor
+    hr = (maxc == r) * (bc - gc)
+    hg = ((maxc == g) & (maxc != r)) * (2.0 + rc - bc)
+    hb = ((maxc != g) & (maxc != r)) * (4.0 + gc - rc)
+    h = torch.fmod((hr + hg + hb) / 6.0 + 1.0, 1.0)
+    return torch.stack((h, s, maxc), dim=1)
+
+
+def _hsv_to_rgb(x):
+    h, s, v = x.unbind(1)
+    n = torch.tensor([5., 3., 1.], device=x.device).view(1, 3, 1, 1)
+    k = torch.fmod(n + h.unsqueeze(1) * 6.0, 6.0)
+    c = torch.minimum(k, 4.0 - k).clamp(0.0, 1.0)
+    return v.unsqueeze(1) * (1.0 - s.unsqueeze(1) * c)
+
+
+def _blend(x, other, factor):
+    return (factor * x + (1 - factor) * other).clamp(0, 1)
+
+
+def _brightness(x, factor):
+    return (x * factor).clamp(0, 1)
+
+
+def _contrast(x, factor):
+    return _blend(x, _grayscale(x).mean((1, 2, 3), keepdim=True), factor)
+
+
+def _saturation(x, factor):
+    return _blend(x, _grayscale(x), factor)
+
+
+def _hue(x, factor):
+    hsv = _rgb_to_hsv(x)
+    h = torch.fmod(hsv[:, 0] + factor.view(-1, 1, 1) + 1.0, 1.0)
+    return _hsv_to_rgb(torch.stack((h, hsv[:, 1], hsv[:, 2]), dim=1))
+
+
+class BatchAugment:
+    """
+    RandomResizedCrop(size, scale), RandomHorizontalFlip(),
+    ColorJitter(jitter, jitter, jitter, jitter), RandomGrayscale() and
+    Normalize(mean, std) applied to a uint8 (N, 3, H, W) minibatch with
+    per-sample random parameters. The parameters are drawn on the CPU from a
+    generator seeded with `seed`, so the output only depends on the input
+    and the seed, whatever the device.
+    """
+    def __init__(self, size=224, scale=(0.7, 1.0), ratio=(3. / 4., 4. / 3.),
+            jitter=0.3, grayscale_p=0.1, mean=(0.485, 0.456, 0.406),
+            std=(0.229, 0.224, 0.225)):
+        self.size = size
+        self.scale = scale
+        self.ratio = ratio
+        self.jitter = jitter
+        self.grayscale_p = grayscale_p
+        self.mean = torch.tensor(mean).view(1, 3, 1, 1)
+        self.std = torch.tensor(std).view(1, 3, 1, 1)
+
+    def _crop_params(self, n, height, width, generator):
+        """Vectorized RandomResizedCrop.get_params: ten attempts per sample,
+        then a center crop clamped to the ratio range."""
+        area = height * width
+        log_ratio = (math.log(self.ratio[0]), math.log(self.ratio[1]))
+        target_area = area * torch.empty(n, 10).uniform_(*self.scale,
+            generator=generator)
+        aspect_ratio = torch.exp(torch.empty(n, 10).uniform_(*log_ratio,
+            generator=generator))
+        w = torch.sqrt(target_area * aspect_ratio).round()
+        h = torch.sqrt(target_area / aspect_ratio).round()
+        valid = (w > 0) & (h > 0) & (w <= width) & (h <= height)
+        first = valid.to(torch.int64).argmax(1, keepdim=True)
+        w = w.gather(1, first).squeeze(1)
+        h = h.gather(1, first).squeeze(1)
+
+        in_ratio = width / height
+        if in_ratio < min(self.ratio):
+            fallback_w, fallback_h = width, round(width / min(self.ratio))
+        elif in_ratio > max(self.ratio):
+            fallback_w, fallback_h = round(height * max(self.ratio)), height
+        else:
+            fallback_w, fallback_h = width, height
+        found = valid.any(1)
+        w = torch.where(found, w, torch.full_like(w, fallback_w))
+        h = torch.where(found, h, torch.full_like(h, fallback_h))
+        top = torch.where(found,
+            (torch.rand(n, generator=generator) * (height - h + 1)).floor(),
+            ((height - h) / 2).round())
+        left = torch.where(found,
+            (torch.rand(n, generator=generator) * (width - w + 1)).floor(),
+            ((width - w) / 2).round())
+        return top, left, h, w
+
+    def __call__(self, x, seed):
+        generator = torch.Generator().manual_seed(seed)
+        n, _, height, width = x.shape
+        device = x.device
+
+        # Crop and horizontal flip, as one affine resampling
+        top, left, h, w = self._crop_params(n, height, width, generator)
+        flip = torch.where(torch.rand(n, generator=generator) < 0.5, -1., 1.)
+        theta = torch.zeros(n, 2, 3)
+        theta[:, 0, 0] = w / width * flip
+        theta[:, 0, 2] = (left + w / 2) / width * 2 - 1
+        theta[:, 1, 1] = h / height
+        theta[:, 1, 2] = (top + h / 2) / height * 2 - 1
+        grid = F.affine_grid(theta.to(device), (n, 3, self.size, self.size),
+            align_corners=False)
+        x = F.grid_sample(x.float() / 255., grid, mode='bilinear',
+            padding_mode='border', align_corners=False)
+
+        # Color jitter, with the four adjustments in a random order per sample
+        j = self.jitter
+        factors = [
+            torch.empty(n).uniform_(1 - j, 1 + j, generator=generator),
+            torch.empty(n).uniform_(1 - j, 1 + j, generator=generator),
+            torch.empty(n).uniform_(1 - j, 1 + j, generator=generator),
+            torch.empty(n).uniform_(-j, j, generator=generator),
+        ]
+        adjustments = [_brightness, _contrast, _saturation, _hue]
+        order = torch.rand(n, 4, generator=generator).argsort(1)
+        for position in range(4):
+            for k, adjust in enumerate(adjustments):
+                index = (order[:, position] == k).nonzero().view(-1)
+                if len(index) == 0:
+                    continue
+                factor = factors[k][index].to(device)
+                if adjust is not _hue:
+                    factor = factor.view(-1, 1, 1, 1)
+                index = index.to(device)
+                x[index] = adjust(x[index], factor)
+
+        gray = torch.rand(n, generator=generator) < self.grayscale_p
+        if gray.any():
+            index = gray.nonzero().view(-1).to(device)
+            x[index] = _grayscale(x[index]).expand(-1, 3, -1, -1)
+
+        return (x - self.mean.to(device)) / self.std.to(device)
+
+
+class BatchAugmentLoader:
+    """Applies a BatchAugment to the inputs of another loader, with a
+    different seed for every batch."""
+    def __init__(self, loader, augment, seed):
+        self.loader = loader
+        self.augment = augment
+        self.seed = seed
+        self._batches = 0
+
+    def __iter__(self):
+        for x, *rest in self.loader:
+            self._batches += 1
+            yield (self.augment(x, misc.seed_hash(self.seed, self._batches)),
+                *rest)
+
+    def __len__(self):
+        return len(self.loader)
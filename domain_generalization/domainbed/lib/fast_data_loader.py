@@ -2,6 +2,9 @@
 
 import torch
 
+from domainbed.lib import misc
+from domainbed.lib import profiler
+
 class _InfiniteSampler(torch.utils.data.Sampler):
     """Wraps another Sampler to yield an infinite stream."""
     def __init__(self, sampler):
@@ -45,6 +48,204 @@ class InfiniteDataLoader:
     def __len__(self):
         raise ValueError
 
+class _MultiEnvDataset(torch.utils.data.Dataset):
+    """Indexed by (env, index, seed) triples. The random transforms of each
+    example draw from a torch RNG seeded with its seed, so that they do not
+    depend on which worker loads it or on where that worker's RNG stands."""
+    def __init__(self, datasets):
+        super().__init__()
+        self.datasets = datasets
+
+    def __getitem__(self, key):
+        env, index, seed = key
+        with torch.random.fork_rng(devices=[]):
+            torch.manual_seed(seed)
+            return self.datasets[env][index]
+
+    def __len__(self):
+        return sum(len(dataset) for dataset in self.datasets)
+
+class _MultiEnvBatchSampler(torch.utils.data.Sampler):
+    """Yields forever, for every step, batch_size (env, index, seed) triples
+    per environment, drawn with replacement (and weights, if given). The
+    batch of each step only depends on the seed and the step, so iteration
+    can start at any step."""
+    def __init__(self, env_sizes, weights, batch_size, seed):
+        self.env_sizes = env_sizes
+        self.weights = weights
+        self.batch_size = batch_size
+        self.seed = seed
+        self.start = 0
+
+    def sample(self, step):
+        """The (indices, seeds) of the minibatch of every env at `step`."""
+        generator = torch.Generator()
+        generator.manual_seed(misc.seed_hash(self.seed, step))
+        samples = []
+        for size, weights in zip(self.env_sizes, self.weights):
+            if weights is None:
+                indices = torch.randint(size, (self.batch_size,),
+                    generator=generator)
+            else:
+                indices = torch.multinomial(torch.as_tensor(weights),
+                    self.batch_size, replacement=True, generator=generator)
+            seeds = torch.randint(2**62, (self.batch_size,),
+                generator=generator)
+            samples.append((indices, seeds))
+        return samples
+
+    def __iter__(self):
+        step = self.start
+        while True:
+            batch = []
+            for env, (indices, seeds) in enumerate(self.sample(step)):
+                batch += [(env, index, seed) for index, seed in
+                    zip(indices.tolist(), seeds.tolist())]
+            yield batch
+            step += 1
+
+class _CollatePerEnv:
+    """Collates a _MultiEnvBatchSampler batch into one minibatch per env."""
+    def __init__(self, n_envs):
+        self.n_envs = n_envs
+
+    def __call__(self, batch):
+        size = len(batch) // self.n_envs
+        return [torch.utils.data.default_collate(batch[i * size:(i + 1) * size])
+            for i in range(self.n_envs)]
+
+class MultiEnvDataLoader:
+    """
+    Infinite loader that yields, at every step, a list with one minibatch per
+    dataset, like zip(*[InfiniteDataLoader(dataset) ...]), from a single pool
+    of num_workers workers. Minibatches are collated in the workers, pinned
+    and prefetched `prefetch` steps ahead. They are copied to `device` with
+    non_blocking transfers one step ahead (on a side stream on CUDA), so that
+    the copies overlap with the current step.
+
+    The minibatches are a function of the loader's seed (drawn from the torch
+    RNG) and the step. state_dict() holds both, and an iterator started after
+    load_state_dict() continues where the saved one was.
+    """
+    def __init__(self, datasets, weights, batch_size, num_workers,
+            device='cpu', prefetch=2):
+        super().__init__()
+        self.device = torch.device(device)
+
+        kwargs = {}
+        if num_workers > 0:
+            kwargs['prefetch_factor'] = max(1, -(-prefetch // num_workers))
+            kwargs['persistent_workers'] = True
+        self._batch_sampler = _MultiEnvBatchSampler(
+            [len(dataset) for dataset in datasets], weights, batch_size,
+            int(torch.empty((), dtype=torch.int64).random_()))
+        self._steps = 0
+        # Set to a lib.profiler.StepProfiler to time the device copies
+        self.profiler = profiler.NullProfiler()
+        self._loader = torch.utils.data.DataLoader(
+            _MultiEnvDataset(datasets),
+            num_workers=num_workers,
+            batch_sampler=self._batch_sampler,
+            collate_fn=_CollatePerEnv(len(datasets)),
+            pin_memory=self.device.type == 'cuda',
+            **kwargs)
+
+    def _to_device(self, minibatches):
+        with self.profiler.phase('h2d'):
+            return [tuple(t.to(self.device, non_blocking=True)
+                for t in minibatch) for minibatch in minibatches]
+
+    def state_dict(self):
+        return {'seed': self._batch_sampler.seed, 'step': self._steps}
+
+    def load_state_dict(self, state_dict):
+        self._batch_sampler.seed = state_dict['seed']
+        self._steps = state_dict['step']
+
+    def _batches(self):
+        """Iterator over the collated minibatches, from step self._steps."""
+        self._batch_sampler.start = self._steps
+        return iter(self._loader)
+
+    def __iter__(self):
+        # Not a generator: the DataLoader iterator draws its base seed from
+        # the torch RNG here, not at the first next(), so that the draw comes
+        # before train.py restores the RNGs of a resumed run
+        return self._iterate(self._batches())
+
+    def _iterate(self, batches):
+        if self.device.type != 'cuda':
+            for minibatches in batches:
+                self._steps += 1
+                yield self._to_device(minibatches)
+            return
+
+        stream = torch.cuda.Stream(self.device)
+        with torch.cuda.stream(stream):
+            staged = self._to_device(next(batches))
+        for minibatches in batches:
+            current_stream = torch.cuda.current_stream(self.device)
+            current_stream.wait_stream(stream)
+            for minibatch in staged:
+                for t in minibatch:
+                    t.record_stream(current_stream)
+            current = staged
+            with torch.cuda.stream(stream):
+                staged = self._to_device(minibatches)
+            self._steps += 1
+            yield current
+
+    def __len__(self):
+        raise ValueError
+
+class ResidentDataLoader:
+    """
+    MultiEnvDataLoader for datasets held as tensors on `device` (see
+    dataset_tensors): the minibatch of each env is gathered from its tensors
+    by an index tensor, with no DataLoader, worker processes or collation.
+    The indices (and class_balanced weights) are those of the
+    MultiEnvDataLoader with the same seed, so both loaders yield the same
+    minibatches, and either can resume from the state_dict() of the other.
+    Only for datasets whose transforms are deterministic.
+    """
+    def __init__(self, tensors, weights, batch_size, device='cpu'):
+        super().__init__()
+        self.device = torch.device(device)
+        self.tensors = [tuple(t.to(self.device) for t in env_tensors)
+            for env_tensors in tensors]
+        self._batch_sampler = _MultiEnvBatchSampler(
+            [len(env_tensors[0]) for env_tensors in tensors], weights,
+            batch_size, int(torch.empty((), dtype=torch.int64).random_()))
+        self._steps = 0
+        self.profiler = profiler.NullProfiler()
+
+    def state_dict(self):
+        return {'seed': self._batch_sampler.seed, 'step': self._steps}
+
+    def load_state_dict(self, state_dict):
+        self._batch_sampler.seed = state_dict['seed']
+        self._steps = state_dict['step']
+
+    def __iter__(self):
+        # The DataLoader iterator of a MultiEnvDataLoader draws its base seed
+        # from the torch RNG in iter(); draw it too, so that the RNG continues
+        # the same
+        torch.empty((), dtype=torch.int64).random_()
+        return self._iterate()
+
+    def _iterate(self):
+        while True:
+            samples = self._batch_sampler.sample(self._steps)
+            minibatches = []
+            for env_tensors, (indices, _) in zip(self.tensors, samples):
+                indices = indices.to(self.device)
+                minibatches.append(tuple(t[indices] for t in env_tensors))
+            self._steps += 1
+            yield minibatches
+
+    def __len__(self):
+        raise ValueError
+
 class FastDataLoader:
     """DataLoader wrapper with slightly improved speed by not respawning worker
     processes at every epoch."""
@@ -71,3 +272,50 @@ class FastDataLoader:
 
     def __len__(self):
         return self._length
+
+class TensorBatchLoader:
+    """Iterates over (x, y) tensors that are already in memory in fixed-size
+    batches, with no DataLoader or worker processes involved."""
+    def __init__(self, x, y, batch_size):
+        super().__init__()
+        self.x = x
+        self.y = y
+        self.batch_size = batch_size
+
+    def __iter__(self):
+        for i in range(0, len(self.x), self.batch_size):
+            yield self.x[i:i + self.batch_size], self.y[i:i + self.batch_size]
+
+    def __len__(self):
+        return (len(self.x) + self.batch_size - 1) // self.batch_size
+
+def materialize_dataset(dataset, batch_size, num_workers):
+    """Run every example of dataset through its transform once and return
+    the stacked tensors of each of its fields ((x, y) for most datasets),
+    placed in shared memory."""
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size,
+        num_workers=num_workers, shuffle=False)
+    batches = []
+    for batch in loader:
+        batches.append([torch.as_tensor(field) for field in batch])
+    return tuple(torch.cat(field).share_memory_() for field in zip(*batches))
+
+def dataset_nbytes(dataset):
+    """Size of dataset_tensors(dataset), estimated from its first example."""
+    if len(dataset) == 0:
+        return 0
+    example = [torch.as_tensor(field) for field in dataset[0]]
+    return len(dataset) * sum(t.element_size() * t.numel() for t in example)
+
+def dataset_tensors(dataset, batch_size, num_workers):
+    """The stacked tensors of each field of every example of dataset. Splits
+    (misc.split_dataset, possibly nested) of a TensorDataset are gathered
+    from its tensors directly; other datasets go through
+    materialize_dataset, without drawing from the torch RNG."""
+    underlying, keys = misc.split_keys(dataset)
+    if isinstance(underlying, torch.utils.data.TensorDataset):
+        if keys is None:
+            return underlying.tensors
+        return tuple(t[keys] for t in underlying.tensors)
+    with torch.random.fork_rng(devices=[]):
+        return materialize_dataset(dataset, batch_size, num_workers)
@@ -4,6 +4,7 @@
 Things that don't belong anywhere else
 """
 import time
+import functools
 import hashlib
 import json
 import os
@@ -16,7 +17,6 @@ import operator
 import numpy as np
 import torch
 import tqdm
-from collections import Counter
 
 
 def l2_between_dicts(dict_1, dict_2, normalize=False):
@@ -60,27 +60,28 @@ class MovingAverage:
         self._updates += 1
         return ema_dict_data
 
+    def state_dict(self):
+        return {'ema_data': dict(self.ema_data), 'updates': self._updates}
+
+    def load_state_dict(self, state_dict, device=None):
+        self.ema_data = {name: data.to(device)
+            for name, data in state_dict['ema_data'].items()}
+        self._updates = state_dict['updates']
+
 
 
 def make_weights_for_balanced_classes(dataset):
-    counts = Counter()
-    classes = []
-    for _, y in dataset:
-        y = int(y)
-        counts[y] += 1
-        classes.append(y)
+    classes = dataset_targets(dataset)
+    if classes is None:
+        classes = np.array([int(y) for _, y in dataset], dtype=np.int64)
 
+    _, inverse, counts = np.unique(classes, return_inverse=True,
+        return_counts=True)
     n_classes = len(counts)
 
-    weight_per_class = {}
-    for y in counts:
-        weight_per_class[y] = 1 / (counts[y] * n_classes)
-
-    weights = torch.zeros(len(dataset))
-    for i, y in enumerate(classes):
-        weights[i] = weight_per_class[int(y)]
+    weight_per_class = 1 / (counts * n_classes)
 
-    return weights
+    return torch.from_numpy(weight_per_class[inverse]).float()
 
 def pdb():
     sys.stdout = sys.__stdout__
@@ -123,6 +124,15 @@ class _SplitDataset(torch.utils.data.Dataset):
     def __len__(self):
         return len(self.keys)
 
+@functools.lru_cache(maxsize=64)
+def _permutation(n, seed):
+    """Shuffled range(n), shared by the splits of every dataset of n examples
+    with the same seed (e.g. the same trial_seed, environment and holdout
+    fraction in consecutive runs of a process)."""
+    keys = np.random.RandomState(seed).permutation(n)
+    keys.flags.writeable = False
+    return keys
+
 def split_dataset(dataset, n, seed=0):
     """
     Return a pair of datasets corresponding to a random split of the given
@@ -130,12 +140,44 @@ def split_dataset(dataset, n, seed=0):
     using the given random seed
     """
     assert(n <= len(dataset))
-    keys = list(range(len(dataset)))
-    np.random.RandomState(seed).shuffle(keys)
-    keys_1 = keys[:n]
-    keys_2 = keys[n:]
+    keys = _permutation(len(dataset), seed)
+    keys_1 = keys[:n].copy()
+    keys_2 = keys[n:].copy()
     return _SplitDataset(dataset, keys_1), _SplitDataset(dataset, keys_2)
 
+def split_keys(dataset):
+    """
+    Return the dataset underlying a (possibly nested) split of split_dataset
+    and the int64 tensor of the keys of the split in it, or (dataset, None)
+    if dataset is not a split.
+    """
+    keys = None
+    while isinstance(dataset, _SplitDataset):
+        split_keys = torch.as_tensor(dataset.keys, dtype=torch.int64)
+        keys = split_keys if keys is None else split_keys[keys]
+        dataset = dataset.underlying_dataset
+    return dataset, keys
+
+def dataset_targets(dataset):
+    """
+    Return the labels of the examples of dataset as an int64 array, read
+    from its label metadata without loading the examples: the `targets` of
+    ImageFolder, CachedImageFolder, WILDSEnvironment and the stored and
+    sharded datasets, or the label tensor of a TensorDataset, through
+    (possibly nested) splits of split_dataset. None if dataset has none.
+    """
+    dataset, keys = split_keys(dataset)
+    if isinstance(dataset, torch.utils.data.TensorDataset):
+        targets = dataset.tensors[1]
+    else:
+        targets = getattr(dataset, "targets", None)
+    if targets is None or len(targets) != len(dataset):
+        return None
+    targets = np.asarray(targets, dtype=np.int64)
+    if keys is not None:
+        targets = targets[keys.numpy()]
+    return targets
+
 def random_pairs_of_minibatches(minibatches):
     perm = torch.randperm(len(minibatches)).tolist()
     pairs = []
@@ -0,0 +1,233 @@
+"""
+Per-step profiling of the training loop of train.py (--profile).
+
+StepProfiler times named phases of every step. Phases nest, and each phase is
+reported without the time of the phases nested in it:
+
+    data_wait  waiting for the next minibatches of the training loader
+    h2d        issuing their copy to the device (inside data_wait; on CUDA
+               the copies themselves overlap with the previous step)
+    augment    the batch_augment pipeline
+    forward    algorithm.update() outside backward passes and optimizer steps
+    backward   every torch.autograd.backward / torch.autograd.grad call
+    optimizer  every Optimizer.step()
+    eval       the evaluation at a checkpoint
+
+backward and optimizer are timed through torch hooks installed for the
+duration of update(), so no algorithm needs to be changed. On CUDA, the
+update phases are timed with CUDA events, which are only read when the
+checkpoint is summarized, so profiling does not synchronize the device.
+
+At every checkpoint, summary() returns the mean time of each phase per step,
+the samples/sec of each training environment, the RSS and peak RSS of the
+process and the per-step mean of the algorithm's extra-cost counters
+(Algorithm.count). With a trace_path, every phase is also written as a
+Chrome trace event (chrome://tracing or https://ui.perfetto.dev).
+"""
+
+import collections
+import contextlib
+import json
+import os
+import resource
+import sys
+import time
+
+import torch
+from torch.optim.optimizer import (register_optimizer_step_post_hook,
+    register_optimizer_step_pre_hook)
+
+# Reported name of each phase, when it differs
+_PHASE_NAMES = {'update': 'forward'}
+
+
+class _Phase:
+    """One timed occurrence of a phase, as a context manager."""
+    __slots__ = ['profiler', 'name', 'parent', 'start', 'end', 'events']
+
+    def __init__(self, profiler, name, cuda):
+        self.profiler = profiler
+        self.name = name
+        self.parent = None
+        self.start = self.end = None
+        self.events = None
+        if cuda and profiler.cuda:
+            self.events = (torch.cuda.Event(enable_timing=True),
+                torch.cuda.Event(enable_timing=True))
+
+    def __enter__(self):
+        profiler = self.profiler
+        self.parent = profiler._current
+        profiler._current = self
+        profiler._phases.append(self)
+        if self.events is not None:
+            self.events[0].record()
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.end = time.perf_counter()
+        if self.events is not None:
+            self.events[1].record()
+        self.profiler._current = self.parent
+
+
+def rss_gb():
+    """Current resident set size of the process, or None if unknown."""
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+    except (OSError, IndexError, ValueError):
+        return None
+    return pages * os.sysconf('SC_PAGE_SIZE') / (1024. * 1024. * 1024.)
+
+
+def peak_rss_gb():
+    """Peak resident set size of the process."""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    if sys.platform != 'darwin':
+        peak *= 1024
+    return peak / (1024. * 1024. * 1024.)
+
+
+class NullProfiler:
+    """The StepProfiler interface, doing nothing (profiling off)."""
+    def phase(self, name, cuda=False):
+        return contextlib.nullcontext()
+
+    def update(self):
+        return contextlib.nullcontext()
+
+    def step(self, minibatches, step_time):
+        pass
+
+    def summary(self, algorithm, step):
+        return None
+
+
+class StepProfiler:
+    def __init__(self, device, env_names, trace_path=None):
+        self.cuda = torch.device(device).type == 'cuda'
+        self.env_names = env_names
+        self.trace_path = trace_path
+        # Wall clock time of perf_counter() == 0, for the trace timestamps
+        self._epoch = time.time() - time.perf_counter()
+        self._phases = []
+        self._current = None
+        self._reset()
+
+    def _reset(self):
+        self._phases.clear()
+        self._steps = 0
+        self._step_time = 0.
+        self._samples = [0] * len(self.env_names)
+
+    def phase(self, name, cuda=False):
+        """Time the enclosed code as phase `name`. With cuda=True on a CUDA
+        device, the device time of the work queued on the current stream is
+        reported instead of the host time."""
+        return _Phase(self, name, cuda)
+
+    def step(self, minibatches, step_time):
+        """Count the samples of one training step that took step_time."""
+        self._steps += 1
+        self._step_time += step_time
+        for i, (x, *_) in enumerate(minibatches):
+            self._samples[i] += len(x)
+
+    @contextlib.contextmanager
+    def update(self):
+        """The update phase, with backward passes and optimizer steps timed
+        as nested phases."""
+        backward, grad = torch.autograd.backward, torch.autograd.grad
+        optimizer_phases = []
+
+        def timed(name, fn):
+            def wrapper(*args, **kwargs):
+                with self.phase(name, cuda=True):
+                    return fn(*args, **kwargs)
+            return wrapper
+
+        def step_pre_hook(optimizer, args, kwargs):
+            optimizer_phases.append(self.phase('optimizer', cuda=True))
+            optimizer_phases[-1].__enter__()
+
+        def step_post_hook(optimizer, args, kwargs):
+            optimizer_phases.pop().__exit__(None, None, None)
+
+        with self.phase('update', cuda=True):
+            handles = [
+                register_optimizer_step_pre_hook(step_pre_hook),
+                register_optimizer_step_post_hook(step_post_hook)
+            ]
+            torch.autograd.backward = timed('backward', backward)
+            torch.autograd.grad = timed('backward', grad)
+            try:
+                yield
+            finally:
+                torch.autograd.backward, torch.autograd.grad = backward, grad
+                for handle in handles:
+                    handle.remove()
+                # An optimizer step that raised
+                while optimizer_phases:
+                    optimizer_phases.pop().__exit__(None, None, None)
+
+    def _duration(self, phase):
+        if phase.events is not None:
+            return phase.events[0].elapsed_time(phase.events[1]) / 1000.
+        return phase.end - phase.start
+
+    def _write_trace(self, durations, step):
+        pid = os.getpid()
+        new = not os.path.exists(self.trace_path)
+        with open(self.trace_path, 'a') as f:
+            # JSON array format, where the closing bracket is optional
+            if new:
+                f.write('[\n')
+            for phase, duration in zip(self._phases, durations):
+                event = {
+                    'name': phase.name,
+                    'ph': 'X',
+                    'ts': (self._epoch + phase.start) * 1e6,
+                    'dur': (phase.end - phase.start) * 1e6,
+                    'pid': pid,
+                    'tid': 0,
+                    'args': {'checkpoint_step': step}
+                }
+                if phase.events is not None:
+                    event['args']['device_ms'] = duration * 1000.
+                f.write(json.dumps(event) + ',\n')
+
+    def summary(self, algorithm, step):
+        """Summarize the steps since the last summary, and start over."""
+        if self.cuda:
+            torch.cuda.synchronize()
+        durations = [self._duration(phase) for phase in self._phases]
+        index = {id(phase): i for i, phase in enumerate(self._phases)}
+        exclusive = list(durations)
+        for phase, duration in zip(self._phases, durations):
+            if phase.parent is not None and id(phase.parent) in index:
+                exclusive[index[id(phase.parent)]] -= duration
+        totals = collections.defaultdict(float)
+        for phase, duration in zip(self._phases, exclusive):
+            totals[_PHASE_NAMES.get(phase.name, phase.name)] += duration
+        if self.trace_path is not None:
+            self._write_trace(durations, step)
+
+        steps = max(self._steps, 1)
+        step_time = max(self._step_time, 1e-12)
+        counters = getattr(algorithm, 'counters', {})
+        summary = {
+            'phase_time': {name: (total if name == 'eval' else total / steps)
+                for name, total in totals.items()},
+            'samples_per_sec': {name: samples / step_time for name, samples
+                in zip(self.env_names, self._samples)},
+            'rss_gb': rss_gb(),
+            'peak_rss_gb': peak_rss_gb(),
+            'counters': {name: count / steps
+                for name, count in counters.items()}
+        }
+        if hasattr(counters, 'clear'):
+            counters.clear()
+        self._reset()
+        return summary
@@ -2,27 +2,13 @@
 
 import collections
 
-import json
-import os
-
-import tqdm
-
+from domainbed.lib import results_index
 from domainbed.lib.query import Q
 
 def load_records(path):
-    records = []
-    for i, subdir in tqdm.tqdm(list(enumerate(os.listdir(path))),
-                               ncols=80,
-                               leave=False):
-        results_path = os.path.join(path, subdir, "results.jsonl")
-        try:
-            with open(results_path, "r") as f:
-                for line in f:
-                    records.append(json.loads(line[:-1]))
-        except IOError:
-            pass
-
-    return Q(records)
+    """All the records of the results.jsonl files under path, read through
+    the sweep's results index (see lib/results_index.py)."""
+    return results_index.ResultsIndex(path).update().records()
 
 def get_grouped_records(records):
     """Group records by (trial_seed, dataset, algorithm, test_env). Because
@@ -0,0 +1,234 @@
+"""
+Incremental index of the results.jsonl files of a sweep.
+
+The index is a SQLite database (by default `results_index.sqlite` in the sweep
+directory). Each update only reads the lines that were appended to a
+results.jsonl since the last update, using the file's size, mtime and the
+offset reached, and re-reads a file from the start when it was rewritten
+(e.g. truncated by a resumed train.py). Records are stored both as JSON, to
+rebuild reporting.load_records, and as columns (run keys, step, per-env
+accuracies) that RecordTable loads as arrays for the model selection methods.
+"""
+
+import json
+import os
+import sqlite3
+
+import numpy as np
+
+from domainbed.lib.query import Q
+
+INDEX_NAME = 'results_index.sqlite'
+SCHEMA_VERSION = 1
+# Bytes before the offset that must be unchanged to read only the new lines
+_TAIL_SIZE = 256
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    run_dir TEXT PRIMARY KEY,
+    mtime REAL,
+    size INTEGER,
+    offset INTEGER,
+    tail BLOB,
+    n_lines INTEGER,
+    position INTEGER
+);
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    run_dir TEXT,
+    line INTEGER,
+    trial_seed INTEGER,
+    dataset TEXT,
+    algorithm TEXT,
+    hparams_seed INTEGER,
+    step INTEGER,
+    n_envs INTEGER,
+    test_envs BLOB,
+    in_accs BLOB,
+    out_accs BLOB,
+    json TEXT
+);
+CREATE INDEX IF NOT EXISTS records_run_dir ON records (run_dir, line);
+"""
+
+# Records in the order of reporting.load_records: run directories in
+# os.listdir order, then lines
+_ORDER = """
+    FROM records JOIN files USING (run_dir)
+    ORDER BY files.position, records.line
+"""
+
+# test_envs, in_accs and out_accs are stored as raw arrays of these types
+_TEST_ENV_DTYPE = np.int64
+_ACC_DTYPE = np.float64
+
+
+def _n_envs(record):
+    """Number of environments, counted like the selection methods do."""
+    n_envs = 0
+    while 'env{}_out_acc'.format(n_envs) in record:
+        n_envs += 1
+    return n_envs
+
+
+class ResultsIndex:
+    def __init__(self, input_dir, index_path=None):
+        self.input_dir = input_dir
+        if index_path is None:
+            index_path = os.path.join(input_dir, INDEX_NAME)
+        try:
+            self.connection = sqlite3.connect(index_path)
+            self._check_schema()
+        except sqlite3.Error:
+            # e.g. a read-only sweep directory: index in memory instead
+            self.connection = sqlite3.connect(':memory:')
+            self._check_schema()
+
+    def _check_schema(self):
+        version = self.connection.execute('PRAGMA user_version').fetchone()[0]
+        if version != SCHEMA_VERSION:
+            for table in ['files', 'records']:
+                self.connection.execute('DROP TABLE IF EXISTS ' + table)
+        self.connection.executescript(_SCHEMA)
+        self.connection.execute('PRAGMA user_version = {}'.format(
+            SCHEMA_VERSION))
+        self.connection.commit()
+
+    def _delete_run(self, run_dir):
+        c = self.connection
+        c.execute('DELETE FROM records WHERE run_dir = ?', (run_dir,))
+        c.execute('DELETE FROM files WHERE run_dir = ?', (run_dir,))
+
+    def _insert(self, run_dir, first_line, lines):
+        rows = []
+        for i, line in enumerate(lines):
+            record = json.loads(line)
+            args = record['args']
+            envs = range(_n_envs(record))
+            in_accs = [record.get('env{}_in_acc'.format(env), np.nan)
+                for env in envs]
+            out_accs = [record['env{}_out_acc'.format(env)] for env in envs]
+            rows.append((run_dir, first_line + i, args['trial_seed'],
+                args['dataset'], args['algorithm'], args['hparams_seed'],
+                record['step'], len(envs),
+                np.array(args['test_envs'], dtype=_TEST_ENV_DTYPE).tobytes(),
+                np.array(in_accs, dtype=_ACC_DTYPE).tobytes(),
+                np.array(out_accs, dtype=_ACC_DTYPE).tobytes(), line))
+        self.connection.executemany('INSERT INTO records (run_dir, line, '
+            'trial_seed, dataset, algorithm, hparams_seed, step, n_envs, '
+            'test_envs, in_accs, out_accs, json) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def update(self):
+        """Ingest the new and changed results.jsonl files of input_dir."""
+        c = self.connection
+        known = {row[0]: row[1:] for row in c.execute(
+            'SELECT run_dir, mtime, size, offset, tail, n_lines FROM files')}
+        seen = set()
+        for position, run_dir in enumerate(os.listdir(self.input_dir)):
+            results_path = os.path.join(self.input_dir, run_dir,
+                'results.jsonl')
+            try:
+                stat = os.stat(results_path)
+            except OSError:
+                continue
+            seen.add(run_dir)
+            c.execute('UPDATE files SET position = ? WHERE run_dir = ?',
+                (position, run_dir))
+            offset, tail, n_lines = 0, b'', 0
+            if run_dir in known:
+                mtime, size, offset, tail, n_lines = known[run_dir]
+                if (mtime, size) == (stat.st_mtime, stat.st_size):
+                    continue
+            with open(results_path, 'rb') as f:
+                # Read from the offset only if the file was appended to
+                if offset > 0:
+                    f.seek(offset - len(tail))
+                    if stat.st_size < offset or f.read(len(tail)) != tail:
+                        self._delete_run(run_dir)
+                        offset, n_lines = 0, 0
+                        f.seek(0)
+                data = f.read()
+            # Only complete lines; a line being written is read next time
+            data = data[:data.rfind(b'\n') + 1]
+            lines = data.decode('utf-8').splitlines()
+            if offset == 0:
+                self._delete_run(run_dir)
+            self._insert(run_dir, n_lines, lines)
+            offset += len(data)
+            with open(results_path, 'rb') as f:
+                f.seek(max(0, offset - _TAIL_SIZE))
+                tail = f.read(offset - max(0, offset - _TAIL_SIZE))
+            c.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, '
+                '?)', (run_dir, stat.st_mtime, stat.st_size, offset, tail,
+                n_lines + len(lines), position))
+        for run_dir in set(known) - seen:
+            self._delete_run(run_dir)
+        c.commit()
+        return self
+
+    def __len__(self):
+        return self.connection.execute(
+            'SELECT COUNT(*) FROM records').fetchone()[0]
+
+    def records(self):
+        """All records, as reporting.load_records returns them."""
+        return Q([json.loads(row[0]) for row in self.connection.execute(
+            'SELECT records.json' + _ORDER)])
+
+    def table(self):
+        return RecordTable(self)
+
+
+class RecordTable:
+    """
+    The columns of every record of a ResultsIndex as arrays, in the order of
+    reporting.load_records:
+
+    trial_seed, dataset, algorithm, hparams_seed, step, n_envs: (R,) arrays,
+        with dataset and algorithm as indices into self.datasets and
+        self.algorithms (names in order of first appearance)
+    test_envs: (R, T) test envs, padded with -1
+    in_acc, out_acc: (R, E) env accuracies, NaN beyond n_envs
+    """
+    def __init__(self, index):
+        rows = index.connection.execute('SELECT records.trial_seed, '
+            'records.hparams_seed, records.step, records.n_envs, '
+            'records.dataset, records.algorithm, records.test_envs, '
+            'records.in_accs, records.out_accs' + _ORDER).fetchall()
+        columns = np.array([row[:4] for row in rows],
+            dtype=np.int64).reshape(-1, 4)
+        self.trial_seed, self.hparams_seed, self.step, self.n_envs = (
+            columns.T.copy())
+        names = [row[4] for row in rows], [row[5] for row in rows]
+        self.datasets = list(dict.fromkeys(names[0]))
+        self.algorithms = list(dict.fromkeys(names[1]))
+        self.dataset = self._name_ids(names[0], self.datasets)
+        self.algorithm = self._name_ids(names[1], self.algorithms)
+        self.test_envs = self._padded([row[6] for row in rows],
+            _TEST_ENV_DTYPE, -1)
+        self.in_acc = self._padded([row[7] for row in rows], _ACC_DTYPE,
+            np.nan)
+        self.out_acc = self._padded([row[8] for row in rows], _ACC_DTYPE,
+            np.nan)
+
+    @staticmethod
+    def _padded(blobs, dtype, fill):
+        """(R, max length) array of the arrays stored in blobs."""
+        lengths = np.array([len(blob) for blob in blobs],
+            dtype=np.int64) // np.dtype(dtype).itemsize
+        values = np.frombuffer(b''.join(blobs), dtype=dtype)
+        result = np.full((len(blobs), lengths.max(initial=0)), fill,
+            dtype=dtype)
+        starts = np.cumsum(lengths) - lengths
+        rows = np.repeat(np.arange(len(blobs)), lengths)
+        result[rows, np.arange(len(values)) - starts[rows]] = values
+        return result
+
+    @staticmethod
+    def _name_ids(column, names):
+        ids = {name: i for i, name in enumerate(names)}
+        return np.array([ids[name] for name in column], dtype=np.int64)
+
+    def __len__(self):
+        return len(self.step)
@@ -0,0 +1,354 @@
+"""
+Sharded, streaming storage of the environments of the WILDS datasets.
+
+pack_environments writes every example of each environment once, in a fixed
+random order, into tar shards of about SHARD_SIZE bytes (one PNG member per
+example, named after its index in the environment), next to an index of the
+offset of each example in its shard and an array of labels:
+
+    env0-00000.tar, env0-00001.tar, ...  PNG of every example of env 0
+    env0.index.npy                        (shard, offset, size) per example
+    env0.labels.npy                       label per example
+
+ShardedEnvironment reads these back, either by index (one pread of the
+example from an already open shard, e.g. for class-balanced sampling) or as
+a stream that reads its shards sequentially in large chunks. The training
+loader of train.py streams the training splits through a shuffle buffer
+(StreamingDataLoader), and the eval loaders read each split once in shard
+order (ShardEvalLoader), so that neither opens nor seeks to small files.
+"""
+
+import fcntl
+import io
+import os
+import tarfile
+import uuid
+
+import numpy as np
+import torch
+from PIL import Image
+
+from domainbed.lib import misc
+from domainbed.lib.fast_data_loader import MultiEnvDataLoader
+from domainbed.lib import profiler
+
+SHARD_SIZE = 256 * 1024 * 1024   # Bytes per shard, before the last example
+CHUNK_SIZE = 8 * 1024 * 1024     # Bytes per sequential read of a stream
+BUFFER_SIZE = 512                # Examples in the shuffle buffer of a stream
+
+
+def _shard_path(path, env_i, shard):
+    return os.path.join(path, "env{}-{:05d}.tar".format(env_i, shard))
+
+
+def _index_paths(path, env_i):
+    prefix = os.path.join(path, "env{}".format(env_i))
+    return prefix + ".index.npy", prefix + ".labels.npy"
+
+
+class _EncodedExamples(torch.utils.data.Dataset):
+    """PNG bytes and label of the examples of an environment whose items are
+    (PIL image, label). Used by pack_environments."""
+    def __init__(self, environment):
+        self.environment = environment
+
+    def __getitem__(self, index):
+        x, y = self.environment[index]
+        buffer = io.BytesIO()
+        x.save(buffer, format="PNG", compress_level=1)
+        return buffer.getvalue(), int(y)
+
+    def __len__(self):
+        return len(self.environment)
+
+
+def pack_environments(environments, path, shard_size=SHARD_SIZE,
+                      num_workers=8):
+    """
+    Pack every example of environments (datasets of (PIL image, label), with
+    no transform) into the shards of the directory `path`. The images are
+    encoded losslessly, in num_workers worker processes, and written in a
+    random order, so that reading a shard front to back gives examples from
+    all over the environment (e.g. from every WILDS hospital slide). Packing
+    holds a lock on `path`.lock, so that of concurrent jobs only the first
+    packs and the others wait for its shards; the directory is written under
+    a temporary name and renamed into place, so that no job sees partially
+    written shards. The global RNGs are left untouched.
+    """
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if os.path.exists(path):
+            # Another job packed the same environments while we waited
+            return
+        tmp_path = "{}.tmp{}".format(path, uuid.uuid4().hex)
+        os.makedirs(tmp_path)
+        for env_i, environment in enumerate(environments):
+            _pack_environment(environment, env_i, tmp_path, shard_size,
+                num_workers)
+        os.rename(tmp_path, path)
+
+
+def _pack_environment(environment, env_i, path, shard_size, num_workers):
+    index = np.zeros((len(environment), 3), dtype=np.int64)
+    labels = np.zeros(len(environment), dtype=np.int64)
+    order = np.random.RandomState(env_i).permutation(len(environment))
+    # The DataLoader draws its base seed from this generator rather than the
+    # global torch RNG, so that the run that packs the shards trains like
+    # the runs that find them packed
+    loader = torch.utils.data.DataLoader(torch.utils.data.Subset(
+        _EncodedExamples(environment), order), batch_size=None,
+        num_workers=num_workers, generator=torch.Generator())
+    shard, tar = -1, None
+    for i, (data, label) in zip(order, loader):
+        if tar is None or tar.offset >= shard_size:
+            if tar is not None:
+                tar.close()
+            shard += 1
+            tar = tarfile.open(_shard_path(path, env_i, shard), "w",
+                format=tarfile.USTAR_FORMAT)
+        info = tarfile.TarInfo("{:08d}.png".format(i))
+        info.size = len(data)
+        offset = tar.offset + len(info.tobuf(tar.format, tar.encoding,
+            tar.errors))
+        tar.addfile(info, io.BytesIO(data))
+        index[i] = shard, offset, len(data)
+        labels[i] = label
+    if tar is not None:
+        tar.close()
+    index_path, labels_path = _index_paths(path, env_i)
+    np.save(index_path, index)
+    np.save(labels_path, labels)
+
+
+def _shuffled(items, buffer_size, rng):
+    """Shuffle the stream `items` through a buffer of buffer_size items."""
+    buffer = []
+    for item in items:
+        if len(buffer) < buffer_size:
+            buffer.append(item)
+            continue
+        i = rng.randint(buffer_size)
+        yield buffer[i]
+        buffer[i] = item
+    rng.shuffle(buffer)
+    yield from buffer
+
+
+class ShardedEnvironment(torch.utils.data.Dataset):
+    """
+    Environment `env_i` of the shards in `path`, with items (x, y) like
+    WILDSEnvironment: x is the decoded image after `transform`, y the label.
+    """
+    def __init__(self, path, env_i, transform=None):
+        super().__init__()
+        self._files = {}
+        self.path = path
+        self.env_i = env_i
+        self.transform = transform
+        index_path, labels_path = _index_paths(path, env_i)
+        self.index = np.load(index_path)
+        self.targets = np.load(labels_path)
+
+    def __getstate__(self):
+        # Each DataLoader worker opens the shards itself
+        state = self.__dict__.copy()
+        state["_files"] = {}
+        return state
+
+    def __del__(self):
+        for fd in self._files.values():
+            os.close(fd)
+
+    def _read(self, shard, offset, size):
+        if shard not in self._files:
+            self._files[shard] = os.open(
+                _shard_path(self.path, self.env_i, shard), os.O_RDONLY)
+        return os.pread(self._files[shard], size, offset)
+
+    def example(self, index, data):
+        """The item of the example `index`, from its encoded image `data`."""
+        x = Image.open(io.BytesIO(data))
+        x.load()
+        if self.transform is not None:
+            x = self.transform(x)
+        return x, torch.tensor(self.targets[index])
+
+    def __getitem__(self, index):
+        shard, offset, size = self.index[index]
+        return self.example(index, self._read(int(shard), int(offset),
+            int(size)))
+
+    def __len__(self):
+        return len(self.targets)
+
+    def parts(self, keys, part, n_parts):
+        """
+        The (shard, example indices) pairs, in shard order, of the examples
+        `keys` read by reader `part` of n_parts: whole shards when there are
+        at least n_parts of them, else every n_parts-th example of each.
+        The examples of each shard are in the order of their offsets.
+        """
+        keys = np.asarray(keys, dtype=np.int64)
+        keys = keys[np.lexsort((self.index[keys, 1], self.index[keys, 0]))]
+        shards = self.index[keys, 0]
+        parts = [(shard, keys[shards == shard]) for shard in np.unique(shards)]
+        if len(parts) >= n_parts:
+            return parts[part::n_parts]
+        return [(shard, examples[part::n_parts]) for shard, examples in parts]
+
+    def read_sequential(self, shard, examples, chunk_size=CHUNK_SIZE):
+        """Yield (index, encoded image) for examples (indices of examples of
+        `shard`, in the order of their offsets), reading the shard front to
+        back in chunks."""
+        offsets, sizes = self.index[examples, 1], self.index[examples, 2]
+        start = 0
+        while start < len(examples):
+            # Examples [start, end) are read in one chunk
+            end = start + 1
+            while (end < len(examples) and
+                    offsets[end] + sizes[end] - offsets[start] <= chunk_size):
+                end += 1
+            base = int(offsets[start])
+            data = self._read(int(shard), base,
+                int(offsets[end - 1] + sizes[end - 1]) - base)
+            for i in range(start, end):
+                yield examples[i], data[offsets[i] - base:
+                    offsets[i] - base + sizes[i]]
+            start = end
+
+
+def sharded_split(dataset):
+    """(ShardedEnvironment, keys) of a split of a ShardedEnvironment, or None
+    if dataset is not one."""
+    environment, keys = misc.split_keys(dataset)
+    if not isinstance(environment, ShardedEnvironment):
+        return None
+    if keys is None:
+        keys = torch.arange(len(environment))
+    return environment, keys.numpy()
+
+
+class _MultiEnvStream(torch.utils.data.IterableDataset):
+    """
+    Yields forever, for every step, one collated minibatch of batch_size
+    examples per (ShardedEnvironment, keys) split. Each DataLoader worker
+    reads its own part of the shards of every split, in a random order at
+    every pass, and shuffles the examples through a buffer of buffer_size.
+    """
+    def __init__(self, splits, batch_size, buffer_size, seed):
+        super().__init__()
+        self.splits = splits
+        self.batch_size = batch_size
+        self.buffer_size = buffer_size
+        self.seed = seed
+        self.start = 0
+
+    def _examples(self, environment, keys, part, n_parts, rng):
+        parts = environment.parts(keys, part, n_parts)
+        if sum(len(examples) for _, examples in parts) == 0:
+            # Fewer examples than workers: this worker reads all of them
+            parts = environment.parts(keys, 0, 1)
+        if len(parts) == 0:
+            raise ValueError("Cannot stream an empty split")
+        while True:
+            for i in rng.permutation(len(parts)):
+                yield from environment.read_sequential(*parts[i])
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        part, n_parts = 0, 1
+        if worker_info is not None:
+            part, n_parts = worker_info.id, worker_info.num_workers
+        rng = np.random.RandomState(misc.seed_hash(self.seed, self.start,
+            part))
+        streams = [_shuffled(self._examples(environment, keys, part, n_parts,
+            rng), self.buffer_size, rng) for environment, keys in self.splits]
+        while True:
+            minibatches = []
+            for (environment, _), stream in zip(self.splits, streams):
+                minibatches.append(torch.utils.data.default_collate(
+                    [environment.example(*next(stream))
+                        for _ in range(self.batch_size)]))
+            yield minibatches
+
+
+class StreamingDataLoader(MultiEnvDataLoader):
+    """
+    MultiEnvDataLoader for splits of ShardedEnvironments (see sharded_split)
+    that streams their shards instead of reading examples by index. The
+    examples are drawn without replacement within a pass over the shards,
+    in an order shuffled through a buffer of buffer_size examples per worker
+    and split, so the minibatches differ from those of a MultiEnvDataLoader.
+    They are a function of the seed, the number of workers and the step the
+    iteration starts at; a resumed run restarts the streams at its step.
+    """
+    def __init__(self, splits, batch_size, num_workers, device='cpu',
+            prefetch=2, buffer_size=BUFFER_SIZE):
+        self.device = torch.device(device)
+
+        kwargs = {}
+        if num_workers > 0:
+            kwargs['prefetch_factor'] = max(1, -(-prefetch // num_workers))
+            kwargs['persistent_workers'] = True
+        self._stream = _MultiEnvStream(splits, batch_size, buffer_size,
+            int(torch.empty((), dtype=torch.int64).random_()))
+        self._steps = 0
+        self.profiler = profiler.NullProfiler()
+        self._loader = torch.utils.data.DataLoader(
+            self._stream,
+            batch_size=None,
+            num_workers=num_workers,
+            pin_memory=self.device.type == 'cuda',
+            **kwargs)
+
+    def state_dict(self):
+        return {'seed': self._stream.seed, 'step': self._steps}
+
+    def load_state_dict(self, state_dict):
+        self._stream.seed = state_dict['seed']
+        self._steps = state_dict['step']
+
+    def _batches(self):
+        self._stream.start = self._steps
+        return iter(self._loader)
+
+
+class _SplitStream(torch.utils.data.IterableDataset):
+    """Every example of a (ShardedEnvironment, keys) split once, in shard
+    order, with each DataLoader worker reading its own part."""
+    def __init__(self, environment, keys):
+        super().__init__()
+        self.environment = environment
+        self.keys = keys
+
+    def __iter__(self):
+        worker_info = torch.utils.data.get_worker_info()
+        part, n_parts = 0, 1
+        if worker_info is not None:
+            part, n_parts = worker_info.id, worker_info.num_workers
+        for shard, examples in self.environment.parts(self.keys, part,
+                n_parts):
+            for index, data in self.environment.read_sequential(shard,
+                    examples):
+                yield self.environment.example(index, data)
+
+
+class ShardEvalLoader:
+    """Iterates once over a split of a ShardedEnvironment in minibatches,
+    reading its shards sequentially, like FastDataLoader does by index. The
+    examples come in shard order; the minibatches of different workers are
+    interleaved."""
+    def __init__(self, dataset, batch_size, num_workers):
+        super().__init__()
+        environment, keys = sharded_split(dataset)
+        self._loader = torch.utils.data.DataLoader(
+            _SplitStream(environment, keys),
+            batch_size=batch_size,
+            num_workers=num_workers,
+            persistent_workers=num_workers > 0)
+
+    def __iter__(self):
+        # The examples do not depend on the base seed the DataLoader iterator
+        # draws; keep the draw off the torch RNG, which a resumed run restores
+        with torch.random.fork_rng(devices=[]):
+            return iter(self._loader)
@@ -0,0 +1,131 @@
+"""
+On-disk store of expert soft labels for two-phase LFME training.
+
+For every source environment the store holds, for each example of the
+environment, the top-k probabilities of that environment's expert (float16)
+and their class indices, as memory-mapped .npy arrays. The probability mass
+outside the top-k is spread uniformly over the remaining classes when the
+dense soft label is rebuilt.
+"""
+
+import json
+import os
+import uuid
+
+import numpy as np
+import torch
+
+MANIFEST_NAME = 'manifest.json'
+
+
+class IndexedSplit(torch.utils.data.Dataset):
+    """Wraps a split returned by misc.split_dataset and also returns the index
+    of each example in its environment, to look up its soft label."""
+    def __init__(self, split):
+        super(IndexedSplit, self).__init__()
+        self.split = split
+
+    def __getitem__(self, key):
+        x, y = self.split[key]
+        return x, y, self.split.keys[key]
+
+    def __len__(self):
+        return len(self.split)
+
+
+def _paths(store_dir, env_i):
+    prefix = os.path.join(store_dir, 'env{}'.format(env_i))
+    return prefix + '.values.npy', prefix + '.indices.npy'
+
+
+def write_soft_labels(store_dir, experts, envs, env_datasets, num_classes,
+        topk, batch_size=64, num_workers=0, device='cpu', **manifest_extra):
+    """Run experts[p] over every example of env_datasets[p] (in order) and
+    write the top-k softmax outputs for environment envs[p] to store_dir.
+    Arrays are written under temporary names and renamed into place."""
+    os.makedirs(store_dir, exist_ok=True)
+    topk = min(topk, num_classes)
+    index_dtype = np.int16 if num_classes <= np.iinfo(np.int16).max \
+        else np.int32
+    tmp_suffix = '.tmp{}'.format(uuid.uuid4().hex)
+    env_sizes = []
+    for expert, env_i, env_dataset in zip(experts, envs, env_datasets):
+        values_path, indices_path = _paths(store_dir, env_i)
+        values = np.lib.format.open_memmap(values_path + tmp_suffix,
+            mode='w+', dtype=np.float16, shape=(len(env_dataset), topk))
+        indices = np.lib.format.open_memmap(indices_path + tmp_suffix,
+            mode='w+', dtype=index_dtype, shape=(len(env_dataset), topk))
+        loader = torch.utils.data.DataLoader(env_dataset,
+            batch_size=batch_size, num_workers=num_workers, shuffle=False)
+        expert.eval()
+        offset = 0
+        with torch.no_grad():
+            for x, _ in loader:
+                p = torch.softmax(expert(x.to(device)), dim=1)
+                top_values, top_indices = p.topk(topk, dim=1)
+                values[offset:offset + len(x)] = top_values.cpu().numpy()
+                indices[offset:offset + len(x)] = top_indices.cpu().numpy()
+                offset += len(x)
+        expert.train()
+        values.flush()
+        indices.flush()
+        del values, indices
+        os.replace(values_path + tmp_suffix, values_path)
+        os.replace(indices_path + tmp_suffix, indices_path)
+        env_sizes.append(len(env_dataset))
+
+    manifest = {
+        'envs': list(envs),
+        'env_sizes': env_sizes,
+        'num_classes': num_classes,
+        'topk': topk,
+        **manifest_extra
+    }
+    with open(os.path.join(store_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    return manifest
+
+
+class SoftLabelStore:
+    """Read side of write_soft_labels."""
+    def __init__(self, store_dir):
+        with open(os.path.join(store_dir, MANIFEST_NAME)) as f:
+            self.manifest = json.load(f)
+        self.num_classes = self.manifest['num_classes']
+        self.topk = self.manifest['topk']
+        self.values = []
+        self.indices = []
+        for env_i in self.manifest['envs']:
+            values_path, indices_path = _paths(store_dir, env_i)
+            self.values.append(np.load(values_path, mmap_mode='r'))
+            self.indices.append(np.load(indices_path, mmap_mode='r'))
+
+    def check(self, dataset_name, test_envs, env_sizes):
+        """Raise ValueError unless the store was built for these source
+        environments of this dataset."""
+        envs = [i for i in range(len(env_sizes)) if i not in test_envs]
+        expected = {
+            'dataset': dataset_name,
+            'envs': envs,
+            'env_sizes': [env_sizes[i] for i in envs],
+        }
+        for key, value in expected.items():
+            if self.manifest.get(key) != value:
+                raise ValueError('Soft label store has {}={}, expected {}'
+                    .format(key, self.manifest.get(key), value))
+
+    def lookup(self, position, index):
+        """Dense soft labels of the examples `index` (a tensor of indices
+        into the environment) of the position-th source environment."""
+        index = index.cpu().numpy()
+        values = torch.from_numpy(self.values[position][index].astype(
+            np.float32))
+        indices = torch.from_numpy(self.indices[position][index].astype(
+            np.int64))
+        if self.topk < self.num_classes:
+            rest = (1. - values.sum(1, keepdim=True)).clamp(min=0) / \
+                (self.num_classes - self.topk)
+        else:
+            rest = torch.zeros(len(index), 1)
+        dense = rest.expand(len(index), self.num_classes).clone()
+        return dense.scatter_(1, indices, values)
@@ -1,13 +1,86 @@
 # Copyright (c) Facebook, Inc. and its affiliates. All Rights Reserved
 
 import itertools
+import warnings
 import numpy as np
 
+from domainbed.lib.query import Q
+
 def get_test_records(records):
     """Given records with a common test env, get the test records (i.e. the
     records with *only* that single test env and no other test envs)"""
     return records.filter(lambda r: len(r['args']['test_envs']) == 1)
 
+def _first_appearance_ids(*keys):
+    """Ids of the distinct tuples of keys (arrays of equal length), numbered
+    in order of first appearance, and the number of distinct tuples."""
+    if not len(keys[0]):
+        return np.zeros(0, dtype=np.int64), 0
+    # One int64 code per tuple, adding one key at a time
+    code = np.zeros(len(keys[0]), dtype=np.int64)
+    for key in keys:
+        values, inverse = np.unique(key, return_inverse=True)
+        _, first, code = np.unique(code * len(values) + inverse.reshape(-1),
+            return_index=True, return_inverse=True)
+        code = code.reshape(-1)
+    rank = np.empty(len(first), dtype=np.int64)
+    rank[np.argsort(first, kind='stable')] = np.arange(len(first))
+    return rank[code], len(first)
+
+def _first_per_group(group, *keys):
+    """Index of the first element of each group when sorting by keys (the
+    first key is the primary one), and the groups."""
+    order = np.lexsort(tuple(reversed(keys)) + (group,))
+    first = np.ones(len(order), dtype=bool)
+    first[1:] = group[order][1:] != group[order][:-1]
+    return order[first], group[order[first]]
+
+def _argmax_per_group(group, val_acc, order):
+    """Like Q.argmax('val_acc') over the elements of each group sorted by
+    order: the first highest val acc, or the first element if its val acc is
+    NaN (max() never replaces a NaN)."""
+    first, groups = _first_per_group(group, order)
+    nan_first = np.isnan(val_acc[first])
+    best, _ = _first_per_group(group,
+        -np.where(np.isnan(val_acc), -np.inf, val_acc), order)
+    return np.where(nan_first, first, best), groups
+
+def _other_envs(test_env, n_envs):
+    """(N, n_envs - 1) indices of the envs other than test_env, in order."""
+    envs = np.arange(n_envs - 1)
+    return envs + (envs >= test_env[:, None])
+
+class _Entries:
+    """
+    One entry per (record, test env of the record) of a RecordTable, in the
+    order in which reporting.get_grouped_records adds records to groups, with
+    the (trial_seed, dataset, algorithm, test_env) group and the
+    (group, hparams_seed) run of each entry.
+    """
+    def __init__(self, table):
+        rows, positions = np.nonzero(table.test_envs >= 0)
+        self.row = rows
+        self.test_env = table.test_envs[rows, positions]
+        self.n_test_envs = (table.test_envs >= 0).sum(1)[rows]
+        self.group, self.n_groups = _first_appearance_ids(
+            table.trial_seed[rows], table.dataset[rows],
+            table.algorithm[rows], self.test_env)
+        self.run, self.n_runs = _first_appearance_ids(self.group,
+            table.hparams_seed[rows])
+        self.run_group = np.zeros(self.n_runs, dtype=np.int64)
+        self.run_group[self.run] = self.group
+        self.run_hparams_seed = np.zeros(self.n_runs, dtype=np.int64)
+        self.run_hparams_seed[self.run] = table.hparams_seed[rows]
+        self.group_entry = np.zeros(self.n_groups, dtype=np.int64)
+        self.group_entry[self.group[::-1]] = np.arange(len(rows))[::-1]
+
+    @classmethod
+    def of(cls, table):
+        """The entries of a RecordTable, built once per table."""
+        if getattr(table, '_entries', None) is None:
+            table._entries = cls(table)
+        return table._entries
+
 class SelectionMethod:
     """Abstract class whose subclasses implement strategies for model
     selection across hparams and timesteps."""
@@ -51,6 +124,114 @@ class SelectionMethod:
         else:
             return None
 
+    @classmethod
+    def run_accs(self, table, entries):
+        """
+        Vectorized run_acc of every run of a RecordTable: (valid, val_acc,
+        test_acc) arrays indexed by the runs of entries (see _Entries).
+        """
+        raise NotImplementedError
+
+    @classmethod
+    def ranked_runs(self, table):
+        """
+        The valid runs of a RecordTable sorted by group (see _Entries), then
+        best first, as hparams_accs sorts them: the highest val acc (NaN
+        last), ties going to the highest hparams_seed. Returns the entries,
+        the sorted runs and their (val_acc, test_acc).
+        """
+        entries = _Entries.of(table)
+        valid, val_acc, test_acc = self.run_accs(table, entries)
+        runs = np.nonzero(valid)[0]
+        order = np.lexsort((-entries.run_hparams_seed[runs],
+            -np.where(np.isnan(val_acc[runs]), -np.inf, val_acc[runs]),
+            entries.run_group[runs]))
+        runs = runs[order]
+        return entries, runs, val_acc[runs], test_acc[runs]
+
+    @staticmethod
+    def _group_dict(table, entries, group):
+        entry = entries.group_entry[group]
+        row = entries.row[entry]
+        return {
+            "trial_seed": int(table.trial_seed[row]),
+            "dataset": table.datasets[table.dataset[row]],
+            "algorithm": table.algorithms[table.algorithm[row]],
+            "test_env": int(entries.test_env[entry])
+        }
+
+    @classmethod
+    def sweep_accs(self, table, bootstrap=0, seed=0):
+        """
+        Vectorized sweep_acc of all the groups of reporting.get_grouped_records
+        over the records of a RecordTable: a Q of {trial_seed, dataset,
+        algorithm, test_env, sweep_acc} dicts in the same order, without the
+        groups whose sweep_acc is None.
+
+        With bootstrap > 0, each dict also has "bootstrap_accs": the sweep_acc
+        of `bootstrap` resamples (with replacement) of the group's runs.
+        """
+        entries, runs, _, test_acc = self.ranked_runs(table)
+        groups = entries.run_group[runs]
+        first = np.ones(len(runs), dtype=bool)
+        first[1:] = groups[1:] != groups[:-1]
+        starts = np.nonzero(first)[0]
+        if bootstrap:
+            bootstrap_accs = self._bootstrap(test_acc, starts, bootstrap,
+                seed)
+        result = []
+        for i in range(len(starts)):
+            result.append({
+                **self._group_dict(table, entries, groups[starts[i]]),
+                "sweep_acc": float(test_acc[starts[i]])
+            })
+            if bootstrap:
+                result[-1]["bootstrap_accs"] = bootstrap_accs[i]
+        return Q(result)
+
+    @staticmethod
+    def _bootstrap(test_acc, starts, n_samples, seed, chunk_size=100):
+        """
+        (len(starts), n_samples) sweep accs of resampled groups, given the
+        ranked runs of each group (from position starts[i] on): resampling
+        k runs and keeping the best one is drawing k ranks and keeping the
+        smallest.
+        """
+        sizes = np.diff(np.append(starts, len(test_acc)))
+        max_size = sizes.max(initial=0)
+        random_state = np.random.RandomState(seed)
+        ranks = np.empty((len(starts), n_samples), dtype=np.int64)
+        # Draws beyond the size of a group never win
+        padding = (np.arange(max_size) >= sizes[:, None])[:, None, :]
+        for i in range(0, n_samples, chunk_size):
+            n = min(chunk_size, n_samples - i)
+            draws = (random_state.random_sample((len(starts), n, max_size)) *
+                sizes[:, None, None]).astype(np.int64)
+            ranks[:, i:i + n] = np.where(padding, max_size, draws).min(2)
+        return test_acc[starts[:, None] + ranks]
+
+    @classmethod
+    def sweep_hparams_accs(self, table):
+        """
+        Vectorized hparams_accs of all the groups of
+        reporting.get_grouped_records: a Q of {trial_seed, dataset,
+        algorithm, test_env, hparams_accs} dicts in the same order, where
+        hparams_accs is a list of ({val_acc, test_acc}, rows) tuples, best
+        first, with the rows of the run's records in the RecordTable.
+        """
+        entries, runs, val_acc, test_acc = self.ranked_runs(table)
+        order = np.argsort(entries.run, kind='stable')
+        run_rows = np.split(entries.row[order],
+            np.cumsum(np.bincount(entries.run, minlength=entries.n_runs))[:-1])
+        hparams_accs = [[] for _ in range(entries.n_groups)]
+        for run, val, test in zip(runs, val_acc, test_acc):
+            hparams_accs[entries.run_group[run]].append((
+                {'val_acc': float(val), 'test_acc': float(test)},
+                run_rows[run]))
+        return Q([{**self._group_dict(table, entries, group),
+            "hparams_accs": hparams_accs[group]}
+            for group in range(entries.n_groups)])
+
 class OracleSelectionMethod(SelectionMethod):
     """Like Selection method which picks argmax(test_out_acc) across all hparams
     and checkpoints, but instead of taking the argmax over all
@@ -72,6 +253,22 @@ class OracleSelectionMethod(SelectionMethod):
             'test_acc': chosen_record[test_in_acc_key]
         }
 
+    @classmethod
+    def run_accs(self, table, entries):
+        single = np.nonzero(entries.n_test_envs == 1)[0]
+        # The last record with the highest step
+        chosen, runs = _first_per_group(entries.run[single],
+            -table.step[entries.row[single]], -single)
+        chosen = single[chosen]
+        rows, test_envs = entries.row[chosen], entries.test_env[chosen]
+        valid = np.zeros(entries.n_runs, dtype=bool)
+        val_acc = np.full(entries.n_runs, np.nan)
+        test_acc = np.full(entries.n_runs, np.nan)
+        valid[runs] = True
+        val_acc[runs] = table.out_acc[rows, test_envs]
+        test_acc[runs] = table.in_acc[rows, test_envs]
+        return valid, val_acc, test_acc
+
 class IIDAccuracySelectionMethod(SelectionMethod):
     """Picks argmax(mean(env_out_acc for env in train_envs))"""
     name = "training-domain validation set"
@@ -99,6 +296,29 @@ class IIDAccuracySelectionMethod(SelectionMethod):
             return None
         return test_records.map(self._step_acc).argmax('val_acc')
 
+    @classmethod
+    def run_accs(self, table, entries):
+        single = np.nonzero(entries.n_test_envs == 1)[0]
+        rows, test_envs = entries.row[single], entries.test_env[single]
+        step_val_acc = np.full(len(single), np.nan)
+        for n_envs in np.unique(table.n_envs[rows]):
+            i = np.nonzero(table.n_envs[rows] == n_envs)[0]
+            envs = _other_envs(test_envs[i], n_envs)
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                step_val_acc[i] = np.mean(table.out_acc[rows[i, None], envs],
+                    axis=1)
+        # The first record with the highest val acc
+        chosen, runs = _argmax_per_group(entries.run[single], step_val_acc,
+            single)
+        valid = np.zeros(entries.n_runs, dtype=bool)
+        val_acc = np.full(entries.n_runs, np.nan)
+        test_acc = np.full(entries.n_runs, np.nan)
+        valid[runs] = True
+        val_acc[runs] = step_val_acc[chosen]
+        test_acc[runs] = table.in_acc[rows[chosen], test_envs[chosen]]
+        return valid, val_acc, test_acc
+
 class LeaveOneOutSelectionMethod(SelectionMethod):
     """Picks (hparams, step) by leave-one-out cross validation."""
     name = "leave-one-domain-out cross-validation"
@@ -139,3 +359,63 @@ class LeaveOneOutSelectionMethod(SelectionMethod):
             return step_accs.argmax('val_acc')
         else:
             return None
+
+    @classmethod
+    def run_accs(self, table, entries):
+        # One key per (run, step)
+        steps = table.step[entries.row]
+        key, n_keys = _first_appearance_ids(entries.run, steps)
+        key_run = np.zeros(n_keys, dtype=np.int64)
+        key_run[key] = entries.run
+        key_step = np.zeros(n_keys, dtype=np.int64)
+        key_step[key] = steps
+        key_test_env = np.zeros(n_keys, dtype=np.int64)
+        key_test_env[key] = entries.test_env
+        # n_envs of the first record of the step
+        key_n_envs = np.zeros(n_keys, dtype=np.int64)
+        key_n_envs[key[::-1]] = table.n_envs[entries.row[::-1]]
+
+        # The single test env record of each step, which must be unique
+        single = np.nonzero(entries.n_test_envs == 1)[0]
+        n_single = np.bincount(key[single], minlength=n_keys)
+        key_test_acc = np.full(n_keys, np.nan)
+        key_test_acc[key[single]] = table.in_acc[entries.row[single],
+            entries.test_env[single]]
+
+        # The in acc of each validation env, from the records with test envs
+        # (test env, validation env); the last record wins
+        pairs = np.nonzero(entries.n_test_envs == 2)[0]
+        pair_rows = entries.row[pairs]
+        val_envs = np.where(table.test_envs[pair_rows, 0] ==
+            entries.test_env[pairs], table.test_envs[pair_rows, 1],
+            table.test_envs[pair_rows, 0])
+        last, _ = _first_appearance_ids(key[pairs], val_envs)
+        last_pair = np.zeros(len(np.unique(last)), dtype=np.int64)
+        last_pair[last] = np.arange(len(pairs))
+        pairs, pair_rows, val_envs = (pairs[last_pair], pair_rows[last_pair],
+            val_envs[last_pair])
+        key_val_accs = np.full((n_keys, max(1, table.in_acc.shape[1])), -1.)
+        key_val_accs[key[pairs], val_envs] = table.in_acc[pair_rows, val_envs]
+
+        key_val_acc = np.full(n_keys, np.nan)
+        key_valid = np.zeros(n_keys, dtype=bool)
+        for n_envs in np.unique(key_n_envs):
+            i = np.nonzero((key_n_envs == n_envs) & (n_single == 1))[0]
+            if n_envs < 2 or not len(i):
+                continue
+            val_accs = key_val_accs[i[:, None],
+                _other_envs(key_test_env[i], n_envs)]
+            key_valid[i] = (val_accs != -1).all(1)
+            key_val_acc[i] = np.sum(val_accs, axis=1) / (n_envs - 1)
+
+        # The first step with the highest val acc
+        keys = np.nonzero(key_valid)[0]
+        chosen, runs = _argmax_per_group(key_run[keys], key_val_acc[keys],
+            key_step[keys])
+        valid = np.zeros(entries.n_runs, dtype=bool)
+        val_acc = np.full(entries.n_runs, np.nan)
+        test_acc = np.full(entries.n_runs, np.nan)
+        valid[runs] = True
+        val_acc[runs] = key_val_acc[keys[chosen]]
+        test_acc[runs] = key_test_acc[keys[chosen]]
+        return valid, val_acc, test_acc
@@ -8,6 +8,24 @@ import random
 from domainbed.lib import wide_resnet
 import copy
 
+_PRETRAINED_STATE_DICTS = {}
+
+def pretrained_resnet18():
+    """
+    torchvision's ImageNet-pretrained resnet18. The weights are read from disk
+    once per process and copied into every later network, so that the jobs
+    of an in-process sweep (command_launchers.in_process_launcher) do not
+    reload them. Both paths draw the same random initialization first.
+    """
+    if 'resnet18' not in _PRETRAINED_STATE_DICTS:
+        network = torchvision.models.resnet18(pretrained=True)
+        _PRETRAINED_STATE_DICTS['resnet18'] = copy.deepcopy(
+            network.state_dict())
+        return network
+    network = torchvision.models.resnet18()
+    network.load_state_dict(_PRETRAINED_STATE_DICTS['resnet18'])
+    return network
+
 def remove_batch_norm_from_resnet(model):
     fuse = torch.nn.utils.fusion.fuse_conv_bn_eval
     model.eval()
@@ -150,10 +168,10 @@ class ResNet(torch.nn.Module):
     def __init__(self, input_shape, hparams):
         super(ResNet, self).__init__()
         if hparams['resnet18']:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 512
         else:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 2048
 
         # self.network = remove_batch_norm_from_resnet(self.network)
@@ -199,10 +217,10 @@ class ResNet_ITTA(torch.nn.Module):
     def __init__(self, input_shape, hparams):
         super(ResNet_ITTA, self).__init__()
         if hparams['resnet18']:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 512
         else:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 2048
 
         nc = input_shape[0]
@@ -432,10 +450,10 @@ class ResNet_base(torch.nn.Module):
     def __init__(self, input_shape, hparams):
         super(ResNet_base, self).__init__()
         if hparams['resnet18']:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 512
         else:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 2048
 
         # self.network = remove_batch_norm_from_resnet(self.network)
@@ -499,10 +517,10 @@ class ResNet_trunk(torch.nn.Module):
     def __init__(self, input_shape, hparams):
         super(ResNet_trunk, self).__init__()
         if hparams['resnet18']:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 512
         else:
-            self.network = torchvision.models.resnet18(pretrained=True)
+            self.network = pretrained_resnet18()
             self.n_outputs = 2048
 
         # self.network = remove_batch_norm_from_resnet(self.network)
@@ -0,0 +1,257 @@
+"""
+Benchmark the per-step cost of the algorithms on CPU.
+
+Every (algorithm, dataset, batch size, number of training domains) case runs
+in its own forked process, on random minibatches shaped like the Debug28
+(MNIST_CNN featurizer) or Debug224 (ResNet featurizer) dataset, with the
+algorithm's default hparams. For each case it reports:
+
+    update_steps_per_sec  update() calls per second, after warmup
+    update_ms             median time of one update()
+    predict_samples_per_sec, predict_ms
+                          the same for predict() on one minibatch per domain
+    peak_rss_mb           peak RSS of the case's process
+    rss_increase_mb       peak RSS minus the RSS before building the algorithm
+    alloc_mb, allocs      bytes and number of tensor allocations of one
+                          update(), from torch.profiler
+
+python -m domainbed.scripts.benchmark --algorithms ERM LFME MLDG \
+    --datasets Debug28 --output benchmark.json
+
+Comparing with an earlier output flags the cases whose update() or
+predict() throughput dropped, or whose peak RSS grew, by more than
+--tolerance, and exits with status 1 if there is any:
+
+python -m domainbed.scripts.benchmark --baseline benchmark.json
+"""
+
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import sys
+import time
+import traceback
+
+import numpy as np
+import torch
+
+from domainbed import algorithms
+from domainbed import datasets
+from domainbed import hparams_registry
+from domainbed.lib import misc
+from domainbed.lib import profiler
+
+# Keys of a case in the results
+CASE_KEYS = ['algorithm', 'dataset', 'batch_size', 'n_domains']
+# Metrics compared with the baseline, and whether higher is better
+COMPARED_METRICS = {
+    'update_steps_per_sec': True,
+    'predict_samples_per_sec': True,
+    'peak_rss_mb': False
+}
+
+
+def random_minibatches(dataset_class, batch_size, n_domains, num_classes):
+    return [(torch.randn(batch_size, *dataset_class.INPUT_SHAPE),
+        torch.randint(0, num_classes, (batch_size,)))
+        for _ in range(n_domains)]
+
+
+def median_time(fn, n):
+    times = []
+    for _ in range(n):
+        start_time = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start_time)
+    return float(np.median(times))
+
+
+def run_case(case, args):
+    """Measure one case; runs in a child process."""
+    torch.manual_seed(0)
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    result = dict(case)
+    try:
+        dataset_class = vars(datasets)[case['dataset']]
+        num_classes = 2
+        hparams = hparams_registry.default_hparams(case['algorithm'],
+            case['dataset'])
+        hparams['batch_size'] = case['batch_size']
+        start_rss = profiler.rss_gb()
+        algorithm = algorithms.get_algorithm_class(case['algorithm'])(
+            dataset_class.INPUT_SHAPE, num_classes, case['n_domains'],
+            hparams)
+        minibatches = random_minibatches(dataset_class, case['batch_size'],
+            case['n_domains'], num_classes)
+
+        def update():
+            algorithm.update(minibatches)
+
+        for _ in range(args.warmup):
+            update()
+        update_time = median_time(update, args.steps)
+
+        x = torch.cat([x for x, _ in minibatches])
+        def predict():
+            with torch.no_grad():
+                algorithm.predict(x)
+        algorithm.eval()
+        predict()
+        predict_time = median_time(predict, args.steps)
+        algorithm.train()
+
+        with torch.profiler.profile(
+                activities=[torch.profiler.ProfilerActivity.CPU],
+                profile_memory=True) as prof:
+            update()
+        allocations = [event.self_cpu_memory_usage for event in prof.events()
+            if event.self_cpu_memory_usage > 0]
+
+        result.update({
+            'update_steps_per_sec': 1. / update_time,
+            'update_ms': 1000. * update_time,
+            'predict_samples_per_sec': len(x) / predict_time,
+            'predict_ms': 1000. * predict_time,
+            'peak_rss_mb': 1024. * profiler.peak_rss_gb(),
+            'rss_increase_mb': 1024. * (profiler.peak_rss_gb() - start_rss),
+            'alloc_mb': sum(allocations) / (1024. * 1024.),
+            'allocs': len(allocations)
+        })
+    except Exception:
+        result['error'] = traceback.format_exc().strip().split('\n')[-1]
+    return result
+
+
+def _run_case_in_child(case, args, connection):
+    connection.send(run_case(case, args))
+    connection.close()
+
+
+def run_isolated(case, args):
+    """run_case in a forked process, so that every case has its own peak
+    RSS and a crash only fails that case: if the process dies (e.g. killed
+    for running out of memory), the case's error is its exit code."""
+    context = multiprocessing.get_context('fork')
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=_run_case_in_child,
+        args=(case, args, sender))
+    process.start()
+    # Only the child holds the sending end now, so recv() raises EOFError
+    # instead of blocking if the child dies
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        result = None
+    process.join()
+    receiver.close()
+    if result is None:
+        result = dict(case)
+        if process.exitcode is not None and process.exitcode < 0:
+            result['error'] = 'Process killed by signal {}'.format(
+                -process.exitcode)
+        else:
+            result['error'] = 'Process exited with code {}'.format(
+                process.exitcode)
+    return result
+
+
+def case_key(result):
+    return tuple(result[key] for key in CASE_KEYS)
+
+
+def compare(results, baseline, tolerance):
+    """Rows of (case, metric, baseline, current, relative change) for the
+    metrics that got worse by more than tolerance."""
+    baseline = {case_key(r): r for r in baseline['results']}
+    regressions = []
+    for result in results:
+        old = baseline.get(case_key(result))
+        if old is None or 'error' in result or 'error' in old:
+            continue
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            change = result[metric] / old[metric] - 1
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append((case_key(result), metric, old[metric],
+                    result[metric], change))
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Benchmark algorithm update() and predict() on CPU')
+    parser.add_argument('--algorithms', nargs='+',
+        default=algorithms.ALGORITHMS)
+    parser.add_argument('--datasets', nargs='+', default=['Debug28'],
+        choices=['Debug28', 'Debug224'])
+    parser.add_argument('--batch_sizes', type=int, nargs='+',
+        default=[8, 32])
+    parser.add_argument('--n_domains', type=int, nargs='+', default=[2, 3],
+        help='Numbers of training domains')
+    parser.add_argument('--steps', type=int, default=10,
+        help='Timed calls of update() and predict() per case')
+    parser.add_argument('--warmup', type=int, default=2)
+    parser.add_argument('--threads', type=int, default=None,
+        help='torch threads per case (default: torch default)')
+    parser.add_argument('--output', type=str, default=None,
+        help='Write the results to this JSON file')
+    parser.add_argument('--baseline', type=str, default=None,
+        help='Results JSON of an earlier run to compare with')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+        help='Relative change that counts as a regression')
+    args = parser.parse_args()
+
+    cases = [{'algorithm': algorithm, 'dataset': dataset,
+        'batch_size': batch_size, 'n_domains': n_domains}
+        for dataset in args.datasets
+        for algorithm in args.algorithms
+        for batch_size in args.batch_sizes
+        for n_domains in args.n_domains]
+
+    columns = CASE_KEYS + ['update_steps_per_sec', 'predict_samples_per_sec',
+        'peak_rss_mb', 'alloc_mb']
+    misc.print_row(columns, colwidth=16)
+    results = []
+    for case in cases:
+        result = run_isolated(case, args)
+        results.append(result)
+        if 'error' in result:
+            misc.print_row(case_key(result), colwidth=16)
+            print('\t' + result['error'])
+        else:
+            misc.print_row([result[key] for key in columns], colwidth=16)
+        sys.stdout.flush()
+
+    output = {
+        'environment': {
+            'python': sys.version.split(' ')[0],
+            'torch': torch.__version__,
+            'platform': platform.platform(),
+            'processor': platform.processor(),
+            'cpu_count': os.cpu_count(),
+            'threads': args.threads or torch.get_num_threads()
+        },
+        'config': {'steps': args.steps, 'warmup': args.warmup},
+        'results': results
+    }
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(output, f, indent=2)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        if baseline['environment'] != output['environment']:
+            print('Warning: the baseline ran in a different environment: '
+                '{}'.format(baseline['environment']))
+        regressions = compare(results, baseline, args.tolerance)
+        print('\n{} regressions (tolerance {:.0%})'.format(len(regressions),
+            args.tolerance))
+        for key, metric, old, new, change in regressions:
+            print('  {}: {} {:.4g} -> {:.4g} ({:+.1%})'.format(
+                ' '.join(map(str, key)), metric, old, new, change))
+        if regressions:
+            sys.exit(1)
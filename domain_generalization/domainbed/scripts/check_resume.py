@@ -0,0 +1,125 @@
+"""
+Check that a stopped and resumed training run matches an uninterrupted one.
+
+For every algorithm, train.py runs on Debug28 for --steps steps, once
+straight through and once stopped at --stop_step (which saves resume.pkl)
+and run again to resume. The two runs must write the same losses and
+accuracies to results.jsonl and save the same final model:
+
+python -m domainbed.scripts.check_resume --algorithms ERM Fish GroupDRO
+
+Exits with status 1 if any algorithm differs or fails.
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+import torch
+
+from domainbed import algorithms
+from domainbed.lib import misc
+
+# Keys of results.jsonl that legitimately differ between the two runs
+IGNORED_KEYS = ['args', 'eval_time', 'eval_times', 'loader_wait', 'mem_gb',
+    'profile', 'step_time']
+
+
+def train(output_dir, algorithm, args, stop_step=None):
+    command = [sys.executable, '-m', 'domainbed.scripts.train',
+        '--dataset', 'Debug28',
+        '--algorithm', algorithm,
+        '--data_dir', output_dir,
+        '--output_dir', output_dir,
+        '--test_envs', '0',
+        '--seed', str(args.seed),
+        '--steps', str(args.steps),
+        '--checkpoint_freq', str(args.checkpoint_freq)]
+    if stop_step is not None:
+        command += ['--stop_step', str(stop_step)]
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL)
+
+
+def read_run(output_dir):
+    with open(os.path.join(output_dir, 'results.jsonl')) as f:
+        records = [json.loads(line) for line in f]
+    for record in records:
+        for key in IGNORED_KEYS:
+            record.pop(key, None)
+    model_path = [os.path.join(output_dir, name)
+        for name in os.listdir(output_dir) if name.startswith('Debug28')]
+    model_dict = torch.load(model_path[0], map_location='cpu',
+        weights_only=False)['model_dict']
+    return records, model_dict
+
+
+def compare_runs(full, resumed):
+    """The differences between two read_run() outputs, as strings."""
+    differences = []
+    (full_records, full_model), (resumed_records, resumed_model) = (full,
+        resumed)
+    if len(full_records) != len(resumed_records):
+        differences.append('{} vs {} results'.format(len(full_records),
+            len(resumed_records)))
+    for full_record, resumed_record in zip(full_records, resumed_records):
+        for key in sorted(set(full_record) | set(resumed_record)):
+            if full_record.get(key) != resumed_record.get(key):
+                differences.append('step {} {}: {} vs {}'.format(
+                    full_record['step'], key, full_record.get(key),
+                    resumed_record.get(key)))
+    for key in sorted(set(full_model) | set(resumed_model)):
+        if (key not in full_model or key not in resumed_model or
+                not torch.equal(full_model[key], resumed_model[key])):
+            differences.append('model {}'.format(key))
+    return differences
+
+
+def check_algorithm(algorithm, args):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        full_dir = os.path.join(tmp_dir, 'full')
+        resumed_dir = os.path.join(tmp_dir, 'resumed')
+        train(full_dir, algorithm, args)
+        train(resumed_dir, algorithm, args, stop_step=args.stop_step)
+        if not os.path.exists(os.path.join(resumed_dir, 'resume.pkl')):
+            return ['no resume.pkl after --stop_step']
+        train(resumed_dir, algorithm, args)
+        return compare_runs(read_run(full_dir), read_run(resumed_dir))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Check that resumed training runs are exact')
+    parser.add_argument('--algorithms', nargs='+',
+        default=algorithms.ALGORITHMS)
+    parser.add_argument('--steps', type=int, default=6)
+    parser.add_argument('--stop_step', type=int, default=4,
+        help='Step the interrupted run stops at, between two checkpoints or '
+        'right after one')
+    parser.add_argument('--checkpoint_freq', type=int, default=2)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    misc.print_row(['algorithm', 'result'], colwidth=16)
+    failed = []
+    for algorithm in args.algorithms:
+        try:
+            differences = check_algorithm(algorithm, args)
+        except subprocess.CalledProcessError as e:
+            differences = ['train.py exited with status {}'.format(
+                e.returncode)]
+        misc.print_row([algorithm, 'differs' if differences else 'ok'],
+            colwidth=16)
+        for difference in differences[:10]:
+            print('\t' + difference)
+        sys.stdout.flush()
+        if differences:
+            failed.append(algorithm)
+
+    print('\n{} of {} algorithms differ or failed{}'.format(len(failed),
+        len(args.algorithms), ': ' + ' '.join(failed) if failed else ''))
+    if failed:
+        sys.exit(1)
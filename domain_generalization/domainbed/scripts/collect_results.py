@@ -17,17 +17,23 @@ import tqdm
 
 from domainbed import datasets
 from domainbed import algorithms
-from domainbed.lib import misc, reporting
+from domainbed.lib import misc, results_index
 from domainbed import model_selection
-from domainbed.lib.query import Q
 import warnings
 
-def format_mean(data, latex):
+def format_mean(data, latex, bootstrap_data=None):
     """Given a list of datapoints, return a string describing their mean and
-    standard error"""
+    standard error, or their mean and the 95% bootstrap confidence interval
+    of the mean if bootstrap_data holds the bootstrap samples of each
+    datapoint"""
     if len(data) == 0:
         return None, None, "X"
     mean = 100 * np.mean(list(data))
+    if bootstrap_data is not None:
+        low, high = 100 * np.percentile(np.mean(list(bootstrap_data), axis=0),
+            [2.5, 97.5])
+        return mean, (low, high), "{:.1f} [{:.1f}, {:.1f}]".format(mean, low,
+            high)
     err = 100 * np.std(list(data) / np.sqrt(len(data)))
     if latex:
         return mean, err, "{:.1f} $\\pm$ {:.1f}".format(mean, err)
@@ -65,19 +71,22 @@ def print_table(table, header_text, row_labels, col_labels, colwidth=10,
         print("\\end{tabular}}")
         print("\\end{center}")
 
-def print_results_tables(records, selection_method, latex):
-    """Given all records, print a results table for each dataset."""
-    grouped_records = reporting.get_grouped_records(records).map(lambda group:
-        { **group, "sweep_acc": selection_method.sweep_acc(group["records"]) }
-    ).filter(lambda g: g["sweep_acc"] is not None)
+def print_results_tables(record_table, selection_method, latex, bootstrap=0):
+    """Given the RecordTable of all records, print a results table for each
+    dataset. With bootstrap > 0, print 95% confidence intervals from that
+    many resamples of the hparams draws instead of standard errors."""
+    grouped_records = selection_method.sweep_accs(record_table, bootstrap)
+
+    def bootstrap_accs(groups):
+        return groups.select("bootstrap_accs") if bootstrap else None
 
     # read algorithm names and sort (predefined order)
-    alg_names = Q(records).select("args.algorithm").unique()
+    alg_names = record_table.algorithms
     alg_names = ([n for n in algorithms.ALGORITHMS if n in alg_names] +
         [n for n in alg_names if n not in algorithms.ALGORITHMS])
 
     # read dataset names and sort (lexicographic order)
-    dataset_names = Q(records).select("args.dataset").unique().sorted()
+    dataset_names = sorted(record_table.datasets)
     dataset_names = [d for d in datasets.DATASETS if d in dataset_names]
 
     for dataset in dataset_names:
@@ -90,12 +99,12 @@ def print_results_tables(records, selection_method, latex):
         for i, algorithm in enumerate(alg_names):
             means = []
             for j, test_env in enumerate(test_envs):
-                trial_accs = (grouped_records
-                    .filter_equals(
-                        "dataset, algorithm, test_env",
-                        (dataset, algorithm, test_env)
-                    ).select("sweep_acc"))
-                mean, err, table[i][j] = format_mean(trial_accs, latex)
+                trials = grouped_records.filter_equals(
+                    "dataset, algorithm, test_env",
+                    (dataset, algorithm, test_env)
+                )
+                mean, err, table[i][j] = format_mean(
+                    trials.select("sweep_acc"), latex, bootstrap_accs(trials))
                 means.append(mean)
             if None in means:
                 table[i][-1] = "X"
@@ -124,11 +133,16 @@ def print_results_tables(records, selection_method, latex):
             trial_averages = (grouped_records
                 .filter_equals("algorithm, dataset", (algorithm, dataset))
                 .group("trial_seed")
-                .map(lambda trial_seed, group:
-                    group.select("sweep_acc").mean()
-                )
+                .map(lambda trial_seed, group: {
+                    "sweep_acc": group.select("sweep_acc").mean(),
+                    "bootstrap_accs": np.mean(
+                        list(group.select("bootstrap_accs")), axis=0)
+                        if bootstrap else None
+                })
             )
-            mean, err, table[i][j] = format_mean(trial_averages, latex)
+            mean, err, table[i][j] = format_mean(
+                trial_averages.select("sweep_acc"), latex,
+                bootstrap_accs(trial_averages))
             means.append(mean)
         if None in means:
             table[i][-1] = "X"
@@ -147,13 +161,16 @@ if __name__ == "__main__":
         description="Domain generalization testbed")
     parser.add_argument("--input_dir", type=str, required=True)
     parser.add_argument("--latex", action="store_true")
+    parser.add_argument("--bootstrap", type=int, default=0,
+        help="Number of bootstrap resamples of the hparams draws of each "
+        "group for confidence intervals (default: standard errors)")
     args = parser.parse_args()
 
     results_file = "results.tex" if args.latex else "results.txt"
 
     sys.stdout = misc.Tee(os.path.join(args.input_dir, results_file), "w")
 
-    records = reporting.load_records(args.input_dir)
+    table = results_index.ResultsIndex(args.input_dir).update().table()
 
     if args.latex:
         print("\\documentclass{article}")
@@ -161,9 +178,9 @@ if __name__ == "__main__":
         print("\\usepackage{adjustbox}")
         print("\\begin{document}")
         print("\\section{Full DomainBed results}")
-        print("% Total records:", len(records))
+        print("% Total records:", len(table))
     else:
-        print("Total records:", len(records))
+        print("Total records:", len(table))
 
     SELECTION_METHODS = [
         model_selection.IIDAccuracySelectionMethod,
@@ -176,7 +193,8 @@ if __name__ == "__main__":
             print()
             print("\\subsection{{Model selection: {}}}".format(
                 selection_method.name))
-        print_results_tables(records, selection_method, args.latex)
+        print_results_tables(table, selection_method, args.latex,
+            args.bootstrap)
 
     if args.latex:
         print("\\end{document}")
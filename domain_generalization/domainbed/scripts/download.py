@@ -3,18 +3,37 @@
 from torchvision.datasets import MNIST
 import xml.etree.ElementTree as ET
 from zipfile import ZipFile
+import concurrent.futures
+import multiprocessing
+import collections
+import contextlib
 import argparse
+import hashlib
 import tarfile
 import shutil
+import fcntl
 import gdown
 import uuid
 import json
+import traceback
+import time
+import sys
 import os
 
+from domainbed import datasets
+
 # from wilds.datasets.camelyon17_dataset import Camelyon17Dataset
 # from wilds.datasets.fmow_dataset import FMoWDataset
 
 
+# Options of the preparation, set from the command line. With data_dir set,
+# completed stages are recorded in its manifest and skipped when run again.
+OPTIONS = argparse.Namespace(data_dir=None, archive_dir=None, offline=False,
+    workers=1, force=False)
+
+MANIFEST_NAME = "download_manifest.json"
+
+
 # utils #######################################################################
 
 def stage_path(data_dir, name):
@@ -26,25 +45,188 @@ def stage_path(data_dir, name):
     return full_path
 
 
-def download_and_extract(url, dst, remove=True):
-    gdown.download(url, dst, quiet=False)
-
-    if dst.endswith(".tar.gz"):
-        tar = tarfile.open(dst, "r:gz")
-        tar.extractall(os.path.dirname(dst))
+def move_extracted(src, dst):
+    """Rename the extracted directory src to dst, replacing dst (created
+    empty by stage_path, or prepared before when forced). Nothing to do if
+    src was already moved."""
+    if not os.path.exists(src) and os.listdir(dst):
+        return
+    shutil.rmtree(dst)
+    os.rename(src, dst)
+
+
+def parallel_map(fn, items):
+    """[fn(item) for item in items], in OPTIONS.workers processes."""
+    items = list(items)
+    if OPTIONS.workers <= 1 or len(items) <= 1:
+        return [fn(item) for item in items]
+    with concurrent.futures.ProcessPoolExecutor(
+            max_workers=min(OPTIONS.workers, len(items)),
+            mp_context=multiprocessing.get_context("fork")) as executor:
+        return list(executor.map(fn, items))
+
+
+def _chunks(items, n):
+    """items split into (at most) n interleaved chunks."""
+    return [items[i::n] for i in range(min(n, len(items)))]
+
+
+@contextlib.contextmanager
+def _manifest():
+    """
+    The manifest of OPTIONS.data_dir ({"files": ..., "stages": ...}), locked
+    against the other processes of the preparation. It is written back to a
+    temporary file and renamed into place on exit.
+    """
+    path = os.path.join(OPTIONS.data_dir, MANIFEST_NAME)
+    os.makedirs(OPTIONS.data_dir, exist_ok=True)
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        manifest = {"files": {}, "stages": {}}
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+        yield manifest
+        tmp_path = "{}.tmp{}".format(path, uuid.uuid4().hex)
+        with open(tmp_path, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp_path, path)
+
+
+def file_checksum(path):
+    """MD5 of the file at path. Recorded in the manifest with the size and
+    mtime of the file, so that a multi-GB archive is only hashed once."""
+    path = os.path.abspath(path)
+    st = os.stat(path)
+    stat = [st.st_size, st.st_mtime_ns]
+    if OPTIONS.data_dir is not None:
+        with _manifest() as manifest:
+            entry = manifest["files"].get(path)
+        if entry is not None and entry["stat"] == stat:
+            return entry["md5"]
+
+    h = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(16 * 1024 * 1024), b""):
+            h.update(block)
+
+    if OPTIONS.data_dir is not None:
+        with _manifest() as manifest:
+            manifest["files"][path] = {"stat": stat, "md5": h.hexdigest()}
+    return h.hexdigest()
+
+
+def stage_done(name, inputs=()):
+    """
+    Whether the manifest records the stage `name` as completed with the same
+    checksums of those `inputs` (files) that still exist: an archive removed
+    after its extraction does not make the extraction stale.
+    """
+    if OPTIONS.data_dir is None or OPTIONS.force:
+        return False
+    with _manifest() as manifest:
+        record = manifest["stages"].get(name)
+    if record is None:
+        return False
+    return all(record["inputs"].get(os.path.abspath(path)) ==
+               file_checksum(path) for path in inputs if os.path.exists(path))
+
+
+def run_stage(name, fn, inputs=()):
+    """Run fn() as the stage `name`, unless it is done (see stage_done), and
+    record it in the manifest with the checksums of its `inputs`."""
+    if stage_done(name, inputs):
+        print("{}: done".format(name))
+        return
+    print("{}: running".format(name))
+    start = time.time()
+    fn()
+    if OPTIONS.data_dir is not None:
+        checksums = {os.path.abspath(path): file_checksum(path)
+                     for path in inputs if os.path.exists(path)}
+        with _manifest() as manifest:
+            manifest["stages"][name] = {"inputs": checksums,
+                                        "seconds": time.time() - start}
+    print("{}: done in {:.0f}s".format(name, time.time() - start))
+
+
+def fetch(url, dst, download=True):
+    """
+    Path of the archive of url that is to be saved at dst: dst itself or a
+    file of the same name in OPTIONS.archive_dir if either exists (e.g. an
+    archive copied there by hand), else dst after downloading it (or dst,
+    missing, if not download).
+    """
+    if OPTIONS.archive_dir is not None:
+        path = os.path.join(OPTIONS.archive_dir, os.path.basename(dst))
+        if os.path.exists(path):
+            return path
+    if os.path.exists(dst) or not download:
+        return dst
+    if OPTIONS.offline:
+        raise RuntimeError("{} is missing and --offline is set; put it in {} "
+            "or in --archive_dir".format(os.path.basename(dst),
+            os.path.dirname(dst)))
+    # Downloaded under a temporary name, so that an interrupted download is
+    # not taken for the archive by the next run
+    tmp_path = dst + ".part"
+    gdown.download(url, tmp_path, quiet=False)
+    os.replace(tmp_path, dst)
+    return dst
+
+
+def _extract_zip_members(args):
+    path, dst_dir, members = args
+    with ZipFile(path, "r") as zf:
+        for member in members:
+            zf.extract(member, dst_dir)
+
+
+def extract_zip(path, dst_dir):
+    """Extract the zip file at path into dst_dir, with the files split
+    between OPTIONS.workers processes."""
+    with ZipFile(path, "r") as zf:
+        members = zf.infolist()
+    # The directories are created up front, so that the workers do not race
+    # to create them
+    for member in members:
+        name = os.path.normpath(member.filename)
+        if not (os.path.isabs(name) or name.startswith("..")):
+            directory = os.path.join(dst_dir, name if member.is_dir()
+                                     else os.path.dirname(name))
+            os.makedirs(directory, exist_ok=True)
+    files = [member.filename for member in members if not member.is_dir()]
+    parallel_map(_extract_zip_members, [(path, dst_dir, chunk)
+        for chunk in _chunks(files, max(1, OPTIONS.workers))])
+
+
+def extract(path, dst_dir):
+    if path.endswith(".tar.gz"):
+        tar = tarfile.open(path, "r:gz")
+        tar.extractall(dst_dir)
         tar.close()
 
-    if dst.endswith(".tar"):
-        tar = tarfile.open(dst, "r:")
-        tar.extractall(os.path.dirname(dst))
+    if path.endswith(".tar"):
+        tar = tarfile.open(path, "r:")
+        tar.extractall(dst_dir)
         tar.close()
 
-    if dst.endswith(".zip"):
-        zf = ZipFile(dst, "r")
-        zf.extractall(os.path.dirname(dst))
-        zf.close()
+    if path.endswith(".zip"):
+        extract_zip(path, dst_dir)
+
+
+def extract_stage(dst):
+    return "extract:" + os.path.relpath(dst, OPTIONS.data_dir or os.curdir)
+
+
+def download_and_extract(url, dst, remove=True):
+    name = extract_stage(dst)
+    # Not downloaded again once extracted, even if it was removed since
+    archive = fetch(url, dst, download=not stage_done(name))
+    run_stage(name, lambda: extract(archive, os.path.dirname(dst)),
+              inputs=[archive])
 
-    if remove:
+    if remove and os.path.exists(dst):
         os.remove(dst)
 
 
@@ -107,20 +289,19 @@ def download_vlcs(data_dir):
 def download_mnist(data_dir):
     # Original URL: http://yann.lecun.com/exdb/mnist/
     full_path = stage_path(data_dir, "MNIST")
-    MNIST(full_path, download=True)
+    MNIST(full_path, download=not OPTIONS.offline)
 
 
 # PACS ########################################################################
 
 def download_pacs(data_dir):
     # Original URL: http://www.eecs.qmul.ac.uk/~dl307/project_iccv2017
-    full_path = stage_path(data_dir, "PACS")
+    full_path = stage_path(data_dir, "pacs_data")
 
     download_and_extract("https://www.kaggle.com/api/v1/datasets/download/nickfratto/pacs-dataset",
                          os.path.join(data_dir, "PACS.zip"),remove=False)
 
-    os.rename(os.path.join(data_dir, "kfold"),
-              full_path)
+    move_extracted(os.path.join(data_dir, "kfold"), full_path)
 
 
 # Office-Home #################################################################
@@ -132,12 +313,17 @@ def download_office_home(data_dir):
     download_and_extract("https://drive.google.com/uc?id=1uY0pj7oFsjMxRwaD3Sxy0jgel0fsYXLC",
                          os.path.join(data_dir, "office_home.zip"))
 
-    os.rename(os.path.join(data_dir, "OfficeHomeDataset_10072016"),
-              full_path)
+    move_extracted(os.path.join(data_dir, "OfficeHomeDataset_10072016"),
+                   full_path)
+
 
 
 # DomainNET ###################################################################
 
+def _fetch(args):
+    return fetch(*args)
+
+
 def download_domain_net(data_dir):
     # Original URL: http://ai.bu.edu/M3SDA/
     full_path = stage_path(data_dir, "domain_net")
@@ -150,9 +336,15 @@ def download_domain_net(data_dir):
         "http://csr.bu.edu/ftp/visda/2019/multi-source/real.zip",
         "http://csr.bu.edu/ftp/visda/2019/multi-source/sketch.zip"
     ]
+    archives = [os.path.join(full_path, url.split("/")[-1]) for url in urls]
 
-    for url in urls:
-        download_and_extract(url, os.path.join(full_path, url.split("/")[-1]))
+    # The archives are downloaded in parallel, then extracted one at a time
+    # (each by all the workers)
+    parallel_map(_fetch, [(url, dst) for url, dst in zip(urls, archives)
+                          if not stage_done(extract_stage(dst))])
+
+    for url, dst in zip(urls, archives):
+        download_and_extract(url, dst)
 
     with open("domainbed/misc/domain_net_duplicates.txt", "r") as f:
         for line in f.readlines():
@@ -164,16 +356,22 @@ def download_domain_net(data_dir):
 
 # TerraIncognita ##############################################################
 
+def _link_files(files):
+    for src_path, dst_path in files:
+        if os.path.exists(dst_path):
+            continue
+        try:
+            os.link(src_path, dst_path)
+        except OSError:
+            shutil.copyfile(src_path, dst_path)
+
+
 def download_terra_incognita(data_dir):
     # Original URL: https://beerys.github.io/CaltechCameraTraps/
     # New URL: http://lila.science/datasets/caltech-camera-traps
 
     full_path = stage_path(data_dir, "terra_incognita")
 
-    #download_and_extract("https://storage.googleapis.com/public-datasets-lila/caltechcameratraps/eccv_18_all_images_sm.tar.gz",os.path.join(full_path, "eccv_18_all_images_sm.tar.gz"),remove = False)
-
-    #download_and_extract("https://storage.googleapis.com/public-datasets-lila/caltechcameratraps/eccv_18_annotations.tar.gz",os.path.join(full_path, "eccv_18_annotations.tar.gz"))
-
     include_locations = ["38", "46", "100", "43"]
 
     include_categories = [
@@ -185,10 +383,14 @@ def download_terra_incognita(data_dir):
     annotations_file = os.path.join(full_path, "eccv_18_annotation_files/train_annotations.json")
     destination_folder = full_path
 
-    stats = {}
+    # Only downloaded if they were not extracted by hand
+    if not os.path.exists(images_folder):
+        download_and_extract("https://storage.googleapis.com/public-datasets-lila/caltechcameratraps/eccv_18_all_images_sm.tar.gz",
+                             os.path.join(full_path, "eccv_18_all_images_sm.tar.gz"), remove=False)
 
-    if not os.path.exists(destination_folder):
-        os.mkdir(destination_folder)
+    if not os.path.exists(annotations_file):
+        download_and_extract("https://storage.googleapis.com/public-datasets-lila/caltechcameratraps/eccv_18_annotations.tar.gz",
+                             os.path.join(full_path, "eccv_18_annotations.tar.gz"))
 
     with open(annotations_file, "r") as f:
         data = json.load(f)
@@ -197,6 +399,11 @@ def download_terra_incognita(data_dir):
     for item in data['categories']:
         category_dict[item['id']] = item['name']
 
+    annotations = collections.defaultdict(list)
+    for annotation in data['annotations']:
+        annotations[annotation['image_id']].append(annotation)
+
+    files = []
     for image in data['images']:
         image_location = image['location']
 
@@ -206,39 +413,31 @@ def download_terra_incognita(data_dir):
         loc_folder = os.path.join(destination_folder,
                                   'location_' + str(image_location) + '/')
 
-        if not os.path.exists(loc_folder):
-            os.mkdir(loc_folder)
+        os.makedirs(loc_folder, exist_ok=True)
 
-        image_id = image['id']
         image_fname = image['file_name']
 
-        for annotation in data['annotations']:
-            if annotation['image_id'] == image_id:
-                if image_location not in stats:
-                    stats[image_location] = {}
-
-                category = category_dict[annotation['category_id']]
+        for annotation in annotations[image['id']]:
+            category = category_dict[annotation['category_id']]
 
-                if category not in include_categories:
-                    continue
+            if category not in include_categories:
+                continue
 
-                if category not in stats[image_location]:
-                    stats[image_location][category] = 0
-                else:
-                    stats[image_location][category] += 1
+            loc_cat_folder = os.path.join(loc_folder, category + '/')
 
-                loc_cat_folder = os.path.join(loc_folder, category + '/')
+            os.makedirs(loc_cat_folder, exist_ok=True)
 
-                if not os.path.exists(loc_cat_folder):
-                    os.mkdir(loc_cat_folder)
+            dst_path = os.path.join(loc_cat_folder, image_fname)
+            src_path = os.path.join(images_folder, image_fname)
 
-                dst_path = os.path.join(loc_cat_folder, image_fname)
-                src_path = os.path.join(images_folder, image_fname)
+            files.append((src_path, dst_path))
 
-                shutil.copyfile(src_path, dst_path)
+    # Hard links rather than copies, since images_folder is removed below
+    parallel_map(_link_files, _chunks(files, max(1, OPTIONS.workers)))
 
     shutil.rmtree(images_folder)
-    os.remove(annotations_file)
+    # Its folder too, which would otherwise be taken for an environment
+    shutil.rmtree(os.path.dirname(annotations_file))
 
 
 # SVIRO #################################################################
@@ -250,21 +449,77 @@ def download_sviro(data_dir):
     download_and_extract("https://sviro.kl.dfki.de/?wpdmdl=1731",
                          os.path.join(data_dir, "sviro_grayscale_rectangle_classification.zip"))
 
-    os.rename(os.path.join(data_dir, "SVIRO_DOMAINBED"),
-              full_path)
+    move_extracted(os.path.join(data_dir, "SVIRO_DOMAINBED"), full_path)
+
+
+# Preparation of each dataset, by the name of its class in datasets.py (MNIST
+# is used by ColoredMNIST and RotatedMNIST)
+DATASETS = {
+    "MNIST": download_mnist,
+    "VLCS": download_vlcs,
+    "PACS": download_pacs,
+    "OfficeHome": download_office_home,
+    "DomainNet": download_domain_net,
+    "TerraIncognita": download_terra_incognita,
+    "SVIRO": download_sviro,
+}
+
+
+def prepare(args):
+    """
+    Prepare the dataset `name` (args is (name, image_cache)) in
+    OPTIONS.data_dir and, if image_cache, build the CachedImageFolder cache
+    of its environments that train.py reads with "image_cache": true.
+    Returns the traceback of the error, if any.
+    """
+    name, image_cache = args
+    try:
+        run_stage("prepare:" + name, lambda: DATASETS[name](OPTIONS.data_dir))
+        if image_cache and name != "MNIST":
+            # Skipped by CachedImageFolder if the cache is up to date
+            vars(datasets)[name](OPTIONS.data_dir, [],
+                {"data_augmentation": False, "image_cache": True})
+    except Exception:
+        return traceback.format_exc()
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description='Download datasets')
     parser.add_argument('--data_dir', type=str, required=True)
+    parser.add_argument('--datasets', nargs='+', choices=list(DATASETS),
+        default=['PACS', 'TerraIncognita'])
+    parser.add_argument('--archive_dir', type=str, default=None,
+        help='Directory of archives downloaded beforehand, used as they are')
+    parser.add_argument('--offline', action='store_true',
+        help='Fail instead of downloading missing archives')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+        help='Processes per dataset, for extraction and copies')
+    parser.add_argument('--jobs', type=int, default=1,
+        help='Datasets prepared at once')
+    parser.add_argument('--image_cache', action='store_true',
+        help='Also build the image cache of every image dataset')
+    parser.add_argument('--force', action='store_true',
+        help='Run every stage again, even if the manifest records it')
     args = parser.parse_args()
 
-    # download_mnist(args.data_dir)
-    download_pacs(args.data_dir)
-    # download_office_home(args.data_dir)
-    # download_domain_net(args.data_dir)
-    # download_vlcs(args.data_dir)
-    download_terra_incognita(args.data_dir)
-    # download_sviro(args.data_dir)
+    OPTIONS.data_dir = args.data_dir
+    OPTIONS.archive_dir = args.archive_dir
+    OPTIONS.offline = args.offline
+    OPTIONS.workers = args.workers
+    OPTIONS.force = args.force
+
+    jobs = [(name, args.image_cache) for name in args.datasets]
+    if args.jobs > 1 and len(jobs) > 1:
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs,
+                mp_context=multiprocessing.get_context("fork")) as executor:
+            errors = list(executor.map(prepare, jobs))
+    else:
+        errors = [prepare(job) for job in jobs]
+
+    for name, error in zip(args.datasets, errors):
+        if error:
+            print("Preparing {} failed:\n{}".format(name, error))
     # Camelyon17Dataset(root_dir=args.data_dir, download=True)
     # FMoWDataset(root_dir=args.data_dir, download=True)
+    if any(errors):
+        sys.exit(1)
@@ -0,0 +1,181 @@
+"""
+Export a trained domainbed checkpoint as a self-contained inference artifact.
+
+Example usage:
+python -m domainbed.scripts.export \
+    --input_dir outputs/LFME/LFME_te0
+
+This writes outputs/LFME/LFME_te0/export/model.pt (TorchScript) and
+outputs/LFME/LFME_te0/export/manifest.json. The artifact can be loaded with
+torch.jit.load without reconstructing any domainbed class.
+"""
+
+import argparse
+import json
+import os
+
+import torch
+import torch.nn as nn
+
+from domainbed import algorithms
+from domainbed import datasets
+from domainbed.scripts.train import RESUME_CHECKPOINT
+
+MANIFEST_NAME = 'manifest.json'
+
+IMAGENET_NORMALIZATION = {
+    'resize': [224, 224],
+    'mean': [0.485, 0.456, 0.406],
+    'std': [0.229, 0.224, 0.225],
+}
+
+
+class _Predictor(nn.Module):
+    """Exposes algorithm.predict() as forward() so that it can be traced."""
+    def __init__(self, algorithm):
+        super(_Predictor, self).__init__()
+        self.algorithm = algorithm
+
+    def forward(self, x):
+        return self.algorithm.predict(x)
+
+
+def find_checkpoint(input_dir):
+    """Return the final model checkpoint written by train.py in input_dir."""
+    candidates = sorted(f for f in os.listdir(input_dir)
+        if f.endswith('.pkl') and not f.startswith('model_step') and
+        f != RESUME_CHECKPOINT)
+    if not candidates:
+        raise FileNotFoundError(
+            'No model checkpoint (*.pkl) found in {}{}'.format(input_dir,
+            ' (only {}: the run has not finished)'.format(RESUME_CHECKPOINT)
+            if os.path.exists(os.path.join(input_dir, RESUME_CHECKPOINT))
+            else ''))
+    return os.path.join(input_dir, candidates[-1])
+
+
+def load_algorithm(checkpoint_path, device='cpu'):
+    """Rebuild the algorithm stored in a train.py checkpoint.
+
+    Returns the algorithm and the checkpoint dict."""
+    ckpt = torch.load(checkpoint_path, map_location=device, weights_only=False)
+    algorithm_class = algorithms.get_algorithm_class(ckpt['args']['algorithm'])
+    algorithm = algorithm_class(ckpt['model_input_shape'],
+        ckpt['model_num_classes'], ckpt['model_num_domains'],
+        ckpt['model_hparams'])
+    algorithm.load_state_dict(ckpt['model_dict'])
+    return algorithm, ckpt
+
+
+def predict_module(algorithm):
+    """Return an nn.Module in eval mode whose forward() is algorithm.predict().
+
+    LFME keeps its experts and target network in plain lists, which are not
+    registered as submodules, so its predict target network[-1] is returned
+    directly."""
+    if isinstance(getattr(algorithm, 'network', None), list):
+        module = algorithm.network[-1]
+    else:
+        module = _Predictor(algorithm)
+    return module.eval()
+
+
+def dataset_classes(ckpt):
+    """Class names of the checkpoint's dataset, or None if unavailable."""
+    dataset_name = ckpt['args']['dataset']
+    dataset_class = datasets.get_dataset_class(dataset_name)
+    if not issubclass(dataset_class, datasets.MultipleEnvironmentImageFolder):
+        return None
+    try:
+        dataset = dataset_class(ckpt['args']['data_dir'],
+            ckpt['args']['test_envs'], ckpt['model_hparams'])
+    except (OSError, IndexError):
+        return None
+    return list(dataset.datasets[-1].classes)
+
+
+def dataset_normalization(dataset_name):
+    dataset_class = datasets.get_dataset_class(dataset_name)
+    if issubclass(dataset_class, (datasets.MultipleEnvironmentImageFolder,
+            datasets.WILDSDataset)):
+        return IMAGENET_NORMALIZATION
+    return None
+
+
+def save_artifact(module, ckpt, output_dir, fmt='torchscript', classes=None,
+        **manifest_extra):
+    """Trace module and write it to output_dir together with a manifest."""
+    input_shape = tuple(ckpt['model_input_shape'])
+    example = torch.randn(1, *input_shape)
+
+    os.makedirs(output_dir, exist_ok=True)
+    with torch.no_grad():
+        if fmt == 'torchscript':
+            model_file = 'model.pt'
+            traced = torch.jit.trace(module, example)
+            traced.save(os.path.join(output_dir, model_file))
+        elif fmt == 'onnx':
+            model_file = 'model.onnx'
+            torch.onnx.export(module, example,
+                os.path.join(output_dir, model_file),
+                input_names=['input'], output_names=['logits'],
+                dynamic_axes={'input': {0: 'batch'}, 'logits': {0: 'batch'}})
+        else:
+            raise ValueError('Unknown export format: {}'.format(fmt))
+
+    if classes is None:
+        classes = dataset_classes(ckpt)
+    if classes is None:
+        classes = [str(i) for i in range(ckpt['model_num_classes'])]
+
+    manifest = {
+        'format': fmt,
+        'file': model_file,
+        'algorithm': ckpt['args']['algorithm'],
+        'dataset': ckpt['args']['dataset'],
+        'test_envs': ckpt['args']['test_envs'],
+        'input_shape': list(input_shape),
+        'num_classes': ckpt['model_num_classes'],
+        'num_domains': ckpt['model_num_domains'],
+        'hparams': ckpt['model_hparams'],
+        'classes': classes,
+        'normalization': dataset_normalization(ckpt['args']['dataset']),
+        **manifest_extra
+    }
+    with open(os.path.join(output_dir, MANIFEST_NAME), 'w') as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+
+    return manifest
+
+
+def export(checkpoint_path, output_dir, fmt='torchscript', classes=None):
+    """Trace the checkpoint's predict path and write it with a manifest."""
+    algorithm, ckpt = load_algorithm(checkpoint_path)
+    return save_artifact(predict_module(algorithm), ckpt, output_dir, fmt,
+        classes, source_checkpoint=os.path.abspath(checkpoint_path))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Export a trained model for inference')
+    parser.add_argument('--input_dir', type=str, required=True,
+        help='Output directory of a domainbed.scripts.train run')
+    parser.add_argument('--checkpoint', type=str, default=None,
+        help='Checkpoint file name inside input_dir (default: final model)')
+    parser.add_argument('--output_dir', type=str, default=None,
+        help='Where to write the artifact (default: input_dir/export)')
+    parser.add_argument('--format', type=str, default='torchscript',
+        choices=['torchscript', 'onnx'])
+    parser.add_argument('--classes', type=str, nargs='+', default=None,
+        help='Class names (default: read from the dataset directory)')
+    args = parser.parse_args()
+
+    if args.checkpoint is not None:
+        checkpoint_path = os.path.join(args.input_dir, args.checkpoint)
+    else:
+        checkpoint_path = find_checkpoint(args.input_dir)
+    output_dir = args.output_dir or os.path.join(args.input_dir, 'export')
+
+    manifest = export(checkpoint_path, output_dir, args.format, args.classes)
+    print('Exported {} ({}) to {}'.format(checkpoint_path, args.format,
+        os.path.join(output_dir, manifest['file'])))
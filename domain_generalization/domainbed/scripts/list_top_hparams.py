@@ -25,7 +25,7 @@ import tqdm
 
 from domainbed import datasets
 from domainbed import algorithms
-from domainbed.lib import misc, reporting
+from domainbed.lib import misc, reporting, results_index
 from domainbed import model_selection
 from domainbed.lib.query import Q
 import warnings
@@ -116,17 +116,11 @@ if __name__ == "__main__":
     parser.add_argument('--test_env', type=int, required=True)
     args = parser.parse_args()
 
-    records = reporting.load_records(args.input_dir)
+    index = results_index.ResultsIndex(args.input_dir).update()
+    records = index.records()
+    table = index.table()
     print("Total records:", len(records))
 
-    records = reporting.get_grouped_records(records)
-    records = records.filter(
-        lambda r:
-            r['dataset'] == args.dataset and
-            r['algorithm'] == args.algorithm and
-            r['test_env'] == args.test_env
-    )
-
     SELECTION_METHODS = [
         model_selection.IIDAccuracySelectionMethod,
         model_selection.LeaveOneOutSelectionMethod,
@@ -136,10 +130,16 @@ if __name__ == "__main__":
     for selection_method in SELECTION_METHODS:
         print(f'Model selection: {selection_method.name}')
 
-        for group in records:
+        groups = selection_method.sweep_hparams_accs(table).filter(
+            lambda g:
+                g['dataset'] == args.dataset and
+                g['algorithm'] == args.algorithm and
+                g['test_env'] == args.test_env
+        )
+        for group in groups:
             print(f"trial_seed: {group['trial_seed']}")
-            best_hparams = selection_method.hparams_accs(group['records'])
-            for run_acc, hparam_records in best_hparams:
+            for run_acc, rows in group['hparams_accs']:
+                hparam_records = Q([records[row] for row in rows])
                 print(f"\t{run_acc}")
                 for r in hparam_records:
                     assert(r['hparams'] == hparam_records[0]['hparams'])
@@ -0,0 +1,206 @@
+"""
+Post-training quantization of a trained domainbed model for CPU inference.
+
+Example usage:
+python -m domainbed.scripts.quantize \
+    --input_dir outputs/LFME/LFME_te0 --mode static
+
+Modes:
+    static        int8 weights and activations for the whole network, with
+                  observers calibrated on the held-out env*_out splits of the
+                  training environments.
+    dynamic       int8 weights for the Linear classifier, activations
+                  quantized on the fly.
+    dynamic_fp16  fp16 weights for the Linear classifier.
+
+The quantized network is written as a TorchScript artifact (default:
+input_dir/export_<mode>) with the same manifest as scripts/export.py, and the
+accuracy and throughput of the fp32 and quantized models on every env*_in /
+env*_out split are written to quantization_report.json next to it.
+"""
+
+import argparse
+import copy
+import json
+import os
+import time
+
+import torch
+import torch.nn as nn
+
+from domainbed import datasets
+from domainbed.lib import misc
+from domainbed.lib.fast_data_loader import FastDataLoader
+from domainbed.scripts import export
+
+QUANTIZATION_MODES = ['static', 'dynamic', 'dynamic_fp16']
+
+
+def _quantized_engine():
+    for engine in ['x86', 'fbgemm', 'qnnpack']:
+        if engine in torch.backends.quantized.supported_engines:
+            return engine
+    raise RuntimeError('No quantized engine available in this PyTorch build')
+
+
+def quantize_static(module, calibration_loader, input_shape,
+        calibration_batches):
+    """FX graph mode int8 quantization, calibrated on calibration_loader."""
+    from torch.ao.quantization import get_default_qconfig_mapping
+    from torch.ao.quantization.quantize_fx import convert_fx, prepare_fx
+
+    engine = _quantized_engine()
+    torch.backends.quantized.engine = engine
+    example = (torch.randn(1, *input_shape),)
+    prepared = prepare_fx(copy.deepcopy(module).eval(),
+        get_default_qconfig_mapping(engine), example)
+    with torch.no_grad():
+        for i, (x, _) in enumerate(calibration_loader):
+            if i >= calibration_batches:
+                break
+            prepared(x)
+    return convert_fx(prepared)
+
+
+def quantize_dynamic(module, dtype):
+    """Dynamic quantization of the Linear layers (the classifier)."""
+    from torch.ao.quantization import quantize_dynamic as _quantize_dynamic
+    torch.backends.quantized.engine = _quantized_engine()
+    return _quantize_dynamic(copy.deepcopy(module).eval(), {nn.Linear},
+        dtype=dtype)
+
+
+def accuracy(module, loader):
+    correct = 0
+    total = 0
+    with torch.no_grad():
+        for x, y in loader:
+            p = module(x)
+            if p.size(1) == 1:
+                correct += p.gt(0).eq(y.view(-1, 1)).sum().item()
+            else:
+                correct += p.argmax(1).eq(y).sum().item()
+            total += len(x)
+    return correct / total
+
+
+def throughput(module, input_shape, batch_size, n_iters=10):
+    """Samples per second of module on random CPU inputs."""
+    x = torch.randn(batch_size, *input_shape)
+    with torch.no_grad():
+        module(x)
+        start = time.time()
+        for _ in range(n_iters):
+            module(x)
+    return batch_size * n_iters / (time.time() - start)
+
+
+def make_splits(ckpt, data_dir):
+    """Rebuild the in/out splits used by train.py, without augmentation."""
+    args = ckpt['args']
+    hparams = dict(ckpt['model_hparams'], data_augmentation=False)
+    dataset = vars(datasets)[args['dataset']](data_dir, args['test_envs'],
+        hparams)
+    splits = []
+    for env_i, env in enumerate(dataset):
+        out, in_ = misc.split_dataset(env,
+            int(len(env) * args.get('holdout_fraction', 0.2)),
+            misc.seed_hash(args.get('trial_seed', 0), env_i))
+        splits.append(('env{}_in'.format(env_i), in_))
+        splits.append(('env{}_out'.format(env_i), out))
+    return dataset, splits
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Quantize a trained model for CPU inference')
+    parser.add_argument('--input_dir', type=str, required=True,
+        help='Output directory of a domainbed.scripts.train run')
+    parser.add_argument('--checkpoint', type=str, default=None,
+        help='Checkpoint file name inside input_dir (default: final model)')
+    parser.add_argument('--data_dir', type=str, default=None,
+        help='Dataset root (default: the data_dir the model was trained on)')
+    parser.add_argument('--mode', type=str, default='static',
+        choices=QUANTIZATION_MODES)
+    parser.add_argument('--calibration_batches', type=int, default=32)
+    parser.add_argument('--batch_size', type=int, default=32)
+    parser.add_argument('--output_dir', type=str, default=None,
+        help='Where to write the artifact (default: input_dir/export_<mode>)')
+    parser.add_argument('--skip_eval', action='store_true',
+        help='Only quantize and save; skip the accuracy-delta report')
+    args = parser.parse_args()
+
+    if args.checkpoint is not None:
+        checkpoint_path = os.path.join(args.input_dir, args.checkpoint)
+    else:
+        checkpoint_path = export.find_checkpoint(args.input_dir)
+    output_dir = args.output_dir or os.path.join(args.input_dir,
+        'export_' + args.mode)
+
+    algorithm, ckpt = export.load_algorithm(checkpoint_path)
+    fp32_module = export.predict_module(algorithm)
+    input_shape = tuple(ckpt['model_input_shape'])
+    test_envs = ckpt['args']['test_envs']
+
+    dataset, splits = None, []
+    if args.mode == 'static' or not args.skip_eval:
+        dataset, splits = make_splits(ckpt, args.data_dir or
+            ckpt['args']['data_dir'])
+
+    if args.mode == 'static':
+        # Calibrate on the training-domain validation data only
+        calibration_set = torch.utils.data.ConcatDataset([split
+            for name, split in splits if name.endswith('_out') and
+            int(name[3:-4]) not in test_envs])
+        calibration_loader = FastDataLoader(dataset=calibration_set,
+            batch_size=args.batch_size, num_workers=dataset.N_WORKERS)
+        quantized_module = quantize_static(fp32_module, calibration_loader,
+            input_shape, args.calibration_batches)
+    elif args.mode == 'dynamic':
+        quantized_module = quantize_dynamic(fp32_module, torch.qint8)
+    else:
+        quantized_module = quantize_dynamic(fp32_module, torch.float16)
+
+    export.save_artifact(quantized_module, ckpt, output_dir,
+        source_checkpoint=os.path.abspath(checkpoint_path),
+        quantization=args.mode)
+    print('Saved {} quantized model to {}'.format(args.mode, output_dir))
+
+    report = {
+        'mode': args.mode,
+        'checkpoint': os.path.abspath(checkpoint_path),
+        'throughput_fp32': {},
+        'throughput_quantized': {},
+    }
+    for batch_size in [1, args.batch_size]:
+        report['throughput_fp32'][batch_size] = throughput(fp32_module,
+            input_shape, batch_size)
+        report['throughput_quantized'][batch_size] = throughput(
+            quantized_module, input_shape, batch_size)
+
+    if not args.skip_eval:
+        for name, split in splits:
+            loader = FastDataLoader(dataset=split,
+                batch_size=args.batch_size, num_workers=dataset.N_WORKERS)
+            acc_fp32 = accuracy(fp32_module, loader)
+            acc_quantized = accuracy(quantized_module, loader)
+            report[name + '_acc_fp32'] = acc_fp32
+            report[name + '_acc_quantized'] = acc_quantized
+            report[name + '_acc_delta'] = acc_quantized - acc_fp32
+
+    keys = ['split', 'fp32', 'quantized', 'delta']
+    misc.print_row(keys, colwidth=12)
+    for name, _ in splits:
+        if name + '_acc_fp32' in report:
+            misc.print_row([name, report[name + '_acc_fp32'],
+                report[name + '_acc_quantized'], report[name + '_acc_delta']],
+                colwidth=12)
+    for batch_size in report['throughput_fp32']:
+        print('batch_size={}: {:.1f} -> {:.1f} samples/sec ({:.2f}x)'.format(
+            batch_size, report['throughput_fp32'][batch_size],
+            report['throughput_quantized'][batch_size],
+            report['throughput_quantized'][batch_size] /
+            report['throughput_fp32'][batch_size]))
+
+    with open(os.path.join(output_dir, 'quantization_report.json'), 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
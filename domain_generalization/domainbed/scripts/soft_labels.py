@@ -0,0 +1,136 @@
+"""
+Phase one of two-phase LFME: write the experts' soft labels for every example
+of the source environments to a memory-mapped store (see lib/soft_labels.py).
+
+The experts are either loaded from the checkpoint of an LFME run of train.py:
+
+python -m domainbed.scripts.soft_labels \
+    --input_dir outputs/LFME/LFME_te0 --output_dir soft_labels/PACS_te0
+
+or trained here on their own domains, without the target network:
+
+python -m domainbed.scripts.soft_labels --data_dir ./domainbed/data/ \
+    --dataset PACS --test_envs 0 --steps 5000 --output_dir soft_labels/PACS_te0
+
+Phase two trains only the target network against the stored soft labels:
+
+python -m domainbed.scripts.train --algorithm LFME --dataset PACS \
+    --test_envs 0 --hparams '{"lfme_soft_labels": "soft_labels/PACS_te0"}'
+
+Soft labels are computed on the non-augmented images.
+"""
+
+import argparse
+import json
+import os
+import time
+
+import torch
+
+from domainbed import algorithms
+from domainbed import datasets
+from domainbed import hparams_registry
+from domainbed.lib import misc
+from domainbed.lib import soft_labels
+from domainbed.lib.fast_data_loader import MultiEnvDataLoader
+from domainbed.scripts import export
+
+
+def train_experts(args, hparams, device):
+    """Train the LFME experts (only) for args.steps steps."""
+    dataset = vars(datasets)[args.dataset](args.data_dir, args.test_envs,
+        hparams)
+    train_splits, train_weights = [], []
+    for env_i, env in enumerate(dataset):
+        if env_i in args.test_envs:
+            continue
+        _, in_ = misc.split_dataset(env,
+            int(len(env)*args.holdout_fraction),
+            misc.seed_hash(args.trial_seed, env_i))
+        if hparams['class_balanced']:
+            weights = misc.make_weights_for_balanced_classes(in_)
+        else:
+            weights = None
+        train_splits.append(in_)
+        train_weights.append(weights)
+    train_loader = MultiEnvDataLoader(datasets=train_splits,
+        weights=train_weights, batch_size=hparams['batch_size'],
+        num_workers=dataset.N_WORKERS, device=device)
+
+    algorithm = algorithms.LFME(dataset.input_shape, dataset.num_classes,
+        len(dataset) - len(args.test_envs), hparams)
+    minibatches_iterator = iter(train_loader)
+    start_time = time.time()
+    for step in range(args.steps):
+        minibatches = next(minibatches_iterator)
+        if dataset.batch_augment is not None:
+            minibatches = [(dataset.batch_augment(x,
+                misc.seed_hash(args.seed, step, i)), *rest)
+                for i, (x, *rest) in enumerate(minibatches)]
+        algorithm.update_experts(minibatches)
+        if step % 100 == 0 or step == args.steps - 1:
+            print('step {}: {:.1f}s'.format(step, time.time() - start_time))
+    return algorithm
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description='Precompute LFME expert soft labels')
+    parser.add_argument('--output_dir', type=str, required=True)
+    parser.add_argument('--input_dir', type=str, default=None,
+        help='Output directory of an LFME run of train.py to read the '
+        'experts from')
+    parser.add_argument('--checkpoint', type=str, default=None,
+        help='Checkpoint file name inside input_dir (default: final model)')
+    parser.add_argument('--data_dir', type=str, default=None)
+    parser.add_argument('--dataset', type=str, default="PACS")
+    parser.add_argument('--test_envs', type=int, nargs='+', default=[0])
+    parser.add_argument('--hparams', type=str,
+        help='JSON-serialized hparams dict')
+    parser.add_argument('--trial_seed', type=int, default=0)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--holdout_fraction', type=float, default=0.2)
+    parser.add_argument('--steps', type=int, default=None,
+        help='Number of expert training steps. Default is dataset-dependent.')
+    parser.add_argument('--topk', type=int, default=5,
+        help='Number of probabilities stored per example')
+    parser.add_argument('--batch_size', type=int, default=64)
+    args = parser.parse_args()
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+
+    if args.input_dir is not None:
+        if args.checkpoint is not None:
+            checkpoint_path = os.path.join(args.input_dir, args.checkpoint)
+        else:
+            checkpoint_path = export.find_checkpoint(args.input_dir)
+        algorithm, ckpt = export.load_algorithm(checkpoint_path, device)
+        if ckpt['args']['algorithm'] != 'LFME' or 'model_experts' not in ckpt:
+            raise ValueError('{} does not contain LFME experts'.format(
+                checkpoint_path))
+        algorithm.load_expert_state_dicts(ckpt['model_experts'])
+        hparams = ckpt['model_hparams']
+        args.dataset = ckpt['args']['dataset']
+        args.test_envs = ckpt['args']['test_envs']
+        args.data_dir = args.data_dir or ckpt['args']['data_dir']
+    else:
+        hparams = hparams_registry.default_hparams('LFME', args.dataset)
+        if args.hparams:
+            hparams.update(json.loads(args.hparams))
+        hparams['lfme_soft_labels'] = None
+        args.steps = args.steps or vars(datasets)[args.dataset].N_STEPS
+        torch.manual_seed(args.seed)
+        algorithm = train_experts(args, hparams, device)
+
+    dataset = vars(datasets)[args.dataset](args.data_dir, args.test_envs,
+        dict(hparams, data_augmentation=False))
+    envs = [i for i in range(len(dataset)) if i not in args.test_envs]
+    start_time = time.time()
+    manifest = soft_labels.write_soft_labels(args.output_dir,
+        algorithm.network[:-1], envs, [dataset[i] for i in envs],
+        dataset.num_classes, args.topk, batch_size=args.batch_size,
+        num_workers=dataset.N_WORKERS, device=device, dataset=args.dataset,
+        test_envs=args.test_envs)
+    print('Wrote soft labels of {} examples to {} in {:.1f}s'.format(
+        sum(manifest['env_sizes']), args.output_dir,
+        time.time() - start_time))
@@ -5,9 +5,11 @@ Run sweeps
 """
 
 import argparse
+import collections
 import copy
 import getpass
 import hashlib
+import itertools
 import json
 import os
 import random
@@ -21,7 +23,9 @@ import torch
 from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms as algorithms
+from domainbed import model_selection
 from domainbed.lib import misc
+from domainbed.lib.query import Q
 from domainbed import command_launchers
 
 import tqdm
@@ -31,6 +35,7 @@ class Job:
     NOT_LAUNCHED = 'Not launched'
     INCOMPLETE = 'Incomplete'
     DONE = 'Done'
+    HALTED = 'Halted'
 
     def __init__(self, train_args, sweep_output_dir):
         args_str = json.dumps(train_args, sort_keys=True)
@@ -39,7 +44,7 @@ class Job:
 
         self.train_args = copy.deepcopy(train_args)
         self.train_args['output_dir'] = self.output_dir
-        command = ['python3.6', '-m', 'domainbed.scripts.train']
+        command = ['python', '-m', 'domainbed.scripts.train']
         for k, v in sorted(self.train_args.items()):
             if isinstance(v, list):
                 v = ' '.join([str(v_) for v_ in v])
@@ -50,6 +55,8 @@ class Job:
 
         if os.path.exists(os.path.join(self.output_dir, 'done')):
             self.state = Job.DONE
+        elif os.path.exists(os.path.join(self.output_dir, 'halted')):
+            self.state = Job.HALTED
         elif os.path.exists(self.output_dir):
             self.state = Job.INCOMPLETE
         else:
@@ -84,6 +91,136 @@ class Job:
             shutil.rmtree(job.output_dir)
         print(f'Deleted {len(jobs)} jobs!')
 
+def halving_rungs(min_steps, max_steps, eta, checkpoint_freq):
+    """Steps at which successive halving compares the runs: min_steps,
+    eta * min_steps, eta^2 * min_steps, ..., each moved up to the step after
+    the next checkpoint (k * checkpoint_freq + 1), so that a run stopped there
+    has just been evaluated, and finally max_steps."""
+    rungs = []
+    step = min_steps
+    while True:
+        rung = -(-(step - 1) // checkpoint_freq) * checkpoint_freq + 1
+        if rung >= max_steps:
+            break
+        if not rungs or rung > rungs[-1]:
+            rungs.append(rung)
+        step *= eta
+    return rungs + [max_steps]
+
+def run_val_acc(records, stop_step, last_step):
+    """Best training-domain validation accuracy over the checkpoints of a run
+    before stop_step, as IIDAccuracySelectionMethod computes it for runs with
+    a single test env, or None if the run has not reached its checkpoint at
+    last_step (the last one before stop_step)."""
+    records = records.filter(lambda r: r['step'] < stop_step)
+    if not len(records) or max(records.select('step')) < last_step:
+        return None
+    if len(records[0]['args']['test_envs']) == 1:
+        return model_selection.IIDAccuracySelectionMethod.run_acc(
+            records)['val_acc']
+    test_envs = records[0]['args']['test_envs']
+    return max(np.mean([acc for key, acc in r.items()
+        if key.startswith('env') and key.endswith('_out_acc') and
+        int(key[3:-8]) not in test_envs]) for r in records)
+
+def successive_halving(jobs, launcher_fn, eta, min_steps):
+    """
+    Train the jobs by successive halving. Every run of a (trial_seed, dataset,
+    algorithm, test_envs) group trains up to the first rung (see halving_rungs)
+    and stops with a resume checkpoint (train.py --stop_step). Only the top
+    1/eta of the group by training-domain validation accuracy are resumed up
+    to the next rung; the others are marked as halted. Runs that did not reach
+    a rung (e.g. they failed) are neither promoted nor halted. Calling this
+    again with the same jobs picks up where it stopped.
+    """
+    def max_steps(job):
+        return job.train_args.get('steps') or \
+            vars(datasets)[job.train_args['dataset']].N_STEPS
+
+    def checkpoint_freq(job):
+        return job.train_args.get('checkpoint_freq') or \
+            vars(datasets)[job.train_args['dataset']].CHECKPOINT_FREQ
+
+    def last_step(job, stop_step):
+        """The step of the last record of a run stopped at stop_step."""
+        if stop_step >= max_steps(job):
+            return max_steps(job) - 1
+        return (stop_step - 1) // checkpoint_freq(job) * checkpoint_freq(job)
+
+    def job_val_acc(job, stop_step):
+        return run_val_acc(load_job_records(job), stop_step,
+            last_step(job, stop_step))
+
+    def load_job_records(job):
+        records = []
+        try:
+            with open(os.path.join(job.output_dir, 'results.jsonl')) as f:
+                for line in f:
+                    records.append(json.loads(line))
+        except IOError:
+            pass
+        return Q(records)
+
+    groups = collections.defaultdict(list)
+    for job in jobs:
+        args = job.train_args
+        groups[(args['trial_seed'], args['dataset'], args['algorithm'],
+            tuple(args['test_envs']))].append(job)
+
+    promoted = list(jobs)
+    for rung in itertools.count():
+        stop_steps = {}
+        for job in promoted:
+            rungs = halving_rungs(min_steps, max_steps(job), eta,
+                checkpoint_freq(job))
+            if rung < len(rungs):
+                stop_steps[job] = rungs[rung]
+        if not stop_steps:
+            break
+
+        to_launch = [job for job in stop_steps if job.state == Job.NOT_LAUNCHED
+            or job.state == Job.INCOMPLETE and job_val_acc(
+                job, stop_steps[job]) is None]
+        print(f'Rung {rung}: {len(stop_steps)} runs, launching '
+            f'{len(to_launch)}.')
+        for job in to_launch:
+            os.makedirs(job.output_dir, exist_ok=True)
+        commands = []
+        for job in to_launch:
+            if stop_steps[job] < max_steps(job):
+                commands.append(f'{job.command_str} --stop_step '
+                    f'{stop_steps[job]}')
+            else:
+                commands.append(job.command_str)
+        if commands:
+            launcher_fn(commands)
+
+        promoted = []
+        for group_jobs in groups.values():
+            val_accs = {}
+            for job in group_jobs:
+                if job not in stop_steps:
+                    continue
+                val_acc = job_val_acc(job, stop_steps[job])
+                if val_acc is not None:
+                    val_accs[job] = val_acc
+            n_promoted = int(np.ceil(len(val_accs) / eta))
+            ranked = sorted(val_accs, key=lambda job: -val_accs[job])
+            for job in ranked[n_promoted:]:
+                if job.state not in [Job.DONE, Job.HALTED]:
+                    with open(os.path.join(job.output_dir, 'halted'), 'w') as f:
+                        f.write(str(stop_steps[job]))
+                    resume_path = os.path.join(job.output_dir, 'resume.pkl')
+                    if os.path.exists(resume_path):
+                        os.remove(resume_path)
+                    job.state = Job.HALTED
+            for job in ranked[:n_promoted]:
+                # Runs halted at a later rung of an earlier call stay in, so
+                # that every rung is decided among the same runs again
+                if job.state == Job.NOT_LAUNCHED:
+                    job.state = Job.INCOMPLETE
+                promoted.append(job)
+
 def all_test_env_combinations(n):
     """
     For a dataset with n >= 3 envs, return all combinations of 1 and 2 test
@@ -153,6 +290,11 @@ if __name__ == "__main__":
     parser.add_argument('--holdout_fraction', type=float, default=0.2)
     parser.add_argument('--single_test_envs', default=True, action='store_true')
     parser.add_argument('--skip_confirmation', default=True, action='store_true')
+    parser.add_argument('--halving_eta', type=int, default=None,
+        help='Launch by successive halving, keeping the best 1/eta of the '
+        'hparams of each dataset, algorithm and test env at each rung.')
+    parser.add_argument('--halving_min_steps', type=int, default=500,
+        help='Steps of the first successive-halving rung.')
     args = parser.parse_args()
 
     args_list = make_args_list(
@@ -173,14 +315,23 @@ if __name__ == "__main__":
 
     for job in jobs:
         print(job)
-    print("{} jobs: {} done, {} incomplete, {} not launched.".format(
+    print("{} jobs: {} done, {} incomplete, {} not launched, {} halted.".format(
         len(jobs),
         len([j for j in jobs if j.state == Job.DONE]),
         len([j for j in jobs if j.state == Job.INCOMPLETE]),
-        len([j for j in jobs if j.state == Job.NOT_LAUNCHED]))
+        len([j for j in jobs if j.state == Job.NOT_LAUNCHED]),
+        len([j for j in jobs if j.state == Job.HALTED]))
     )
 
-    if args.command == 'launch':
+    if args.command == 'launch' and args.halving_eta is not None:
+        print(f'About to run {len(jobs)} jobs by successive halving.')
+        if not args.skip_confirmation:
+            ask_for_confirmation()
+        launcher_fn = command_launchers.REGISTRY[args.command_launcher]
+        successive_halving(jobs, launcher_fn, args.halving_eta,
+            args.halving_min_steps)
+
+    elif args.command == 'launch':
         to_launch = [j for j in jobs if j.state == Job.NOT_LAUNCHED]
         print(f'About to launch {len(to_launch)} jobs.')
         if not args.skip_confirmation:
@@ -17,9 +17,21 @@ from domainbed import datasets
 from domainbed import hparams_registry
 from domainbed import algorithms as algorithms
 from domainbed.lib import misc
-from domainbed.lib.fast_data_loader import InfiniteDataLoader, FastDataLoader
-
-if __name__ == "__main__":
+from domainbed.lib.fast_data_loader import MultiEnvDataLoader, FastDataLoader
+from domainbed.lib.fast_data_loader import TensorBatchLoader, materialize_dataset
+from domainbed.lib.fast_data_loader import (ResidentDataLoader, dataset_nbytes,
+    dataset_tensors)
+from domainbed.lib.soft_labels import IndexedSplit, SoftLabelStore
+from domainbed.lib.batch_augment import BatchAugmentLoader
+from domainbed.lib.shards import ShardEvalLoader, StreamingDataLoader
+from domainbed.lib.shards import sharded_split
+from domainbed.lib.profiler import StepProfiler, NullProfiler
+
+# Written at every checkpoint, and read back to resume an interrupted run or
+# one stopped at --stop_step
+RESUME_CHECKPOINT = 'resume.pkl'
+
+def get_parser():
     parser = argparse.ArgumentParser(description='Domain generalization')
     parser.add_argument('--data_dir', default='./data/', type=str)
     parser.add_argument('--dataset', type=str, default="PACS")
@@ -46,14 +58,107 @@ if __name__ == "__main__":
         help="For domain adaptation, % of test to use unlabeled for training.")
     parser.add_argument('--skip_model_save', action='store_true')
     parser.add_argument('--save_model_every_checkpoint', action='store_true')
-    args = parser.parse_args()
+    parser.add_argument('--stop_step', type=int, default=None,
+        help='Stop at this step and save a checkpoint to resume from, without '
+        'finishing the run (used by successive-halving sweeps). The run is '
+        'not evaluated at this step unless it is a checkpoint.')
+    parser.add_argument('--prefetch_steps', type=int, default=2,
+        help='Number of training steps the data loader prefetches.')
+    parser.add_argument('--eval_batch_size', type=int, default=None,
+        help='Batch size of the eval loaders. Default is 64, or 1 for '
+        'algorithms whose predictions depend on the test batch.')
+    parser.add_argument('--eval_cache', action='store_true',
+        help='Transform each deterministic eval split once and keep it in '
+        'shared memory instead of decoding it at every checkpoint.')
+    parser.add_argument('--resident_data_gb', type=float, default=1.,
+        help='Keep the training splits on the device and sample minibatches '
+        'from them by index, when their transforms are deterministic and '
+        'they take at most this many GB (0 disables).')
+    parser.add_argument('--profile', action='store_true',
+        help='Time the phases of every step and write them, the throughput '
+        'and memory use to results.jsonl under "profile".')
+    parser.add_argument('--profile_trace', action='store_true',
+        help='With --profile, also write the phases to profile_trace.json '
+        '(Chrome trace format).')
+    return parser
+
+
+def load_dataset(args, hparams, dataset_cache=None):
+    """
+    Build the dataset of args. With a dataset_cache dict, datasets are reused
+    across calls (i.e. across the runs of an in-process sweep) when the
+    dataset, data_dir, test_envs and transform hparams match. Datasets whose
+    construction draws random numbers (e.g. the MNIST shuffles, which depend
+    on args.seed) are never reused.
+    """
+    if args.dataset not in vars(datasets):
+        raise NotImplementedError
+    key = (args.dataset, os.path.abspath(args.data_dir), tuple(args.test_envs),
+        hparams['data_augmentation'], hparams.get('image_cache', False),
+        hparams.get('batch_augment', False), hparams.get('mnist_store', False),
+        hparams.get('wilds_shards', False))
+    if dataset_cache is not None and key in dataset_cache:
+        dataset_cache[key] = dataset_cache.pop(key)
+        return dataset_cache[key]
+
+    rng_states = (random.getstate(), np.random.get_state()[1].copy(),
+        torch.get_rng_state())
+    dataset = vars(datasets)[args.dataset](args.data_dir, args.test_envs,
+        hparams)
+    deterministic = (rng_states[0] == random.getstate() and
+        np.array_equal(rng_states[1], np.random.get_state()[1]) and
+        torch.equal(rng_states[2], torch.get_rng_state()))
+    if dataset_cache is not None and deterministic:
+        dataset_cache[key] = dataset
+    return dataset
+
+
+def make_train_loader(args, hparams, dataset, envs, splits, device):
+    """
+    Loader of minibatches of the (split, weights) pairs of envs. The splits
+    are made resident on the device (ResidentDataLoader) when none of envs is
+    augmented and they fit in --resident_data_gb; otherwise they are read
+    through a MultiEnvDataLoader. Both yield the same minibatches. Splits of
+    WILDS shards (wilds_shards) that are not resident are streamed instead,
+    unless class_balanced weights require sampling by index.
+    """
+    weights = [env_weights for _, env_weights in splits]
+    resident = (args.resident_data_gb > 0 and
+        not any(env_i in dataset.augmented_envs for env_i in envs))
+    if resident:
+        nbytes = sum(dataset_nbytes(split) for split, _ in splits)
+        resident = nbytes <= args.resident_data_gb * 1024. * 1024. * 1024.
+    if resident:
+        return ResidentDataLoader(
+            tensors=[dataset_tensors(split, hparams['batch_size'],
+                dataset.N_WORKERS) for split, _ in splits],
+            weights=weights,
+            batch_size=hparams['batch_size'],
+            device=device)
+    sharded = [sharded_split(split) for split, _ in splits]
+    if (len(splits) and all(split is not None for split in sharded) and
+            all(env_weights is None for env_weights in weights)):
+        return StreamingDataLoader(
+            splits=sharded,
+            batch_size=hparams['batch_size'],
+            num_workers=dataset.N_WORKERS,
+            device=device,
+            prefetch=args.prefetch_steps)
+    return MultiEnvDataLoader(
+        datasets=[split for split, _ in splits],
+        weights=weights,
+        batch_size=hparams['batch_size'],
+        num_workers=dataset.N_WORKERS,
+        device=device,
+        prefetch=args.prefetch_steps)
 
+
+def main(args, dataset_cache=None):
     model_name=args.dataset+args.algorithm+args.task+str(args.seed)+str(args.steps)+str(args.test_envs)+".pkl"
 
-    # If we ever want to implement checkpointing, just persist these values
-    # every once in a while, and then load them from disk here.
+    # Overwritten below when resuming from RESUME_CHECKPOINT
     start_step = 0
-    algorithm_dict = None
+    resume_dict = None
 
     os.makedirs(args.output_dir, exist_ok=True)
     sys.stdout = misc.Tee(os.path.join(args.output_dir, 'out.txt'))
@@ -70,6 +175,26 @@ if __name__ == "__main__":
     for k, v in sorted(vars(args).items()):
         print('\t{}: {}'.format(k, v))
 
+    resume_path = os.path.join(args.output_dir, RESUME_CHECKPOINT)
+    if os.path.exists(resume_path):
+        resume_dict = torch.load(resume_path, map_location='cpu',
+            weights_only=False)
+        start_step = resume_dict['step']
+        print('Resuming from step {}'.format(start_step))
+
+    # Drop the records an earlier attempt wrote past the step we start from
+    epochs_path = os.path.join(args.output_dir, 'results.jsonl')
+    if os.path.exists(epochs_path):
+        with open(epochs_path) as f:
+            lines = f.readlines()
+        with open(epochs_path, 'w') as f:
+            for line in lines:
+                try:
+                    if json.loads(line)['step'] < start_step:
+                        f.write(line)
+                except ValueError:
+                    pass
+
     if args.hparams_seed == 0:
         hparams = hparams_registry.default_hparams(args.algorithm, args.dataset)
     else:
@@ -92,11 +217,7 @@ if __name__ == "__main__":
     else:
         device = "cpu"
 
-    if args.dataset in vars(datasets):
-        dataset = vars(datasets)[args.dataset](args.data_dir,
-            args.test_envs, hparams)
-    else:
-        raise NotImplementedError
+    dataset = load_dataset(args, hparams, dataset_cache)
 
     # Split each env into an 'in-split' and an 'out-split'. We'll train on
     # each in-split except the test envs, and evaluate on all splits.
@@ -113,6 +234,7 @@ if __name__ == "__main__":
     in_splits = []
     out_splits = []
     uda_splits = []
+    uda_envs = []
     for env_i, env in enumerate(dataset):
         uda = []
 
@@ -136,31 +258,63 @@ if __name__ == "__main__":
         out_splits.append((out, out_weights))
         if len(uda):
             uda_splits.append((uda, uda_weights))
+            uda_envs.append(env_i)
 
     if args.task == "domain_adaptation" and len(uda_splits) == 0:
         raise ValueError("Not enough unlabeled samples for domain adaptation.")
 
-    train_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
-        for i, (env, env_weights) in enumerate(in_splits)
-        if i not in args.test_envs]
+    # Two-phase LFME reads the experts' soft labels by example index
+    if hparams.get('lfme_soft_labels'):
+        SoftLabelStore(hparams['lfme_soft_labels']).check(args.dataset,
+            args.test_envs, [len(env) for env in dataset])
+        train_splits = [(IndexedSplit(env), env_weights)
+            for env, env_weights in in_splits]
+    else:
+        train_splits = in_splits
 
-    uda_loaders = [InfiniteDataLoader(
-        dataset=env,
-        weights=env_weights,
-        batch_size=hparams['batch_size'],
-        num_workers=dataset.N_WORKERS)
-        for i, (env, env_weights) in enumerate(uda_splits)
-        if i in args.test_envs]
-
-    eval_loaders = [FastDataLoader(
-        dataset=env,
-        batch_size=1,
-        num_workers=dataset.N_WORKERS)
-        for env, _ in (in_splits + out_splits + uda_splits)]
+    # One loader, with a single worker pool, for all the training envs
+    train_envs = [i for i in range(len(train_splits))
+        if i not in args.test_envs]
+    train_loader = make_train_loader(args, hparams, dataset, train_envs,
+        [train_splits[i] for i in train_envs], device)
+
+    if args.task == "domain_adaptation":
+        uda_indices = [i for i in range(len(uda_splits))
+            if i in args.test_envs]
+        uda_loader = make_train_loader(args, hparams, dataset,
+            [uda_envs[i] for i in uda_indices],
+            [uda_splits[i] for i in uda_indices], device)
+
+    if args.eval_batch_size is None:
+        # ARM and MTL pool over the test batch and ITTA adapts to it, so their
+        # accuracy depends on the eval batch size.
+        batch_dependent = (args.algorithm in ['ARM', 'MTL'] or
+            'ITTA' in args.algorithm)
+        args.eval_batch_size = 1 if batch_dependent else 64
+
+    eval_envs = list(range(len(in_splits))) + list(range(len(out_splits)))
+    eval_envs += uda_envs
+    eval_loaders = []
+    for env_i, (env, _) in zip(eval_envs, in_splits + out_splits + uda_splits):
+        # Splits of augmented envs go through their random transform at every
+        # evaluation, so only the deterministic ones can be cached.
+        if args.eval_cache and env_i not in dataset.augmented_envs:
+            x, y = materialize_dataset(env, args.eval_batch_size,
+                dataset.N_WORKERS)
+            eval_loaders.append(TensorBatchLoader(x, y, args.eval_batch_size))
+        elif sharded_split(env) is not None:
+            eval_loaders.append(ShardEvalLoader(env, args.eval_batch_size,
+                dataset.N_WORKERS))
+        else:
+            eval_loaders.append(FastDataLoader(
+                dataset=env,
+                batch_size=args.eval_batch_size,
+                num_workers=dataset.N_WORKERS))
+        if (dataset.batch_augment is not None and
+                env_i in dataset.augmented_envs):
+            eval_loaders[-1] = BatchAugmentLoader(eval_loaders[-1],
+                dataset.batch_augment, misc.seed_hash(args.seed, 'eval',
+                len(eval_loaders)))
     eval_weights = [None for _, weights in (in_splits + out_splits + uda_splits)]
     eval_loader_names = ['env{}_in'.format(i)
         for i in range(len(in_splits))]
@@ -173,19 +327,40 @@ if __name__ == "__main__":
     algorithm = algorithm_class(dataset.input_shape, dataset.num_classes,
         len(dataset) - len(args.test_envs), hparams)
 
-    if algorithm_dict is not None:
-        algorithm.load_state_dict(algorithm_dict)
-
     algorithm.to(device)
 
-    train_minibatches_iterator = zip(*train_loaders)
-    uda_minibatches_iterator = zip(*uda_loaders)
+    if resume_dict is not None:
+        algorithm.load_training_state_dict(resume_dict.pop('algorithm'))
+        train_loader.load_state_dict(resume_dict['train_loader'])
+        if args.task == "domain_adaptation":
+            uda_loader.load_state_dict(resume_dict['uda_loader'])
+
+    if args.profile:
+        trace_path = None
+        if args.profile_trace:
+            trace_path = os.path.join(args.output_dir, 'profile_trace.json')
+        profiler = StepProfiler(device, ['env{}'.format(i)
+            for i in range(len(in_splits)) if i not in args.test_envs],
+            trace_path)
+        train_loader.profiler = profiler
+    else:
+        profiler = NullProfiler()
+
+    train_minibatches_iterator = iter(train_loader)
+    if args.task == "domain_adaptation":
+        uda_minibatches_iterator = iter(uda_loader)
     checkpoint_vals = collections.defaultdict(lambda: [])
+    if resume_dict is not None:
+        checkpoint_vals.update(resume_dict.get('checkpoint_vals', {}))
 
     steps_per_epoch = min([len(env)/hparams['batch_size'] for env,_ in in_splits])
 
     n_steps = args.steps or dataset.N_STEPS
     checkpoint_freq = args.checkpoint_freq or dataset.CHECKPOINT_FREQ
+    if args.stop_step is not None:
+        stop_step = min(args.stop_step, n_steps)
+    else:
+        stop_step = n_steps
 
     # 保存最后的模型
     def save_checkpoint(filename):
@@ -199,22 +374,68 @@ if __name__ == "__main__":
             "model_hparams": hparams,
             "model_dict": algorithm.state_dict()
         }
+        if hasattr(algorithm, 'expert_state_dicts'):
+            save_dict["model_experts"] = algorithm.expert_state_dicts()
 
         torch.save(save_dict, os.path.join(args.output_dir, filename))
 
 
+    def save_resume_checkpoint(step):
+        save_dict = {
+            "args": vars(args),
+            "step": step,
+            "algorithm": algorithm.training_state_dict(),
+            "train_loader": train_loader.state_dict(),
+            # The step values since the last checkpoint, when stopped between
+            # two checkpoints
+            "checkpoint_vals": dict(checkpoint_vals),
+            "rng": {
+                "python": random.getstate(),
+                "numpy": np.random.get_state(),
+                "torch": torch.get_rng_state(),
+                "cuda": torch.cuda.get_rng_state_all()
+            }
+        }
+        if args.task == "domain_adaptation":
+            save_dict["uda_loader"] = uda_loader.state_dict()
+        # Write to a temporary file first, so that a job killed while saving
+        # keeps its previous checkpoint
+        tmp_path = resume_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            torch.save(save_dict, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, resume_path)
+
+    # The loaders above may have drawn from the RNGs, so restore them last
+    if resume_dict is not None:
+        random.setstate(resume_dict['rng']['python'])
+        np.random.set_state(resume_dict['rng']['numpy'])
+        torch.set_rng_state(resume_dict['rng']['torch'])
+        if torch.cuda.is_available():
+            torch.cuda.set_rng_state_all(resume_dict['rng']['cuda'])
+        resume_dict = None
+
     last_results_keys = None
-    for step in range(start_step, n_steps):
+    for step in range(start_step, stop_step):
         step_start_time = time.time()
-        minibatches_device = [(x.to(device), y.to(device))
-            for x,y in next(train_minibatches_iterator)]
+        with profiler.phase('data_wait'):
+            minibatches_device = next(train_minibatches_iterator)
+        if dataset.batch_augment is not None:
+            with profiler.phase('augment', cuda=True):
+                minibatches_device = [(dataset.batch_augment(x,
+                    misc.seed_hash(args.seed, step, i)), *rest)
+                    for i, (x, *rest) in enumerate(minibatches_device)]
         if args.task == "domain_adaptation":
-            uda_device = [x.to(device)
-                for x,_ in next(uda_minibatches_iterator)]
+            with profiler.phase('data_wait'):
+                uda_device = [x for x,_ in next(uda_minibatches_iterator)]
         else:
             uda_device = None
-        step_vals = algorithm.update(minibatches_device, uda_device)
+        checkpoint_vals['loader_wait'].append(time.time() - step_start_time)
+        with profiler.update():
+            step_vals = algorithm.update(minibatches_device, uda_device)
         checkpoint_vals['step_time'].append(time.time() - step_start_time)
+        profiler.step(minibatches_device, time.time() - step_start_time)
 
         for key, val in step_vals.items():
             checkpoint_vals[key].append(val)
@@ -231,12 +452,19 @@ if __name__ == "__main__":
             evals = zip(eval_loader_names, eval_loaders, eval_weights)
             #algorithm.init_testparams()
             algorithm.to(device)
-            for name, loader, weights in evals:
-                if 'ITTA' in args.algorithm:
-                    acc = misc.accuracy_tsc(algorithm, loader, weights, device)
-                else:
-                    acc = misc.accuracy(algorithm, loader, weights, device)
-                results[name+'_acc'] = acc
+            eval_times = {}
+            with profiler.phase('eval'):
+                for name, loader, weights in evals:
+                    eval_start_time = time.time()
+                    if 'ITTA' in args.algorithm:
+                        acc = misc.accuracy_tsc(algorithm, loader, weights,
+                            device)
+                    else:
+                        acc = misc.accuracy(algorithm, loader, weights, device)
+                    results[name+'_acc'] = acc
+                    eval_times[name] = time.time() - eval_start_time
+            results['eval_time'] = sum(eval_times.values())
+            profile = profiler.summary(algorithm, step)
 
             results['mem_gb'] = torch.cuda.max_memory_allocated() / (1024.*1024.*1024.)
 
@@ -248,23 +476,37 @@ if __name__ == "__main__":
                 colwidth=12)
 
             results.update({
+                'eval_times': eval_times,
                 'hparams': hparams,
                 'args': vars(args)
             })
+            if profile is not None:
+                results['profile'] = profile
 
-            epochs_path = os.path.join(args.output_dir, 'results.jsonl')
             with open(epochs_path, 'a') as f:
                 f.write(json.dumps(results, sort_keys=True) + "\n")
 
-            algorithm_dict = algorithm.state_dict()
-            start_step = step + 1
             checkpoint_vals = collections.defaultdict(lambda: [])
+            save_resume_checkpoint(step + 1)
 
             if args.save_model_every_checkpoint:
                 save_checkpoint(f'model_step{step}.pkl')
+        elif step == stop_step - 1:
+            # Not evaluated, so that a stopped and resumed run writes the same
+            # records and draws the same random numbers as an uninterrupted one
+            save_resume_checkpoint(step + 1)
+
 
+    if stop_step < n_steps:
+        return
 
     save_checkpoint(model_name)
+    if os.path.exists(resume_path):
+        os.remove(resume_path)
 
     with open(os.path.join(args.output_dir, 'done'), 'w') as f:
         f.write('done')
+
+
+if __name__ == "__main__":
+    main(get_parser().parse_args())
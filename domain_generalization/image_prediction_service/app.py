@@ -10,14 +10,15 @@ sys.path.insert(0, project_root)
 
 from flask import Flask, request, jsonify, render_template_string
 from flask_cors import CORS  # 添加CORS支持
-import tempfile
 import torch
 import numpy as np
 from torch.jit import script
 
 # 直接从本地predictor模块导入，避免domainbed模块导入问题
 try:
-    from predictor import predict_single_image
+    from predictor import (predict_multiple_models, preprocess_image_bytes,
+                           model_registry)
+    from scheduler import inference_scheduler
     print(f"成功导入predictor模块")
 except ImportError as e:
     print(f"导入predictor模块失败: {e}")
@@ -54,6 +55,8 @@ app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
 # 可用模型列表
 AVAILABLE_MODELS = ['LFME', 'ERM', 'CORAL', 'Mixup']
+# 可选的测试排除环境（PACS的4个域）
+TEST_ENVS = [0, 1, 2, 3]
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
@@ -89,18 +92,21 @@ def api_predict():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Unsupported file type'}), 400
         
-        # 创建临时文件进行预测
-        with tempfile.NamedTemporaryFile(suffix='.' + file.filename.rsplit('.', 1)[1].lower(), delete=False) as temp:
-            file.save(temp.name)
-            temp_path = temp.name
-        
         # 获取其他参数
         algorithm = request.form.get('algorithm', 'LFME')
-        test_excluded_env = int(request.form.get('seed', 0))  # 使用seed参数作为test_excluded_env
+        test_excluded_env = request.form.get('seed', '0')  # 使用seed参数作为test_excluded_env
+
+        # 调度器为每个(算法, 测试环境)创建一个常驻线程，只接受已知的组合
+        if algorithm not in AVAILABLE_MODELS:
+            return jsonify({'error': 'Unknown algorithm'}), 400
+        if test_excluded_env not in [str(te) for te in TEST_ENVS]:
+            return jsonify({'error': 'Invalid seed'}), 400
+        test_excluded_env = int(test_excluded_env)
         
         try:
-            # 调用预测函数
-            pred_class, probs = predict_single_image(temp_path, algorithm, test_excluded_env)
+            # 在内存中预处理图像，交给微批调度器与同一模型的其他请求合并推理
+            x = preprocess_image_bytes(file.read())
+            pred_class, probs = inference_scheduler.predict(x, algorithm, test_excluded_env)
 
             print(f"预测结果: pred_class={pred_class}, probs={probs}")
             
@@ -125,13 +131,6 @@ def api_predict():
         except Exception as e:
             print(f"预测错误: {str(e)}")
             return jsonify({'error': str(e)}), 500
-        finally:
-            # 确保删除临时文件
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except:
-                pass
         
     except Exception as e:
         print(f"请求处理错误: {str(e)}")
@@ -163,13 +162,11 @@ def api_predict_all():
         if not allowed_file(file.filename):
             return jsonify({'error': 'Unsupported file type'}), 400
         
-        # 创建临时文件进行预测
-        with tempfile.NamedTemporaryFile(suffix='.' + file.filename.rsplit('.', 1)[1].lower(), delete=False) as temp:
-            file.save(temp.name)
-            temp_path = temp.name
-        
         # 获取参数
-        test_excluded_env = int(request.form.get('seed', 1))
+        test_excluded_env = request.form.get('seed', '1')
+        if test_excluded_env not in [str(te) for te in TEST_ENVS]:
+            return jsonify({'error': 'Invalid seed'}), 400
+        test_excluded_env = int(test_excluded_env)
         
         # 获取选中的模型列表，支持多选
         selected_models = request.form.getlist('models')
@@ -191,34 +188,38 @@ def api_predict_all():
         
         try:
             results = []
-            
-            # 调用选中的模型进行预测
-            for algorithm in algorithms:
-                try:
-                    pred_class, probs = predict_single_image(temp_path, algorithm, test_excluded_env)
-                    
-                    # 类别名称映射
-                    category_names = ['dog', 'elephant', 'giraffe', 'guitar', 'horse', 'house', 'person']
-                    
-                    result = {
-                        'algorithm': algorithm,
-                        'predicted_class': int(pred_class),
-                        'predicted_class_name': category_names[int(pred_class)],
-                        'all_probabilities': [float(p) for p in probs] if not isinstance(probs, torch.Tensor) else [float(p) for p in probs.tolist()],
-                        'confidence': float(probs[int(pred_class)]),
-                        'status': 'success'
-                    }
-                    results.append(result)
-                    
-                    print(f"{algorithm}模型预测完成: {category_names[int(pred_class)]} (置信度: {float(probs[int(pred_class)]):.4f})")
-                    
-                except Exception as e:
-                    print(f"{algorithm}模型预测失败: {str(e)}")
+
+            # 图像只在内存中解码和归一化一次，所有模型共享同一个输入张量
+            x = preprocess_image_bytes(file.read())
+
+            # 调用选中的模型进行预测（并发执行，结构相同时堆叠成一次批量前向）
+            predictions = predict_multiple_models(x, algorithms, test_excluded_env)
+
+            # 类别名称映射
+            category_names = ['dog', 'elephant', 'giraffe', 'guitar', 'horse', 'house', 'person']
+
+            for algorithm, prediction in zip(algorithms, predictions):
+                if isinstance(prediction, Exception):
+                    print(f"{algorithm}模型预测失败: {str(prediction)}")
                     results.append({
                         'algorithm': algorithm,
-                        'error': str(e),
+                        'error': str(prediction),
                         'status': 'error'
                     })
+                    continue
+
+                pred_class, probs = prediction
+                result = {
+                    'algorithm': algorithm,
+                    'predicted_class': int(pred_class),
+                    'predicted_class_name': category_names[int(pred_class)],
+                    'all_probabilities': [float(p) for p in probs] if not isinstance(probs, torch.Tensor) else [float(p) for p in probs.tolist()],
+                    'confidence': float(probs[int(pred_class)]),
+                    'status': 'success'
+                }
+                results.append(result)
+
+                print(f"{algorithm}模型预测完成: {category_names[int(pred_class)]} (置信度: {float(probs[int(pred_class)]):.4f})")
             
             # 构建对比响应
             response = {
@@ -233,13 +234,6 @@ def api_predict_all():
         except Exception as e:
             print(f"多模型预测错误: {str(e)}")
             return jsonify({'error': str(e)}), 500
-        finally:
-            # 确保删除临时文件
-            try:
-                if os.path.exists(temp_path):
-                    os.unlink(temp_path)
-            except:
-                pass
         
     except Exception as e:
         print(f"请求处理错误: {str(e)}")
@@ -250,7 +244,12 @@ def health_check():
     """
     健康检查接口
     """
-    return jsonify({'status': 'healthy', 'service': 'image_prediction_service'})
+    return jsonify({
+        'status': 'healthy',
+        'service': 'image_prediction_service',
+        'model_cache': model_registry.stats(),
+        'inference_queue': inference_scheduler.stats()
+    })
 
 if __name__ == '__main__':
     # 开发环境使用，生产环境应使用WSGI服务器如Gunicorn
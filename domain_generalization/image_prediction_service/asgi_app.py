@@ -0,0 +1,280 @@
+import os
+import sys
+import asyncio
+import logging
+from concurrent.futures import ThreadPoolExecutor
+
+# 获取当前文件的绝对路径，确保能导入同目录下的predictor和scheduler
+current_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, current_dir)
+
+from starlette.applications import Starlette
+from starlette.exceptions import HTTPException
+from starlette.formparsers import MultiPartException, MultiPartParser
+from starlette.middleware import Middleware
+from starlette.middleware.cors import CORSMiddleware
+from starlette.responses import FileResponse, JSONResponse
+from starlette.routing import Mount, Route
+from starlette.staticfiles import StaticFiles
+
+from predictor import (predict_multiple_models, preprocess_image_bytes,
+                       model_registry)
+from scheduler import inference_scheduler
+
+logger = logging.getLogger("image_prediction_service")
+
+FRONTEND_DIR = os.path.join(current_dir, 'frontend_builded')
+# 允许的图片格式
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif'}
+# 可用模型列表
+AVAILABLE_MODELS = ['LFME', 'ERM', 'CORAL', 'Mixup']
+# 可选的测试排除环境（PACS的4个域）
+TEST_ENVS = [0, 1, 2, 3]
+# 类别名称映射
+CATEGORY_NAMES = ['dog', 'elephant', 'giraffe', 'guitar', 'horse', 'house', 'person']
+
+# 解码和多模型推理等CPU密集操作在有界线程池中执行，不阻塞事件循环
+cpu_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("ASGI_CPU_WORKERS", os.cpu_count() or 4)))
+# 同时处理中的预测请求上限，超过后直接返回429
+MAX_PENDING_REQUESTS = int(os.environ.get("ASGI_MAX_PENDING", 256))
+# 单个上传文件的大小上限（字节）
+MAX_UPLOAD_BYTES = int(os.environ.get("ASGI_MAX_UPLOAD_MB", 16)) * 1024 * 1024
+# 表单其他字段（algorithm、seed、models）和multipart分隔符的大小上限（字节）
+MAX_FORM_FIELDS_BYTES = 64 * 1024
+# 整个请求体的大小上限（字节）
+MAX_REQUEST_BYTES = MAX_UPLOAD_BYTES + MAX_FORM_FIELDS_BYTES
+
+
+class _PendingCounter:
+    """统计处理中的请求数，用于背压控制（只在事件循环线程中访问）"""
+    def __init__(self, limit):
+        self.limit = limit
+        self.pending = 0
+        self.rejected = 0
+
+    def try_acquire(self):
+        if self.pending >= self.limit:
+            self.rejected += 1
+            return False
+        self.pending += 1
+        return True
+
+    def release(self):
+        self.pending -= 1
+
+
+pending_requests = _PendingCounter(MAX_PENDING_REQUESTS)
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def _prediction_result(algorithm, pred_class, probs):
+    return {
+        'algorithm': algorithm,
+        'predicted_class': int(pred_class),
+        'predicted_class_name': CATEGORY_NAMES[int(pred_class)],
+        'all_probabilities': [float(p) for p in probs.tolist()],
+        'confidence': float(probs[int(pred_class)])
+    }
+
+
+class _UploadTooLarge(Exception):
+    pass
+
+
+class _InMemoryMultiPartParser(MultiPartParser):
+    """上传文件不超过MAX_REQUEST_BYTES，始终留在内存中，不会写入磁盘临时文件"""
+    spool_max_size = MAX_REQUEST_BYTES
+
+
+async def _capped_stream(request):
+    """逐块读取请求体，累计超过MAX_REQUEST_BYTES时立即中止"""
+    received = 0
+    async for chunk in request.stream():
+        received += len(chunk)
+        if received > MAX_REQUEST_BYTES:
+            raise _UploadTooLarge()
+        yield chunk
+
+
+async def _read_upload(request):
+    """
+    读取表单和上传文件到内存
+
+    先按Content-Length拒绝过大的请求，再边接收边计数，超过上限时不再继续读取
+
+    Returns:
+        (form, data, error_response)，出错时error_response不为None
+    """
+    too_large = JSONResponse({'error': 'File too large'}, status_code=413)
+    content_length = request.headers.get('content-length', '')
+    if content_length.isdigit() and int(content_length) > MAX_REQUEST_BYTES:
+        return None, None, too_large
+    if not request.headers.get('content-type', '').startswith('multipart/form-data'):
+        return None, None, JSONResponse({'error': 'No file uploaded'}, status_code=400)
+
+    parser = _InMemoryMultiPartParser(request.headers, _capped_stream(request),
+                                      max_part_size=MAX_FORM_FIELDS_BYTES)
+    try:
+        form = await parser.parse()
+    except _UploadTooLarge:
+        return None, None, too_large
+    except MultiPartException as e:
+        return None, None, JSONResponse({'error': e.message}, status_code=400)
+
+    file = form.get('file')
+    if file is None or isinstance(file, str):
+        return form, None, JSONResponse({'error': 'No file uploaded'}, status_code=400)
+    if file.filename == '':
+        return form, None, JSONResponse({'error': 'No file selected'}, status_code=400)
+    if not allowed_file(file.filename):
+        return form, None, JSONResponse({'error': 'Unsupported file type'}, status_code=400)
+    data = await file.read()
+    await form.close()
+    if len(data) > MAX_UPLOAD_BYTES:
+        return form, None, too_large
+    return form, data, None
+
+
+def _too_many_requests():
+    return JSONResponse({'error': 'Too many pending requests'}, status_code=429,
+                        headers={'Retry-After': '1'})
+
+
+async def api_predict(request):
+    """
+    API接口，处理图像上传并返回单个模型的JSON格式预测结果
+    """
+    if not pending_requests.try_acquire():
+        return _too_many_requests()
+    try:
+        form, data, error = await _read_upload(request)
+        if error is not None:
+            return error
+
+        algorithm = form.get('algorithm', 'LFME')
+        test_excluded_env = form.get('seed', '0')  # 使用seed参数作为test_excluded_env
+        # 调度器为每个(算法, 测试环境)创建一个常驻线程，只接受已知的组合
+        if algorithm not in AVAILABLE_MODELS:
+            return JSONResponse({'error': 'Unknown algorithm'}, status_code=400)
+        if test_excluded_env not in [str(te) for te in TEST_ENVS]:
+            return JSONResponse({'error': 'Invalid seed'}, status_code=400)
+        test_excluded_env = int(test_excluded_env)
+
+        try:
+            loop = asyncio.get_running_loop()
+            x = await loop.run_in_executor(cpu_executor, preprocess_image_bytes, data)
+            # 微批调度器返回concurrent.futures.Future，等待时不占用线程
+            pred_class, probs = await asyncio.wrap_future(
+                inference_scheduler.submit(x, algorithm, test_excluded_env))
+        except Exception as e:
+            logger.warning("预测错误: %s", e)
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+        return JSONResponse(_prediction_result(algorithm, pred_class, probs))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning("请求处理错误: %s", e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+    finally:
+        pending_requests.release()
+
+
+async def api_predict_all(request):
+    """
+    根据用户选择的模型进行预测，返回对比结果
+    """
+    if not pending_requests.try_acquire():
+        return _too_many_requests()
+    try:
+        form, data, error = await _read_upload(request)
+        if error is not None:
+            return error
+
+        test_excluded_env = form.get('seed', '1')
+        if test_excluded_env not in [str(te) for te in TEST_ENVS]:
+            return JSONResponse({'error': 'Invalid seed'}, status_code=400)
+        test_excluded_env = int(test_excluded_env)
+        selected_models = form.getlist('models')
+        # 处理models参数为'on'的情况，这通常是由于前端复选框没有正确设置value导致的
+        if selected_models == ['on'] or not selected_models:
+            algorithms = list(AVAILABLE_MODELS)
+        else:
+            algorithms = [model for model in selected_models if model in AVAILABLE_MODELS]
+            if not algorithms:
+                return JSONResponse({'error': 'No valid models selected'}, status_code=400)
+
+        try:
+            loop = asyncio.get_running_loop()
+            x = await loop.run_in_executor(cpu_executor, preprocess_image_bytes, data)
+            predictions = await loop.run_in_executor(
+                cpu_executor, predict_multiple_models, x, algorithms, test_excluded_env)
+        except Exception as e:
+            logger.warning("多模型预测错误: %s", e)
+            return JSONResponse({'error': str(e)}, status_code=500)
+
+        results = []
+        for algorithm, prediction in zip(algorithms, predictions):
+            if isinstance(prediction, Exception):
+                results.append({
+                    'algorithm': algorithm,
+                    'error': str(prediction),
+                    'status': 'error'
+                })
+            else:
+                results.append({**_prediction_result(algorithm, *prediction),
+                                'status': 'success'})
+
+        return JSONResponse({
+            'comparison_results': results,
+            'total_models': len(algorithms),
+            'successful_models': len([r for r in results if r['status'] == 'success'])
+        })
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.warning("请求处理错误: %s", e)
+        return JSONResponse({'error': str(e)}, status_code=500)
+    finally:
+        pending_requests.release()
+
+
+async def health_check(request):
+    """
+    健康检查接口
+    """
+    return JSONResponse({
+        'status': 'healthy',
+        'service': 'image_prediction_service',
+        'model_cache': model_registry.stats(),
+        'inference_queue': inference_scheduler.stats(),
+        'pending_requests': pending_requests.pending,
+        'rejected_requests': pending_requests.rejected,
+    })
+
+
+async def serve_frontend(request):
+    return FileResponse(os.path.join(FRONTEND_DIR, 'index.html'))
+
+
+routes = [
+    Route('/', serve_frontend),
+    Route('/index', serve_frontend),
+    Route('/image-prediction', serve_frontend),
+    Route('/api/predict', api_predict, methods=['POST']),
+    Route('/api/predict-all', api_predict_all, methods=['POST']),
+    Route('/health', health_check, methods=['GET']),
+]
+if os.path.isdir(FRONTEND_DIR):
+    routes.append(Mount('/', app=StaticFiles(directory=FRONTEND_DIR)))
+
+app = Starlette(
+    routes=routes,
+    middleware=[Middleware(CORSMiddleware, allow_origins=['*'],
+                           allow_methods=['*'], allow_headers=['*'],
+                           expose_headers=['*'])],
+)
@@ -1,4 +1,11 @@
+import io
 import os
+import json
+import time
+import threading
+import copy
+import collections
+from concurrent.futures import ThreadPoolExecutor
 import torch
 import torch.nn as nn
 import torchvision
@@ -6,6 +13,11 @@ from torchvision import transforms
 from PIL import Image
 import numpy as np
 
+# export脚本写出的manifest文件名
+EXPORT_MANIFEST = "manifest.json"
+# 导出产物所在的子目录；设为export_static / export_dynamic即可使用quantize脚本生成的量化模型
+EXPORT_SUBDIR = os.environ.get("MODEL_EXPORT_SUBDIR", "export")
+
 # 设备配置
 device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
@@ -28,22 +40,42 @@ def preprocess_image(image_path):
     x = x.unsqueeze(0)
     return x.to(device, non_blocking=True)
 
-def find_ckpt_path(algo: str, te: int) -> str:
-    """查找模型检查点路径"""
+def preprocess_image_bytes(data):
+    """在内存中解码并预处理上传的图像字节，不经过临时文件"""
+    return preprocess_image(io.BytesIO(data))
+
+def _possible_run_dirs(algo, te):
+    """训练输出目录的可能位置"""
     # 使用基于当前文件目录的路径
     current_dir = os.path.dirname(os.path.abspath(__file__))
-    
-    # 尝试多种可能的路径
-    possible_paths = [
+    return [
         # 在Docker容器中的路径
-        os.path.join("/app", "outputs", algo, f"{algo}_te{te}", 
-                     f"PACS{algo}domain_generalization0None[{te}].pkl"),
+        os.path.join("/app", "outputs", algo, f"{algo}_te{te}"),
         # 在本地开发环境中的路径
-        os.path.join(current_dir, "..", "..", "outputs", algo, f"{algo}_te{te}", 
-                     f"PACS{algo}domain_generalization0None[{te}].pkl"),
+        os.path.join(current_dir, "..", "..", "outputs", algo, f"{algo}_te{te}"),
         # 在domain_generalization目录中的路径
-        os.path.join(current_dir, "..", "outputs", algo, f"{algo}_te{te}", 
-                     f"PACS{algo}domain_generalization0None[{te}].pkl")
+        os.path.join(current_dir, "..", "outputs", algo, f"{algo}_te{te}")
+    ]
+
+def find_export_manifest(algo, te):
+    """
+    查找domainbed.scripts.export导出的TorchScript产物，返回manifest.json路径
+
+    找不到时返回None，此时回退到原始检查点
+    """
+    for run_dir in _possible_run_dirs(algo, te):
+        export_dir = os.path.join(run_dir, EXPORT_SUBDIR)
+        if (os.path.isfile(os.path.join(export_dir, EXPORT_MANIFEST)) and
+                os.path.isfile(os.path.join(export_dir, "model.pt"))):
+            return os.path.join(export_dir, EXPORT_MANIFEST)
+    return None
+
+def find_ckpt_path(algo: str, te: int) -> str:
+    """查找模型检查点路径"""
+    # 尝试多种可能的路径
+    possible_paths = [
+        os.path.join(run_dir, f"PACS{algo}domain_generalization0None[{te}].pkl")
+        for run_dir in _possible_run_dirs(algo, te)
     ]
     
     # 检查每个可能的路径
@@ -125,6 +157,290 @@ def get_algorithm_class(algorithm_name):
     # 我们只需要加载正确的模型权重即可
     return AlgorithmBase
 
+def remap_state_dict(state_dict):
+    """
+    将domainbed保存的权重键映射到AlgorithmBase的命名
+
+    权重键可能包含"featurizer.network."、"network.0.network."或"0.network."前缀，
+    分类器可能是"network.1."或"1."前缀，统一映射到"network.network."和"classifier."
+    """
+    new_state_dict = {}
+    for key, value in state_dict.items():
+        # 映射"featurizer.network."前缀到"network.network."
+        if key.startswith("featurizer.network."):
+            new_key = key.replace("featurizer.network.", "network.network.")
+        # 映射"network.0.network."前缀到"network.network."
+        elif key.startswith("network.0.network."):
+            new_key = key.replace("network.0.network.", "network.network.")
+        # 映射"0.network."前缀到"network.network."
+        elif key.startswith("0.network."):
+            new_key = key.replace("0.network.", "network.network.")
+        # 映射分类器权重（"classifier.weight" -> "classifier.weight"）
+        elif key == "classifier.weight":
+            new_key = "classifier.weight"
+        elif key == "classifier.bias":
+            new_key = "classifier.bias"
+        # 映射分类器权重（"network.1.weight" -> "classifier.weight"）
+        elif key == "network.1.weight":
+            new_key = "classifier.weight"
+        elif key == "network.1.bias":
+            new_key = "classifier.bias"
+        # 映射分类器权重（"1.weight" -> "classifier.weight"）
+        elif key == "1.weight":
+            new_key = "classifier.weight"
+        elif key == "1.bias":
+            new_key = "classifier.bias"
+        else:
+            new_key = key
+        new_state_dict[new_key] = value
+    return new_state_dict
+
+def load_model(ckpt_path):
+    """
+    从检查点构建模型并切换到eval模式
+
+    Returns:
+        model: 已加载权重的模型
+        info: 检查点中的元信息（算法、输入形状、类别数、域数量、超参数）
+    """
+    # 加载检查点
+    ckpt = torch.load(ckpt_path, map_location=device)
+
+    # 提取模型参数
+    info = {
+        "algorithm": ckpt["args"]["algorithm"],
+        "input_shape": ckpt["model_input_shape"],
+        "num_classes": ckpt["model_num_classes"],
+        "num_domains": ckpt["model_num_domains"],
+        "hparams": ckpt["model_hparams"],
+    }
+
+    # 获取算法类
+    AlgorithmClass = get_algorithm_class(info["algorithm"])
+
+    # 创建模型
+    model = AlgorithmClass(
+        input_shape=info["input_shape"],
+        num_classes=info["num_classes"],
+        num_domains=info["num_domains"],
+        hparams=info["hparams"],
+    )
+
+    # 处理多专家网络权重（如LFME算法）并加载状态字典
+    model.load_state_dict(remap_state_dict(ckpt["model_dict"]))
+    model.to(device)
+    model.eval()
+    return model, info
+
+class ExportedModel(nn.Module):
+    """包装torch.jit.load得到的模块，提供与AlgorithmBase相同的predict接口"""
+    def __init__(self, module):
+        super(ExportedModel, self).__init__()
+        self.module = module
+
+    def forward(self, x):
+        return self.module(x)
+
+    def predict(self, x):
+        return self.forward(x)
+
+def load_exported_model(manifest_path):
+    """
+    加载导出的TorchScript产物，不需要重建任何Python模型类，也不需要映射权重键
+
+    Returns:
+        model: 已加载的模型
+        info: manifest中的元信息
+    """
+    with open(manifest_path, "r") as f:
+        manifest = json.load(f)
+    module = torch.jit.load(
+        os.path.join(os.path.dirname(manifest_path), manifest["file"]),
+        map_location=device)
+    model = ExportedModel(module)
+    model.eval()
+    info = {
+        "algorithm": manifest["algorithm"],
+        "input_shape": tuple(manifest["input_shape"]),
+        "num_classes": manifest["num_classes"],
+        "num_domains": manifest["num_domains"],
+        "hparams": manifest["hparams"],
+        "classes": manifest["classes"],
+    }
+    return model, info
+
+def _model_nbytes(model):
+    """模型参数和buffer占用的字节数"""
+    return sum(t.numel() * t.element_size()
+               for t in list(model.parameters()) + list(model.buffers()))
+
+class ModelRegistry:
+    """
+    进程级模型注册表，按(算法, 测试环境, 检查点mtime)缓存已加载的模型
+
+    每个检查点只加载一次，模型常驻内存并保持eval模式；超过数量上限或内存预算时
+    按LRU顺序淘汰。检查点文件被覆盖（mtime变化）后会自动重新加载。
+    """
+    def __init__(self, max_models=8, max_bytes=None, max_ensembles=2):
+        self.max_models = max_models
+        self.max_bytes = max_bytes
+        self.max_ensembles = max_ensembles
+        self._models = collections.OrderedDict()
+        self._lock = threading.Lock()
+        self._key_locks = collections.defaultdict(threading.Lock)
+        # 堆叠后的集成权重，键为参与集成的模型id元组
+        self._ensembles = collections.OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.load_count = 0
+        self.load_time_total = 0.0
+        self.load_time_max = 0.0
+
+    def get(self, algorithm_name, test_excluded_env):
+        """
+        返回(model, info)，必要时从磁盘加载
+
+        Raises:
+            FileNotFoundError: 找不到检查点文件
+        """
+        # 优先使用导出的TorchScript产物，没有时回退到训练检查点
+        manifest_path = find_export_manifest(algorithm_name, test_excluded_env)
+        if manifest_path is not None:
+            ckpt_path, loader = manifest_path, load_exported_model
+        else:
+            ckpt_path, loader = find_ckpt_path(algorithm_name, test_excluded_env), load_model
+        key = (algorithm_name, test_excluded_env, os.path.getmtime(ckpt_path))
+
+        with self._lock:
+            if key in self._models:
+                self._models.move_to_end(key)
+                self.hits += 1
+                return self._models[key][:2]
+            key_lock = self._key_locks[key]
+
+        # 同一个检查点只允许一个线程加载，其余线程等待后直接命中
+        with key_lock:
+            with self._lock:
+                if key in self._models:
+                    self._models.move_to_end(key)
+                    self.hits += 1
+                    return self._models[key][:2]
+                self.misses += 1
+
+            print(f"[INFO] 加载检查点: {ckpt_path}")
+            try:
+                start_time = time.time()
+                model, info = loader(ckpt_path)
+                load_time = time.time() - start_time
+                nbytes = _model_nbytes(model)
+
+                with self._lock:
+                    self.load_count += 1
+                    self.load_time_total += load_time
+                    self.load_time_max = max(self.load_time_max, load_time)
+                    # 同一模型的旧版本检查点已经失效
+                    for stale in [k for k in self._models if k[:2] == key[:2]]:
+                        del self._models[stale]
+                    self._models[key] = (model, info, nbytes)
+                    self._evict()
+            finally:
+                # 加载失败（如检查点损坏或未写完）时也要释放该键的锁，避免常驻
+                with self._lock:
+                    self._key_locks.pop(key, None)
+            return model, info
+
+    def _evict(self):
+        """按LRU顺序淘汰模型，直到满足数量和内存预算（至少保留最新的一个）"""
+        while len(self._models) > 1 and (
+                len(self._models) > self.max_models or
+                (self.max_bytes is not None and self.total_bytes() > self.max_bytes)):
+            key, (model, _, _) = self._models.popitem(last=False)
+            self.evictions += 1
+            for ensemble_key in [k for k in self._ensembles if id(model) in k]:
+                del self._ensembles[ensemble_key]
+            print(f"[INFO] 淘汰缓存模型: {key}")
+
+    def get_stacked(self, models):
+        """
+        返回一组同结构模型沿第0维堆叠后的(params, buffers, skeleton)，结果会被缓存
+
+        skeleton是放在meta设备上的模型副本，供functional_call使用，避免在
+        其他线程正在使用的模型上临时替换参数。缓存项持有模型引用，模型被淘汰时
+        对应的集成权重一并释放。
+        """
+        ensemble_key = tuple(id(model) for model in models)
+        with self._lock:
+            if ensemble_key in self._ensembles:
+                self._ensembles.move_to_end(ensemble_key)
+                return self._ensembles[ensemble_key][1]
+        params, buffers = torch.func.stack_module_state(models)
+        skeleton = copy.deepcopy(models[0]).to("meta")
+        stacked = (params, buffers, skeleton)
+        with self._lock:
+            self._ensembles[ensemble_key] = (models, stacked)
+            while len(self._ensembles) > self.max_ensembles:
+                self._ensembles.popitem(last=False)
+        return stacked
+
+    def total_bytes(self):
+        return sum(nbytes for _, _, nbytes in self._models.values())
+
+    def clear(self):
+        with self._lock:
+            self._models.clear()
+            self._ensembles.clear()
+
+    def stats(self):
+        """返回缓存命中/未命中/加载耗时等统计"""
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'loads': self.load_count,
+                'load_time_total_s': self.load_time_total,
+                'load_time_max_s': self.load_time_max,
+                'load_time_mean_s': self.load_time_total / max(self.load_count, 1),
+                'resident_models': [list(k[:2]) for k in self._models],
+                'resident_mb': self.total_bytes() / (1024. * 1024.),
+            }
+
+# 全局模型注册表，可通过环境变量调整缓存上限
+model_registry = ModelRegistry(
+    max_models=int(os.environ.get("MODEL_CACHE_SIZE", 8)),
+    max_bytes=(int(float(os.environ["MODEL_CACHE_MB"]) * 1024 * 1024)
+               if os.environ.get("MODEL_CACHE_MB") else None),
+)
+
+def mock_prediction(algorithm_name):
+    """找不到检查点时，基于算法名称返回模拟预测结果"""
+    # 使用模拟预测结果，基于算法名称生成不同的结果
+    # 模拟不同算法的预测行为
+    if algorithm_name == "LFME":
+        # LFME模型更可能正确识别大象
+        probs = torch.tensor([0.1, 0.65, 0.05, 0.05, 0.05, 0.05, 0.05])
+        pred_class = 1  # elephant
+    elif algorithm_name == "ERM":
+        # ERM模型可能识别为狗
+        probs = torch.tensor([0.4, 0.3, 0.1, 0.05, 0.05, 0.05, 0.05])
+        pred_class = 0  # dog
+    elif algorithm_name == "CORAL":
+        # CORAL模型可能识别为长颈鹿
+        probs = torch.tensor([0.2, 0.25, 0.35, 0.05, 0.05, 0.05, 0.05])
+        pred_class = 2  # giraffe
+    elif algorithm_name == "Mixup":
+        # Mixup模型可能识别为马
+        probs = torch.tensor([0.15, 0.2, 0.1, 0.05, 0.4, 0.05, 0.05])
+        pred_class = 4  # horse
+    else:
+        # 默认情况
+        probs = torch.tensor([0.25, 0.25, 0.1, 0.1, 0.1, 0.1, 0.1])
+        pred_class = 0  # dog
+    
+    print(f"[模拟预测] {algorithm_name}: 预测为 {['dog', 'elephant', 'giraffe', 'guitar', 'horse', 'house', 'person'][pred_class]}")
+    return pred_class, probs
+
 @torch.inference_mode()
 def predict_single_image(img_path, algorithm_name, test_excluded_env):
     """
@@ -143,69 +459,13 @@ def predict_single_image(img_path, algorithm_name, test_excluded_env):
         # 预处理图像
         x = preprocess_image(img_path)
 
-        # 查找检查点路径
-        ckpt_path = find_ckpt_path(algorithm_name, test_excluded_env)
-        
-        print(f"[INFO] 加载检查点: {ckpt_path}")
-        
-        # 加载检查点
-        ckpt = torch.load(ckpt_path, map_location=device)
-
-        # 提取模型参数
-        algorithm_name = ckpt["args"]["algorithm"]
-        input_shape = ckpt["model_input_shape"]
-        n_classes = ckpt["model_num_classes"]
-        num_domains = ckpt["model_num_domains"]
-        hparams = ckpt["model_hparams"]
-        state_dict = ckpt["model_dict"]
-
-        # 获取算法类
-        AlgorithmClass = get_algorithm_class(algorithm_name)
-
-        # 创建模型
-        model = AlgorithmClass(
-            input_shape=input_shape,
-            num_classes=n_classes,
-            num_domains=num_domains,
-            hparams=hparams,
-        )
-        
-        # 处理多专家网络权重（如LFME算法）
-        # 权重键可能包含"featurizer.network."前缀，需要正确映射到我们的网络结构
-        new_state_dict = {}
-        for key, value in state_dict.items():
-            # 映射"featurizer.network."前缀到"network.network."
-            if key.startswith("featurizer.network."):
-                new_key = key.replace("featurizer.network.", "network.network.")
-            # 映射"network.0.network."前缀到"network.network."
-            elif key.startswith("network.0.network."):
-                new_key = key.replace("network.0.network.", "network.network.")
-            # 映射"0.network."前缀到"network.network."
-            elif key.startswith("0.network."):
-                new_key = key.replace("0.network.", "network.network.")
-            # 映射分类器权重（"classifier.weight" -> "classifier.weight"）
-            elif key == "classifier.weight":
-                new_key = "classifier.weight"
-            elif key == "classifier.bias":
-                new_key = "classifier.bias"
-            # 映射分类器权重（"network.1.weight" -> "classifier.weight"）
-            elif key == "network.1.weight":
-                new_key = "classifier.weight"
-            elif key == "network.1.bias":
-                new_key = "classifier.bias"
-            # 映射分类器权重（"1.weight" -> "classifier.weight"）
-            elif key == "1.weight":
-                new_key = "classifier.weight"
-            elif key == "1.bias":
-                new_key = "classifier.bias"
-            else:
-                new_key = key
-            new_state_dict[new_key] = value
-        
-        # 加载状态字典
-        model.load_state_dict(new_state_dict)
-        model.to(device)
-        model.eval()
+        # 从注册表获取常驻模型（首次访问时加载检查点）
+        model, info = model_registry.get(algorithm_name, test_excluded_env)
+        algorithm_name = info["algorithm"]
+        input_shape = info["input_shape"]
+        n_classes = info["num_classes"]
+        num_domains = info["num_domains"]
+        hparams = info["hparams"]
         
         # 进行预测
         logits = model.predict(x)
@@ -240,37 +500,102 @@ def predict_single_image(img_path, algorithm_name, test_excluded_env):
 
     except FileNotFoundError as e:
         print(f"模型文件不存在，使用模拟预测: {e}")
-        # 使用模拟预测结果，基于算法名称生成不同的结果
-        # 模拟不同算法的预测行为
-        if algorithm_name == "LFME":
-            # LFME模型更可能正确识别大象
-            probs = torch.tensor([0.1, 0.65, 0.05, 0.05, 0.05, 0.05, 0.05])
-            pred_class = 1  # elephant
-        elif algorithm_name == "ERM":
-            # ERM模型可能识别为狗
-            probs = torch.tensor([0.4, 0.3, 0.1, 0.05, 0.05, 0.05, 0.05])
-            pred_class = 0  # dog
-        elif algorithm_name == "CORAL":
-            # CORAL模型可能识别为长颈鹿
-            probs = torch.tensor([0.2, 0.25, 0.35, 0.05, 0.05, 0.05, 0.05])
-            pred_class = 2  # giraffe
-        elif algorithm_name == "Mixup":
-            # Mixup模型可能识别为马
-            probs = torch.tensor([0.15, 0.2, 0.1, 0.05, 0.4, 0.05, 0.05])
-            pred_class = 4  # horse
-        else:
-            # 默认情况
-            probs = torch.tensor([0.25, 0.25, 0.1, 0.1, 0.1, 0.1, 0.1])
-            pred_class = 0  # dog
-        
-        print(f"[模拟预测] {algorithm_name}: 预测为 {['dog', 'elephant', 'giraffe', 'guitar', 'horse', 'house', 'person'][pred_class]}")
-        return pred_class, probs
+        return mock_prediction(algorithm_name)
 
     except Exception as e:
         print(f"预测过程中发生错误: {e}")
         # 返回错误信息而不是硬编码结果
         raise RuntimeError(f"模型预测失败: {e}")
 
+# 多模型推理使用的线程池，线程数可通过环境变量调整
+predict_executor = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("PREDICT_WORKERS", 4)))
+# 结构相同的模型是否堆叠成一次批量前向（设为0时始终并发执行各模型）
+STACKED_ENSEMBLE = os.environ.get("STACKED_ENSEMBLE", "1") != "0"
+
+def _same_architecture(models):
+    """判断多个模型的类型和所有权重形状是否一致，一致时可以堆叠成集成"""
+    if not all(isinstance(model, AlgorithmBase) for model in models):
+        return False
+
+    def signature(model):
+        return (type(model), [(k, tuple(v.shape), v.dtype)
+                              for k, v in model.state_dict().items()])
+    first = signature(models[0])
+    return all(signature(model) == first for model in models[1:])
+
+@torch.inference_mode()
+def _stacked_predict(models, x):
+    """将同结构模型的权重堆叠，用一次vmap前向得到所有模型的logits"""
+    params, buffers, skeleton = model_registry.get_stacked(models)
+
+    def call(p, b, x):
+        return torch.func.functional_call(skeleton, (p, b), (x,))
+
+    return torch.vmap(call, in_dims=(0, 0, None))(params, buffers, x)
+
+@torch.inference_mode()
+def _predict_logits(model, x):
+    return model.predict(x)
+
+def predict_multiple_models(x, algorithm_names, test_excluded_env):
+    """
+    用多个模型预测同一张已预处理的图像
+
+    图像只解码一次；检查点并发加载。所有模型结构相同时堆叠成一个批量集成，
+    只做一次前向；否则在线程池中并发执行各模型的前向。
+
+    Args:
+        x: preprocess_image / preprocess_image_bytes 的输出
+        algorithm_names: 算法名称列表
+        test_excluded_env: 测试排除环境
+
+    Returns:
+        与algorithm_names顺序一致的列表，每项为(pred_class, probs)或预测失败时的异常
+    """
+    results = {}
+    models = collections.OrderedDict()
+
+    # 并发获取模型（命中缓存时几乎没有开销）
+    futures = [(name, predict_executor.submit(
+                    model_registry.get, name, test_excluded_env))
+               for name in algorithm_names]
+    for name, future in futures:
+        try:
+            models[name] = future.result()[0]
+        except FileNotFoundError as e:
+            print(f"模型文件不存在，使用模拟预测: {e}")
+            results[name] = mock_prediction(name)
+        except Exception as e:
+            print(f"{name}模型加载失败: {e}")
+            results[name] = RuntimeError(f"模型预测失败: {e}")
+
+    names = list(models.keys())
+    logits = {}
+    if (STACKED_ENSEMBLE and len(names) > 1 and
+            _same_architecture(list(models.values()))):
+        try:
+            stacked_logits = _stacked_predict(list(models.values()), x)
+            logits = dict(zip(names, stacked_logits))
+        except Exception as e:
+            print(f"堆叠集成推理失败，改为并发推理: {e}")
+
+    if not logits:
+        futures = [(name, predict_executor.submit(_predict_logits, models[name], x))
+                   for name in names]
+        for name, future in futures:
+            try:
+                logits[name] = future.result()
+            except Exception as e:
+                print(f"{name}模型预测失败: {e}")
+                results[name] = RuntimeError(f"模型预测失败: {e}")
+
+    for name, model_logits in logits.items():
+        probs = torch.softmax(model_logits, dim=1)
+        results[name] = (probs.argmax(dim=1).item(), probs.squeeze().cpu())
+
+    return [results[name] for name in algorithm_names]
+
 # 测试函数
 if __name__ == "__main__":
     # 测试预测函数
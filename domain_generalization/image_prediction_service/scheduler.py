@@ -0,0 +1,129 @@
+import os
+import time
+import queue
+import threading
+import collections
+from concurrent.futures import Future
+
+import torch
+
+from predictor import model_registry, mock_prediction
+
+
+class InferenceScheduler:
+    """
+    动态微批推理调度器，位于app.py和predictor.py之间
+
+    同一模型（算法, 测试环境）的请求进入同一个队列，由该模型的后台线程在
+    max_wait_ms的时间窗口内最多收集max_batch_size个请求，拼接后只做一次
+    model.predict，再把每个样本的结果分发回等待中的请求。
+    """
+    def __init__(self, max_batch_size=8, max_wait_ms=5.0):
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.
+        self._queues = {}
+        self._lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self.requests = 0
+        self.batches = 0
+        self.max_queue_depth = 0
+        self.wait_time_total = 0.0
+        self.batch_sizes = collections.Counter()
+
+    def submit(self, x, algorithm_name, test_excluded_env):
+        """
+        提交一个已预处理的样本（形状为1xCxHxW），返回Future，结果为(pred_class, probs)
+
+        每个新的(algorithm_name, test_excluded_env)都会创建一个不退出的后台线程，
+        调用方需先校验这两个参数
+        """
+        key = (algorithm_name, test_excluded_env)
+        with self._lock:
+            if key not in self._queues:
+                self._queues[key] = queue.Queue()
+                worker = threading.Thread(target=self._worker, args=(key,),
+                                          name=f"inference-{algorithm_name}-{test_excluded_env}",
+                                          daemon=True)
+                worker.start()
+            request_queue = self._queues[key]
+
+        future = Future()
+        request_queue.put((x, future, time.time()))
+        with self._stats_lock:
+            self.requests += 1
+            self.max_queue_depth = max(self.max_queue_depth, request_queue.qsize())
+        return future
+
+    def predict(self, x, algorithm_name, test_excluded_env, timeout=None):
+        """同步版本的submit，阻塞直到该样本所在的批次推理完成"""
+        return self.submit(x, algorithm_name, test_excluded_env).result(timeout)
+
+    def _worker(self, key):
+        request_queue = self._queues[key]
+        while True:
+            batch = [request_queue.get()]
+            deadline = time.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(request_queue.get(timeout=remaining))
+                except queue.Empty:
+                    break
+            self._run_batch(key, batch)
+
+    @torch.inference_mode()
+    def _run_batch(self, key, batch):
+        algorithm_name, test_excluded_env = key
+        start_time = time.time()
+        try:
+            try:
+                model, _ = model_registry.get(algorithm_name, test_excluded_env)
+            except FileNotFoundError as e:
+                print(f"模型文件不存在，使用模拟预测: {e}")
+                for _, future, _ in batch:
+                    future.set_result(mock_prediction(algorithm_name))
+                return
+
+            logits = model.predict(torch.cat([x for x, _, _ in batch]))
+            probs = torch.softmax(logits, dim=1).cpu()
+            pred_classes = probs.argmax(dim=1).tolist()
+            for i, (_, future, _) in enumerate(batch):
+                future.set_result((pred_classes[i], probs[i]))
+        except Exception as e:
+            print(f"批量推理失败: {e}")
+            for _, future, _ in batch:
+                if not future.done():
+                    future.set_exception(RuntimeError(f"模型预测失败: {e}"))
+        finally:
+            with self._stats_lock:
+                self.batches += 1
+                self.batch_sizes[len(batch)] += 1
+                self.wait_time_total += sum(start_time - t for _, _, t in batch)
+
+    def stats(self):
+        """返回队列深度和批大小统计"""
+        with self._lock:
+            queue_depths = {f"{a}_te{te}": q.qsize()
+                            for (a, te), q in self._queues.items()}
+        with self._stats_lock:
+            batched_requests = sum(size * n for size, n in self.batch_sizes.items())
+            return {
+                'max_batch_size': self.max_batch_size,
+                'max_wait_ms': self.max_wait * 1000.,
+                'requests': self.requests,
+                'batches': self.batches,
+                'mean_batch_size': batched_requests / max(self.batches, 1),
+                'batch_size_histogram': {str(k): v for k, v in sorted(self.batch_sizes.items())},
+                'mean_queue_wait_ms': 1000. * self.wait_time_total / max(batched_requests, 1),
+                'queue_depth': queue_depths,
+                'max_queue_depth': self.max_queue_depth,
+            }
+
+
+# 全局调度器，批大小和等待窗口可通过环境变量调整
+inference_scheduler = InferenceScheduler(
+    max_batch_size=int(os.environ.get("BATCH_MAX_SIZE", 8)),
+    max_wait_ms=float(os.environ.get("BATCH_MAX_WAIT_MS", 5)),
+)
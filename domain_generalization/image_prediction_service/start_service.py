@@ -5,6 +5,9 @@ import sys
 # 添加父目录到Python路径，确保能找到domain_generalization模块
 sys.path.append(os.path.abspath(os.path.join(os.path.dirname(__file__), '..')))
 
+# 使用 --asgi 参数时以ASGI模式（uvicorn + asgi_app.py）启动，否则启动Flask服务
+use_asgi = '--asgi' in sys.argv[1:]
+
 # 检查是否已安装依赖
 try:
     import flask
@@ -12,6 +15,9 @@ try:
     import torchvision
     from PIL import Image
     import numpy
+    if use_asgi:
+        import starlette
+        import uvicorn
     print("所有依赖已安装，正在启动服务...")
 except ImportError:
     print("检测到缺少依赖，建议先安装requirements.txt中的依赖：")
@@ -25,5 +31,12 @@ print("API接口: http://0.0.0.0:10000/api/predict")
 print("健康检查: http://0.0.0.0:10000/health")
 print("按 Ctrl+C 停止服务")
 
-# 运行Flask应用
-subprocess.run([sys.executable, '-m', 'flask', 'run', '--host=0.0.0.0', '--port=10000'])
\ No newline at end of file
+if use_asgi:
+    # 运行ASGI应用：单进程事件循环，推理在有界线程池和微批调度器中执行
+    print("运行模式: ASGI (uvicorn)")
+    subprocess.run([sys.executable, '-m', 'uvicorn', 'asgi_app:app',
+                    '--host=0.0.0.0', '--port=10000',
+                    '--limit-concurrency', os.environ.get('ASGI_LIMIT_CONCURRENCY', '1024')])
+else:
+    # 运行Flask应用
+    subprocess.run([sys.executable, '-m', 'flask', 'run', '--host=0.0.0.0', '--port=10000'])